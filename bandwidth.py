@@ -0,0 +1,81 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import statistics
+import threading
+from collections import deque
+
+from metrics import REGISTRY
+
+# part of the upload which is not the h264 stream (mp4 boxes, multipart, latency...)
+UPLOAD_OVERHEAD = 0.1
+# the resolution is never reduced below this width or height
+MINIMUM_SIDE = 128
+
+
+class UplinkEstimator:
+    """ Estimates the throughput of the uplink from the last 'window' uploads. Uploads smaller
+        than 'minimum_size' bytes are ignored: their time is mostly the latency of the Bot API """
+
+    def __init__(self, window=5, minimum_size=64 * 1024):
+        self.minimum_size = minimum_size
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, size, seconds):
+        """ Takes into account that 'size' bytes have been uploaded in 'seconds' seconds """
+
+        if size < self.minimum_size or seconds <= 0:
+            return
+
+        with self._lock:
+            self._samples.append(size / seconds)
+        REGISTRY.gauge("uplink_bytes_per_second", "Estimated throughput of the uplink").set(int(self.estimate))
+
+    @property
+    def estimate(self):
+        """ Bytes per second the uplink is expected to give (None if nothing has been uploaded yet).
+            The median is used so that a single stalled upload does not ruin the estimate """
+
+        with self._lock:
+            if not self._samples:
+                return None
+            return statistics.median(self._samples)
+
+
+def choose_video_settings(estimate, duration, target_time, resolution, framerate,
+                          min_bitrate, max_bitrate, min_bits_per_pixel):
+    """ Returns (bitrate, resize) for a video of 'duration' seconds so that its upload takes
+        about 'target_time' seconds with an uplink of 'estimate' bytes per second. If the
+        bitrate is too low for 'resolution' ('min_bits_per_pixel'), the video is recorded at
+        half the width and height (as many times as needed). 'resize' is None if the video
+        must be recorded at the resolution of the camera """
+
+    if estimate is None or target_time <= 0:
+        return max_bitrate, None
+
+    bitrate = int(estimate * 8 * target_time * (1 - UPLOAD_OVERHEAD) / max(duration, 1))
+    bitrate = max(min_bitrate, min(max_bitrate, bitrate))
+
+    width, height = resolution
+    resize = None
+    while bitrate / (width * height * framerate) < min_bits_per_pixel and \
+            min(width, height) // 2 >= MINIMUM_SIDE:
+        # the encoder works with blocks of 16x16 pixels
+        width, height = width // 2 // 16 * 16, height // 2 // 16 * 16
+        resize = (width, height)
+
+    return bitrate, resize
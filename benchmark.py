@@ -0,0 +1,802 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Runs FourthBrother without a Raspberry Pi nor Telegram, so that its performance can be
+    measured on any Linux machine:
+
+    - the pins are the mock pins of gpiozero.
+    - the camera is a fake PiCamera which produces h264 and jpeg data at real bitrates.
+    - the Bot API is a local HTTP server which answers like Telegram does.
+
+    A storm of pir triggers and a burst of commands are played and the latency of the alerts,
+    the throughput of the messages and the peak memory are reported. Before that, the built-in
+    muxer and ffmpeg (if it is installed) mux the same clip. For instance:
+
+        python benchmark.py --pir-triggers 5 --commands 30 --json results.json """
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_TOKEN = "123456:benchmark"
+BENCH_CHAT_ID = -1000
+PINS = {"PIR_SENSOR": 17, "RELAY_A": 27, "RELAY_B": 22}
+
+# text of the alert sent when the pir sensor is triggered (see handlers.movement_handler)
+ALERT_TEXT = "ATENCIÓN"
+# commands whose first reply mentions who sent them, so their latency can be measured
+COMMANDS_WITH_SENDER = {"foto", "video", "movimiento", "alarma", "lamp"}
+
+
+# ---------------------------------------------------------------------------------------------
+# fake camera
+# ---------------------------------------------------------------------------------------------
+
+def _write_ue(bits, value):
+    """ Appends the exp-Golomb code of 'value' to a list of bits """
+
+    value += 1
+    length = value.bit_length()
+    bits.extend([0] * (length - 1))
+    bits.extend(int(bit) for bit in bin(value)[2:])
+
+
+def _bits_to_bytes(bits):
+    # rbsp trailing bits
+    bits = bits + [1]
+    bits += [0] * (-len(bits) % 8)
+    return bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+
+def generate_sps(width, height, profile_idc=100):
+    """ Returns a SPS NAL unit (with its start code) for that resolution. The camera of the
+        Pi uses the high profile (100) by default, whose SPS also has the chroma format """
+
+    bits = []
+    # profile_idc, constraint flags and level_idc (4.0)
+    bits.extend(int(bit) for bit in f"{profile_idc:08b}{0 if profile_idc == 100 else 0xc0:08b}{40:08b}")
+    # seq_parameter_set_id
+    _write_ue(bits, 0)
+    if profile_idc == 100:
+        # chroma_format_idc (4:2:0) and 8 bits for luma and chroma
+        for value in (1, 0, 0):
+            _write_ue(bits, value)
+        # qpprime_y_zero_transform_bypass_flag and seq_scaling_matrix_present_flag
+        bits.extend([0, 0])
+    for value in (0, 2, 1):
+        # log2_max_frame_num_minus4, pic_order_cnt_type, max_num_ref_frames
+        _write_ue(bits, value)
+    # gaps_in_frame_num_value_allowed_flag
+    bits.append(0)
+    _write_ue(bits, (width + 15) // 16 - 1)
+    _write_ue(bits, (height + 15) // 16 - 1)
+    # frame_mbs_only_flag, direct_8x8_inference_flag, frame_cropping_flag, vui_parameters_present_flag
+    bits.extend([1, 1, 0, 0])
+    return b"\x00\x00\x00\x01\x67" + _bits_to_bytes(bits)
+
+
+PPS = b"\x00\x00\x00\x01\x68\xce\x38\x80"
+
+
+def _payload(size):
+    # without zeros there cannot be start codes inside the payload. The first bit set
+    # means that the slice starts at the first macroblock (a new frame)
+    return b"\x88" + os.urandom(size - 1).replace(b"\x00", b"\x01")
+
+
+def generate_h264(seconds, framerate, resolution, bitrate, intra_period=None):
+    """ Returns the h264 stream the fake camera would record in 'seconds' seconds (without
+        waiting for them) and the number of frames it has """
+
+    frame_size = bitrate // 8 // framerate
+    intra_period = intra_period or framerate
+    sps = generate_sps(*resolution)
+    frame_count = int(seconds * framerate)
+    frames = []
+    for index in range(frame_count):
+        if index % intra_period == 0:
+            frames.append(sps + PPS + b"\x00\x00\x00\x01\x65" + _payload(frame_size * 4))
+        else:
+            frames.append(b"\x00\x00\x00\x01\x41" + _payload(max(16, frame_size // 2)))
+    return b"".join(frames), frame_count
+
+
+class FakeFrameType:
+    frame = 0
+    key_frame = 1
+    sps_header = 2
+    motion_data = 3
+
+
+class FakeCircularIO:
+    """ Keeps the frames of the last 'size' bytes, like picamera.PiCameraCircularIO """
+
+    def __init__(self, camera, size, splitter_port=1, **kwargs):
+        self.camera = camera
+        self.size = size
+        self._frames = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._frames.append((time.monotonic(), data))
+            self._bytes += len(data)
+            while self._bytes > self.size and self._frames:
+                self._bytes -= len(self._frames.pop(0)[1])
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def copy_to(self, output, seconds=None, first_frame=FakeFrameType.sps_header):
+        with self._lock:
+            frames = list(self._frames)
+
+        if seconds is not None and frames:
+            frames = [frame for frame in frames if frame[0] >= frames[-1][0] - seconds]
+        # the copy starts at a frame with headers
+        while frames and not frames[0][1].startswith(b"\x00\x00\x00\x01\x67"):
+            frames.pop(0)
+        for _, data in frames:
+            output.write(data)
+
+    def close(self):
+        with self._lock:
+            self._frames = []
+            self._bytes = 0
+
+
+class _FakeEncoder(threading.Thread):
+    """ Writes a frame into the output every 1/framerate seconds """
+
+    def __init__(self, camera, output, intra_period, inline_headers, bitrate=None, resize=None):
+        super().__init__(daemon=True, name="fake-encoder")
+        self.camera = camera
+        self.output = output
+        self.intra_period = intra_period
+        self.inline_headers = inline_headers
+
+        # frames are about the size a real encoder would give at that bitrate (limited by the
+        # one requested and smaller if the video is resized), keyframes bigger
+        resolution = resize or camera.resolution
+        bitrate = min(bitrate or camera.bitrate, camera.bitrate * resolution[0] * resolution[1]
+                      // (camera.resolution[0] * camera.resolution[1]))
+        frame_size = bitrate // 8 // camera.framerate
+        self._frame_sizes = (max(16, frame_size // 2), max(32, frame_size * 4))
+        self._sps = generate_sps(*resolution)
+
+        self._pending_output = None
+        self._split_done = threading.Event()
+        self._finished = threading.Event()
+
+    def split(self, output):
+        self._split_done.clear()
+        self._pending_output = output
+        self._split_done.wait()
+
+    def run(self):
+        frame_time = 1 / self.camera.framerate
+        next_time = time.monotonic()
+        for index in itertools.count():
+            if self._finished.is_set():
+                break
+
+            is_keyframe = index % self.intra_period == 0 or self._pending_output is not None
+            if is_keyframe and self._pending_output is not None:
+                self.output = self._pending_output
+                self._pending_output = None
+                self._split_done.set()
+
+            if is_keyframe:
+                headers = self._sps + PPS if index == 0 or self.inline_headers else b""
+                frame = headers + b"\x00\x00\x00\x01\x65" + _payload(self._frame_sizes[1])
+            else:
+                frame = b"\x00\x00\x00\x01\x41" + _payload(self._frame_sizes[0])
+            self.output.write(frame)
+
+            next_time += frame_time
+            self._finished.wait(max(0, next_time - time.monotonic()))
+
+        if hasattr(self.output, "flush"):
+            self.output.flush()
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+
+class FakePiCamera:
+    """ Stand-in for picamera.PiCamera. Photos take as long as a frame and recordings
+        produce a h264 stream (which the muxers accept) in real time """
+
+    def __init__(self, framerate=30, resolution=(576, 288), bitrate=4000000, **kwargs):
+        self.framerate = framerate
+        self.resolution = resolution
+        self.rotation = 0
+        self.bitrate = bitrate
+        self._encoders = {}
+        # what the automatic exposure and white balance would have reached
+        self.shutter_speed = 0
+        self.exposure_speed = 20000
+        self.awb_mode = "auto"
+        self.awb_gains = (1.5, 1.2)
+        self.analog_gain = 1.0
+        self.digital_gain = 1.0
+
+    def _jpeg(self):
+        # roughly 1.5 bits per pixel
+        size = self.resolution[0] * self.resolution[1] * 3 // 16
+        return b"\xff\xd8" + _payload(size) + b"\xff\xd9"
+
+    def capture(self, output, format="jpeg", use_video_port=False, splitter_port=0, **kwargs):
+        # the still port needs a mode switch which takes far longer than a frame
+        time.sleep(1 / self.framerate if use_video_port else 0.5)
+        output.write(self._jpeg())
+
+    def capture_sequence(self, outputs, format="jpeg", use_video_port=False, splitter_port=0, **kwargs):
+        for output in outputs:
+            self.capture(output, format, use_video_port, splitter_port)
+
+    def start_recording(self, output, format="h264", splitter_port=1, intra_period=None,
+                        inline_headers=True, bitrate=None, resize=None, **kwargs):
+        if splitter_port in self._encoders:
+            raise RuntimeError(f"The splitter port {splitter_port} is already in use")
+        if isinstance(output, str):
+            output = open(output, "wb")
+
+        encoder = _FakeEncoder(self, output, intra_period or self.framerate * 2, inline_headers,
+                               bitrate, resize)
+        self._encoders[splitter_port] = encoder
+        encoder.start()
+
+    def split_recording(self, output, splitter_port=1, **kwargs):
+        self._encoders[splitter_port].split(output)
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        if splitter_port not in self._encoders:
+            raise RuntimeError(f"There is no recording in the splitter port {splitter_port}")
+        time.sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        self._encoders.pop(splitter_port).stop()
+
+    def close(self):
+        for splitter_port in list(self._encoders):
+            self.stop_recording(splitter_port)
+
+
+class FakeMotionAnalysis:
+
+    def __init__(self, camera, size=None):
+        self.camera = camera
+        self.size = size
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def install_fake_picamera(bitrate):
+    """ Makes 'import picamera' import the fake camera """
+
+    class Camera(FakePiCamera):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, bitrate=bitrate, **kwargs)
+
+    picamera = types.ModuleType("picamera")
+    picamera.PiCamera = Camera
+    picamera.PiCameraCircularIO = FakeCircularIO
+    picamera.PiVideoFrameType = FakeFrameType
+    picamera.PiCameraError = RuntimeError
+    picamera_array = types.ModuleType("picamera.array")
+    picamera_array.PiMotionAnalysis = FakeMotionAnalysis
+    picamera.array = picamera_array
+
+    sys.modules["picamera"] = picamera
+    sys.modules["picamera.array"] = picamera_array
+
+
+# ---------------------------------------------------------------------------------------------
+# fake Bot API
+# ---------------------------------------------------------------------------------------------
+
+class FakeBotApi(ThreadingHTTPServer):
+    """ Answers the requests to the Bot API like Telegram does and writes down when each
+        one arrived. Uploads take as long as they would with 'upload_bandwidth' bytes/s """
+
+    daemon_threads = True
+
+    def __init__(self, latency, upload_bandwidth):
+        super().__init__(("127.0.0.1", 0), _BotApiHandler)
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+
+        # (monotonic time, method, chat id, text, bytes of the request)
+        self.requests = []
+        self._requests_lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = queue.Queue()
+        self.polling_started = threading.Event()
+        # parameters of every 'setWebhook' request
+        self.webhooks = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def push_command(self, text, sender):
+        """ Makes the next 'getUpdates' return a command sent by 'sender'. Returns when
+            it has been pushed (monotonic time) """
+
+        self._updates.put(self.command_update(text, sender))
+        return time.monotonic()
+
+    def command_update(self, text, sender):
+        """ The update Telegram sends when 'sender' writes a command """
+
+        command = text.split()[0]
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": BENCH_CHAT_ID, "type": "supergroup", "title": "benchmark"},
+                "from": {"id": 1000 + update_id, "is_bot": False, "first_name": sender},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+            }
+        }
+
+    def record(self, method, chat_id, text, size):
+        with self._requests_lock:
+            self.requests.append((time.monotonic(), method, chat_id, text, size))
+
+    def requests_since(self, start_time):
+        """ Requests made since 'start_time' (but the ones which poll the updates) """
+
+        with self._requests_lock:
+            return [request for request in self.requests
+                    if request[0] >= start_time and request[1] != "getUpdates"]
+
+    def get_updates(self, timeout):
+        self.polling_started.set()
+        updates = []
+        try:
+            updates.append(self._updates.get(timeout=min(timeout, 1)))
+            while True:
+                updates.append(self._updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+    def message(self, chat_id, **fields):
+        return dict({"message_id": next(self._message_ids), "date": int(time.time()),
+                     "chat": {"id": int(chat_id), "type": "supergroup", "title": "benchmark"}},
+                    **fields)
+
+    def media(self, width=576, height=288):
+        file_id = next(self._file_ids)
+        return {"file_id": f"file{file_id}", "file_unique_id": f"unique{file_id}",
+                "width": width, "height": height}
+
+
+class _BotApiHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        parameters = self._parse(body)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.upload_bandwidth and len(body) > 4096:
+            time.sleep(len(body) / self.server.upload_bandwidth)
+
+        chat_id = parameters.get("chat_id")
+        self.server.record(method, chat_id, str(parameters.get("text", "")), len(body))
+        self._reply(self._result(method, parameters))
+
+    do_GET = do_POST
+
+    def _parse(self, body):
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            form = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            return {part.get_param("name", header="content-disposition"):
+                    "<file>" if part.get_filename() else part.get_content()
+                    for part in form.iter_parts()}
+        return {}
+
+    def _result(self, method, parameters):
+        server = self.server
+        chat_id = parameters.get("chat_id", BENCH_CHAT_ID)
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bro", "username": "bench_bot"}
+        if method == "getUpdates":
+            return server.get_updates(float(parameters.get("timeout", 0)))
+        if method == "setWebhook":
+            server.webhooks.append(parameters)
+            return True
+        if method in ("deleteWebhook", "deleteMessage", "answerCallbackQuery"):
+            return True
+        if method == "sendPhoto":
+            return server.message(chat_id, photo=[server.media()])
+        if method == "sendVideo":
+            return server.message(chat_id, video=dict(server.media(), duration=8))
+        if method == "sendAnimation":
+            return server.message(chat_id, animation=dict(server.media(), duration=1))
+        if method == "sendMediaGroup":
+            media = parameters.get("media", "[]")
+            count = len(json.loads(media) if isinstance(media, str) else media)
+            return [server.message(chat_id, photo=[server.media()]) for _ in range(count)]
+        if method in ("sendMessage", "editMessageReplyMarkup"):
+            return server.message(chat_id, text=str(parameters.get("text", "")))
+        return True
+
+    def _reply(self, result):
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ---------------------------------------------------------------------------------------------
+# scenario
+# ---------------------------------------------------------------------------------------------
+
+def percentile(values, q):
+    """ Nearest-rank percentile (None if there are no values) """
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99), "max": max(values) if values else None}
+
+
+def wait_until(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def wait_until_quiet(api, quiet_time, timeout):
+    """ Waits until the bot has not made any request (but polling) for 'quiet_time' seconds """
+
+    def is_quiet():
+        return not api.requests_since(time.monotonic() - quiet_time)
+
+    time.sleep(quiet_time)
+    return wait_until(is_quiet, timeout)
+
+
+def run_pir_storm(api, bro, triggers, interval, timeout):
+    """ Triggers the pir sensor 'triggers' times and measures how long it takes the alert,
+        the preview and the video to arrive to the Bot API """
+
+    alert_latencies = []
+    preview_latencies = []
+    video_latencies = []
+    zone = bro.camera_zone or bro.zones[0]
+    pin = zone.pir_sensor.pin
+
+    trigger_times = []
+    for _ in range(triggers):
+        trigger_times.append(time.monotonic())
+        pin.drive_high()
+        time.sleep(0.2)
+        pin.drive_low()
+        time.sleep(max(0, interval - 0.2))
+
+    # the triggers which arrive while a video is being recorded are ignored by the sensor
+    # handler, so not every trigger gets its alert
+    wait_until_quiet(api, 3, timeout)
+
+    requests = api.requests_since(trigger_times[0])
+    alerts = [request[0] for request in requests if request[1] == "sendMessage" and ALERT_TEXT in request[3]]
+    videos = [request[0] for request in requests if request[1] == "sendVideo"]
+    previews = [request[0] for request in requests if request[1] in ("sendAnimation", "sendPhoto")]
+
+    # each alert belongs to the latest trigger before it
+    for alert_time in alerts:
+        trigger_time = max(t for t in trigger_times if t <= alert_time)
+        alert_latencies.append(alert_time - trigger_time)
+    for preview_time in previews:
+        trigger_time = max(t for t in trigger_times if t <= preview_time)
+        preview_latencies.append(preview_time - trigger_time)
+    for video_time in videos:
+        trigger_time = max(t for t in trigger_times if t <= video_time)
+        video_latencies.append(video_time - trigger_time)
+
+    return {"triggers": triggers, "alerts": len(alerts), "previews": len(previews), "videos": len(videos),
+            "alert_latency": summarize(alert_latencies), "preview_latency": summarize(preview_latencies),
+            "video_latency": summarize(video_latencies)}
+
+
+def run_command_burst(api, commands, count, timeout):
+    """ Sends 'count' commands at once and measures how long it takes the first reply of
+        each one to arrive (only for the commands whose reply mentions who sent them) """
+
+    pushed = {}
+    start_time = time.monotonic()
+    for i in range(count):
+        sender = f"bench{i:04d}"
+        command = commands[i % len(commands)]
+        pushed_time = api.push_command(f"/{command}", sender)
+        if command in COMMANDS_WITH_SENDER:
+            pushed[sender] = pushed_time
+
+    def answered():
+        texts = [request[3] for request in api.requests_since(start_time)]
+        return [sender for sender in pushed if any(f"{sender} " in text for text in texts)]
+
+    wait_until(lambda: len(answered()) == len(pushed), timeout)
+    # the rest of the replies (photos, menus...)
+    wait_until_quiet(api, 3, timeout)
+
+    requests = api.requests_since(start_time)
+    latencies = []
+    for sender, pushed_time in pushed.items():
+        reply_times = [request[0] for request in requests if f"{sender} " in request[3]]
+        if reply_times:
+            latencies.append(min(reply_times) - pushed_time)
+
+    elapsed_time = max(request[0] for request in requests) - start_time if requests else 0
+    return {"commands": count, "measured": len(pushed), "answered": len(latencies),
+            "reply_latency": summarize(latencies),
+            "requests": len(requests),
+            "requests_per_second": len(requests) / elapsed_time if elapsed_time else None,
+            "bytes_sent": sum(request[4] for request in requests)}
+
+
+def run_muxer_comparison(seconds, framerate, resolution, bitrate, chunk_size=64 * 1024):
+    """ Muxes the same clip with every muxer (ffmpeg only if it is installed) writing it in
+        chunks, like the camera does, and measures how long 'finish' takes to return the mp4.
+        If ffprobe is installed, it also checks that it can read the result """
+
+    import helper
+    import mp4
+
+    h264, frame_count = generate_h264(seconds, framerate, resolution, bitrate)
+    muxers = {"builtin": mp4.Mp4Muxer}
+    if shutil.which("ffmpeg"):
+        muxers["ffmpeg"] = helper.FFmpegMuxer
+
+    results = {"seconds": seconds, "frames": frame_count, "h264_bytes": len(h264), "muxers": {}}
+    for name, muxer_class in muxers.items():
+        start_time = time.monotonic()
+        muxer = muxer_class(framerate)
+        for offset in range(0, len(h264), chunk_size):
+            muxer.write(h264[offset:offset + chunk_size])
+        output = muxer.finish()
+        elapsed_time = time.monotonic() - start_time
+
+        data = output.getvalue()
+        result = {"seconds": elapsed_time, "mp4_bytes": len(data), "ffprobe_frames": None}
+        if shutil.which("ffprobe"):
+            with tempfile.NamedTemporaryFile(suffix=".mp4") as mp4_file:
+                mp4_file.write(data)
+                mp4_file.flush()
+                probe = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                                        "-count_packets", "-show_entries", "stream=nb_read_packets",
+                                        "-of", "csv=p=0", mp4_file.name],
+                                       capture_output=True, text=True)
+            result["ffprobe_frames"] = int(probe.stdout.strip()) if probe.returncode == 0 else -1
+        results["muxers"][name] = result
+
+    return results
+
+
+def print_report(results):
+    def seconds(value):
+        return "-" if value is None else f"{value:.3f}s"
+
+    def latency_line(name, summary):
+        print(f"  {name:<20} n={summary['count']:<4} p50={seconds(summary['p50'])} "
+              f"p95={seconds(summary['p95'])} p99={seconds(summary['p99'])} max={seconds(summary['max'])}")
+
+    if results.get("startup"):
+        print(f"Startup: {results['startup']}")
+
+    muxing = results.get("muxers")
+    if muxing:
+        print(f"Muxing a {muxing['seconds']}s clip ({muxing['frames']} frames, {muxing['h264_bytes']} bytes):")
+        for name, result in muxing["muxers"].items():
+            probe = "" if result["ffprobe_frames"] is None else f", ffprobe reads {result['ffprobe_frames']} frames"
+            print(f"  {name:<20} {result['seconds']:.3f}s, {result['mp4_bytes']} bytes{probe}")
+        if "ffmpeg" not in muxing["muxers"]:
+            print("  ffmpeg               not installed")
+
+    storm = results.get("pir_storm")
+    if storm:
+        print(f"PIR storm: {storm['triggers']} triggers, {storm['alerts']} alerts, "
+              f"{storm['previews']} previews, {storm['videos']} videos")
+        latency_line("alert latency", storm["alert_latency"])
+        latency_line("preview latency", storm["preview_latency"])
+        latency_line("video latency", storm["video_latency"])
+
+    burst = results.get("command_burst")
+    if burst:
+        print(f"Command burst: {burst['commands']} commands, "
+              f"{burst['answered']}/{burst['measured']} measured replies")
+        latency_line("reply latency", burst["reply_latency"])
+        throughput = burst["requests_per_second"]
+        print(f"  {burst['requests']} requests to the Bot API "
+              f"({'-' if throughput is None else f'{throughput:.1f}'}/s, {burst['bytes_sent']} bytes)")
+
+    print(f"Peak memory: {results['max_rss_kb'] / 1024:.1f} MiB (RSS)", end="")
+    if results.get("tracemalloc_peak") is not None:
+        print(f", {results['tracemalloc_peak'] / 1024 / 1024:.1f} MiB (Python objects)")
+    else:
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures FourthBrother without hardware")
+    parser.add_argument("--pir-triggers", type=int, default=5)
+    parser.add_argument("--pir-interval", type=float, default=1.0,
+                        help="seconds between the pir triggers")
+    parser.add_argument("--pir-delay", type=float, default=0,
+                        help="minimum seconds between alerts (MINIMUM_DELAY_PIR)")
+    parser.add_argument("--video-duration", type=int, default=2)
+    parser.add_argument("--commands", type=int, default=20)
+    parser.add_argument("--command-mix", default="foto,movimiento,video,stats",
+                        help="commands of the burst, comma separated")
+    parser.add_argument("--bitrate", type=int, default=4000000, help="bits per second of the fake camera")
+    parser.add_argument("--muxer", default="builtin", choices=("builtin", "ffmpeg"),
+                        help="muxer of the bot (MUXER). 'ffmpeg' needs ffmpeg to be installed")
+    parser.add_argument("--mux-seconds", type=int, default=30,
+                        help="duration of the clip every muxer is compared with (0 skips it)")
+    parser.add_argument("--api-latency", type=float, default=0.05,
+                        help="seconds the fake Bot API takes to answer")
+    parser.add_argument("--upload-bandwidth", type=int, default=2000000,
+                        help="bytes per second of the uploads (0 is unlimited)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also measure the peak of Python allocations (slower)")
+    parser.add_argument("--json", help="file where the results are written")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    api = FakeBotApi(args.api_latency, args.upload_bandwidth)
+    threading.Thread(target=api.serve_forever, name="fake-bot-api", daemon=True).start()
+
+    # the configuration is read by decouple from the environment
+    work_directory = tempfile.mkdtemp(prefix="bro-benchmark-")
+    os.environ.update({
+        "TOKEN": BENCH_TOKEN,
+        "GROUP_CHAT_ID": str(BENCH_CHAT_ID),
+        "BOT_API_URL": api.base_url,
+        "UPDATES_MODE": "polling",
+        "SPOOL_DIR": os.path.join(work_directory, "spool"),
+        "HISTORY_DB": os.path.join(work_directory, "history.db"),
+        "ARCHIVE_DIR": os.path.join(work_directory, "archive"),
+        "METRICS_PORT": "0",
+        "MUXER": args.muxer,
+    })
+    os.environ.update({f"{device}_PIN": str(pin) for device, pin in PINS.items()})
+
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory
+    Device.pin_factory = MockFactory()
+    install_fake_picamera(args.bitrate)
+
+    import bro as bro_module
+    import constants
+    from startup import STARTUP
+    logging.getLogger().setLevel(args.log_level)
+
+    results = {}
+    if args.mux_seconds:
+        results["muxers"] = run_muxer_comparison(args.mux_seconds, constants.CAMERA_FRAMERATE,
+                                                 (288 * 2, 576 * 2), args.bitrate)
+
+    constants.MINIMUM_DELAY_PIR = args.pir_delay
+    constants.DEFAULT_VIDEO_DURATION = args.video_duration
+
+    bro = bro_module.create_bot()
+
+    def scenario():
+        try:
+            if not api.polling_started.wait(30):
+                raise RuntimeError("The bot has not started polling")
+
+            # the zones are created in the background once the bot is polling
+            if not bro.hardware_ready.wait(30):
+                raise RuntimeError("The hardware has not been initialized")
+            results["startup"] = STARTUP.report()
+
+            # the alarm must be on for the pir sensor to send alerts
+            api.push_command("/alarma", "setup")
+            if not wait_until(lambda: bro.zones[0].pir_activated, 30):
+                raise RuntimeError("The alarm could not be activated")
+            time.sleep(constants.PREROLL_SECONDS + 1)
+
+            if args.pir_triggers:
+                results["pir_storm"] = run_pir_storm(api, bro, args.pir_triggers, args.pir_interval,
+                                                     args.timeout)
+            if args.commands:
+                results["command_burst"] = run_command_burst(api, args.command_mix.split(","),
+                                                             args.commands, args.timeout)
+        except Exception as exc:
+            results["error"] = repr(exc)
+        finally:
+            # the bot stops the same way it does with Ctrl+C
+            os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=scenario, name="scenario", daemon=True).start()
+    bro.start(timeout=1)
+
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    if "error" in results:
+        print(f"The benchmark failed: {results['error']}", file=sys.stderr)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=4)
+
+    api.shutdown()
+    return 1 if "error" in results else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,102 +17,50 @@
 import logging
 import threading
 import os
+import secrets
 import time
 import subprocess
+from concurrent.futures import Future
 from signal import signal, SIGINT, SIGTERM, SIGABRT
-from io import BytesIO
 
-from gpiozero import MotionSensor
-from picamera import PiCamera
-
-from decouple import config
+from cachetools import LRUCache
+from telegram import InputMediaPhoto
 from telegram.ext import (Updater, CommandHandler, 
                 CallbackQueryHandler, ConversationHandler)
-from telegram.error import NetworkError, BadRequest
+from telegram.error import NetworkError, BadRequest, TelegramError, TimedOut
 
+import bandwidth
 import handlers
 import helper
+import history
+import hub
 import menu
+import metrics
 import constants
-from negative_logic_relay import NegativeLogicRelay
+import events
+import outbox
+import polling
+import spool
+import webhook
+import zones
+from startup import STARTUP
 
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-# It is important that in the .env file, in order to specify
-# the pin associated to each device calling the env variable
-# following the format: '{DEVICE_NAME}_PIN'
-DEVICES_NAMES = ["PIR_SENSOR", "RELAY_A", "RELAY_B"]
-
-def generate_pin_dict():
-    """ Returns a dict where the key is the device name
-    and the value the pin which is connected to"""
-    pins = {}
-    for device_name in DEVICES_NAMES:
-        pins[device_name] = config(f"{device_name}_PIN", cast=int)
-
-    return pins
-
-class MovementThread(threading.Thread):
-    """ This thread is in charge of switching on or off the lamp
-        depending on the state of several flags """
-
-    def __init__(self, bro, movement_event, lamp_on_time, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.bro = bro
-        self.movement_event = movement_event
-        # minimum time the lamp will be on
-        self.lamp_on_time = lamp_on_time
-
-        # ensure atomicity (https://stackoverflow.com/questions/43879149/stop-a-thread-flag-vs-event)
-        self._finished = threading.Event()
-        self.start()
-
-
-    def run(self):
-        while True:
-            # blocks until the internal flag of the event is set when movement
-            # is detected
-            self.movement_event.wait()
-            if self._finished.is_set():
-                break
-            self.bro.change_to_manual_mode()
-
-            # since the state of the lamp has changed, the menu also does is
-            self.bro.send_menu()
-            self.movement_event.clear()
-
-            # if we detect movement but the lamp is still on, wait another 'on_time' seconds
-            # before switching it off, but only if we are not exiting
-            while self.movement_event.wait(self.lamp_on_time):
-                if not self._finished.is_set():
-                    self.movement_event.clear()
-                else:
-                    break
-
-            self.bro.change_to_normal_mode()
-            # again, update the menu but if it is appropiate
-            if not self.bro.is_executing_callback.is_set() and not self._finished.is_set():
-                self.bro.send_menu()
-
-    def stop(self):
-        self._finished.set()
-        self.movement_event.set()
-        self.join()
+logger = logging.getLogger(__name__)
 
 class FourthBrother:
 
     def __init__(
         self, 
         token, 
-        authorized_chat, 
-        pin_dict, 
+        authorized_chats, 
+        zones_config, 
         camera_framerate=constants.CAMERA_FRAMERATE,
         camera_resolution=(576, 288),
         rotation=0,
-        lamp_on_time=constants.LAMP_ON_TIME
+        preroll_buffer_size=constants.PREROLL_BUFFER_SIZE
     ):
         # this event must be set everytime we want to exist
         self.exiting_event = threading.Event()
@@ -126,71 +74,249 @@ class FourthBrother:
         self.reason_for_finishing = None
 
         # telegram api stuff
-        self.__updater = Updater(token)
+        # a different url for the Bot API allows to use a local server (a fake one, for instance)
+        self.__updater = Updater(token, base_url=constants.BOT_API_URL or None)
         self.__dispatcher = self.__updater.dispatcher
 
-        # only one chat is allowed to talk to the bot. This way, bro knows where
-        # to send a message when the value of a sensor changes
-        self.__authorized_chat = authorized_chat
-
-        # the process of changing mode must be atomic to avoid possible shortcircuits
-        self.__switching_mode_lock = threading.Lock()
-
-        self.pir_sensor = MotionSensor(pin_dict["PIR_SENSOR"])
-
-        # when this relay is on, the lamp acts as if there were no pir sensor
-        self.relay_normal = NegativeLogicRelay(pin_dict["RELAY_A"])
-        self.relay_manual = NegativeLogicRelay(pin_dict["RELAY_B"])
-
-        self.camera = PiCamera(framerate=camera_framerate, resolution=camera_resolution)
-        self.camera.rotation = rotation
-
-        self.camera_lock = threading.Lock()
-        self.pir_activated = False
-
-        # If this is true, then the lamp will be on for an specified amount of time when the pir sensor
-        # detects movement
-        self.movement_activated = False
-        self.movement_event = threading.Event()
-
-        self.movement_thread = MovementThread(self, self.movement_event, lamp_on_time)
+        # only used if updates are received by polling
+        self.polling_scheduler = None
+        # only used if updates are received by the webhook
+        self.webhook_server = None
+        # the dispatcher is started by this class, not by the updater (see _start_dispatcher)
+        self._dispatcher_thread = None
+
+        # only these chats are allowed to talk to the bot. This way, bro knows where
+        # to send a message when the value of a sensor changes. The value of each chat
+        # is the set of its permissions (see helper.parse_authorized_chats)
+        if isinstance(authorized_chats, int):
+            authorized_chats = {authorized_chats: {constants.PERMISSION_CONTROL}}
+        self.__authorized_chats = authorized_chats
+
+        # every request to the Bot API is sent by priority and without exceeding the limits of Telegram
+        self.outbox = outbox.Outbox(constants.OUTBOX_RATE, constants.OUTBOX_BURST,
+                                    constants.OUTBOX_WORKERS)
+
+        # media which could not be sent is kept in disk until the network is back
+        self.spool = spool.UploadSpool(self, constants.SPOOL_DIR, constants.SPOOL_MAX_BYTES,
+                                       constants.SPOOL_MAX_AGE, constants.SPOOL_RETRY_DELAY,
+                                       constants.SPOOL_MAX_RETRY_DELAY, name="spool")
+
+        # the metrics can be scraped by Prometheus from this server (see metrics.py)
+        self.metrics_server = None
+        if constants.METRICS_PORT:
+            self.metrics_server = metrics.start_http_server(constants.METRICS_LISTEN, constants.METRICS_PORT)
+
+        # what has happened is kept in disk, so it can be consulted with /historial
+        self.history = history.EventStore(constants.HISTORY_DB)
+        self.clip_archive = None
+        if constants.ARCHIVE_DIR:
+            self.clip_archive = history.ClipArchive(constants.ARCHIVE_DIR, constants.ARCHIVE_MAX_BYTES,
+                                                    constants.ARCHIVE_MAX_AGE,
+                                                    on_evict=self.history.forget_clip)
+
+        # the handlers of the devices are not run in the thread of gpiozero (see events.py)
+        self.event_bus = events.EventBus(constants.EVENT_QUEUE_SIZE, constants.EVENT_MERGE_WINDOW,
+                                         constants.EVENT_WORKERS)
+
+        # the camera and the zones are set up by 'init_hardware', which 'start' runs in the
+        # background so that the commands which do not need them can be answered meanwhile
+        self._zones_config = zones_config
+        self._camera_options = (camera_framerate, camera_resolution, rotation, preroll_buffer_size)
+        self.hardware_ready = threading.Event()
+        # the exception raised by 'init_hardware', if any
+        self.hardware_error = None
+        self._hardware_thread = None
+        # set once the bot starts exiting (see _on_exit)
+        self._exiting = threading.Event()
+        # handlers added to the devices before they exist (see add_handler_to_zones)
+        self._pending_zone_handlers = []
+
+        # opens and closes the camera of this Pi (see camera_power.py)
+        self.camera_power = None
+        self.camera_arbiter = None
+        self.zones = []
+        # the zone the camera points at. Its lamp is switched on to take photos and videos
+        self.camera_zone = None
+        # zones whose devices are connected to another Pi are reached through its node
+        # (see hub.py and node.py). There is a link for every node
+        self.node_links = {zone_config["node"]: hub.NodeLink(zone_config["node"])
+                           for zone_config in zones_config if zone_config["node"]}
+        if self.node_links and not constants.NODE_SECRET:
+            raise ValueError("NODE_SECRET must be set in the .env file if there are zones in other nodes")
+        self.hub_server = None
+
+        # the quality of the videos depends on how fast the last ones were uploaded
+        self.uplink = bandwidth.UplinkEstimator(constants.UPLINK_ESTIMATE_WINDOW)
+
+        # requests of photos and videos which overlap in time get the same media
+        self._in_flight = helper.InFlight()
+
+        # ids Telegram has given to the media recently sent (by the key given when they were sent),
+        # so that sending it again does not need to upload it
+        self._file_ids = LRUCache(constants.FILE_ID_CACHE_SIZE)
+        self._file_ids_lock = threading.Lock()
+        self.last_media_key = None
 
         # again, Event() guarantees that there will never be problems
         self.is_executing_callback = threading.Event()
-        self.switch_on_from_button = threading.Event()
-
-        self.is_normal_mode = True
-        self.last_time_pir = 0
-
-        # Last message representing the menu
-        self._menu_message = None
-        self.send_menu()
-
 
-    def add_handler_to_device(self, attr_device_name, **events):
-        """ Adds an event handler to a device. The callback receives a
-            reference to this class 
+        # Last message representing the menu and the state of the bot it shows (by chat)
+        self._menu_messages = {}
+        self._menu_states = {}
+        # id of the last message of each chat. If it is not the menu, the menu is sent
+        # again so that it stays at the bottom of the chat
+        self._last_message_ids = {}
+
+        # refreshes of the menu requested within a short period of time are coalesced
+        self._menu_timer = None
+        self._menu_timer_lock = threading.Lock()
+        self._menu_refresh_lock = threading.Lock()
+
+    def init_hardware(self):
+        """ Opens the camera, sets up the zones and then sends the menu. Opening the camera
+            takes a few seconds, so 'start' runs it once the bot is already getting updates.
+            Meanwhile, the commands which need the hardware wait for it """
+
+        try:
+            # every zone has its own pir sensor, lamp and state (see zones.py)
+            for zone_config in self._zones_config:
+                if zone_config["node"]:
+                    zone = hub.RemoteZone(self, zone_config["name"], self.node_links[zone_config["node"]],
+                                          zone_config["lamp_on_time"], zone_config["camera"])
+                else:
+                    zone = zones.Zone(self, zone_config["name"], zone_config["pins"],
+                                      zone_config["lamp_on_time"], zone_config["camera"])
+                self.zones.append(zone)
+            self.camera_zone = next((zone for zone in self.zones if zone.has_camera), None)
+            STARTUP.mark("zones")
+
+            # the nodes can connect once their zones exist
+            if self.node_links:
+                self.hub_server = hub.HubServer(self, self.node_links, constants.HUB_LISTEN, constants.HUB_PORT,
+                                                constants.NODE_SECRET, name="hub")
+
+            framerate, resolution, rotation, preroll_buffer_size = self._camera_options
+            camera_node = next((zone_config["node"] for zone_config in self._zones_config
+                                if zone_config["camera"]), "")
+            if camera_node:
+                self.camera_arbiter = hub.RemoteCamera(self.node_links[camera_node])
+            else:
+                # picamera is only imported if the camera is connected to this Pi
+                from camera_arbiter import CameraArbiter
+                from camera_power import CameraPower
+
+                self.camera_power = CameraPower(framerate, resolution, rotation, constants.CAMERA_IDLE_TIMEOUT,
+                                                constants.CAMERA_COLD_SETTLE, constants.CAMERA_WARM_SETTLE)
+                # the first time, the exposure and the white balance start from scratch. Waking
+                # it up now means that the next wake-ups can start from the values it gets
+                self.camera_power.wake()
+                # photos, videos and everything else share the camera through it
+                self.camera_arbiter = CameraArbiter(self.camera_power, preroll_buffer_size)
+            STARTUP.mark("camera")
+
+            for attr_device_name, immediate, events in self._pending_zone_handlers:
+                self._add_handler_to_zones(attr_device_name, immediate, events)
+            self._pending_zone_handlers.clear()
+        except Exception as exc:
+            logger.exception("The hardware could not be initialized")
+            self.hardware_error = exc
+            self.send_message("No se ha podido iniciar el hardware. Solo funcionarán los comandos "
+                              "que no lo necesitan")
+        finally:
+            self.hardware_ready.set()
+
+        if self.hardware_error is None:
+            STARTUP.mark("hardware")
+            STARTUP.log("Hardware ready")
+            self.send_menu()
+
+    def _wait_for_hardware(self):
+        """ Returns True once the hardware is ready (False if it could not be initialized
+            or the bot exits meanwhile) """
+
+        if not self.hardware_ready.is_set():
+            self.send_message("El bot se está iniciando. La orden se ejecutará en unos segundos")
+            # otherwise, the dispatcher could not be stopped (see _on_exit)
+            while not self.hardware_ready.wait(1):
+                if self._exiting.is_set():
+                    return False
+
+        if self.hardware_error is not None:
+            self.send_message("Esta orden no está disponible: no se ha podido iniciar el hardware")
+            return False
+        return True
+
+
+    def get_zone(self, name):
+        return next((zone for zone in self.zones if zone.name == name), None)
+
+    def zone_from_args(self, comm_args):
+        """ If the first argument of a command is the name of a zone, returns that zone and
+            the rest of the arguments. Otherwise, the first zone and all the arguments """
+
+        if comm_args:
+            zone = self.get_zone(comm_args[0])
+            if zone is not None:
+                return zone, comm_args[1:]
+
+        return self.zones[0], comm_args
+
+    def zone_label(self, zone):
+        """ Text which tells the zone apart in the messages (nothing if there is only one) """
+
+        return f" ({zone.name})" if len(self.zones) > 1 else ""
+
+    def add_handler_to_zones(self, attr_device_name, immediate=False, **events):
+        """ Adds an event handler to a device of every zone. The callback receives a
+            reference to this class and the zone. If 'immediate' is true, the callback
+            is run as soon as the event happens, even if the previous one is still being
+            handled, so it must return at once (see EventBus)
             NOTE: attr_device_name is the name the object (representing a device)
-            has in this class """
-
-        device = getattr(self, attr_device_name)
-        for event_name, event_handler in events.items():
-            if not hasattr(device, event_name):
-                raise AttributeError(f"{type(device)} does not have the event '{event_name}'")
-
-            setattr(device, event_name, lambda: event_handler(self))
-
-    def add_command(self, name, callback, run_async=True, end_menu=True):
+            has in the zones. If the zones do not exist yet, it is added when they are
+            created (see init_hardware) """
+
+        if not self.hardware_ready.is_set():
+            self._pending_zone_handlers.append((attr_device_name, immediate, events))
+            return
+        self._add_handler_to_zones(attr_device_name, immediate, events)
+
+    def _add_handler_to_zones(self, attr_device_name, immediate, events):
+        for zone in self.zones:
+            device = getattr(zone, attr_device_name)
+            device_name = f"{zone.name}.{attr_device_name}"
+            for event_name, event_handler in events.items():
+                if not hasattr(device, event_name):
+                    raise AttributeError(f"{type(device)} does not have the event '{event_name}'")
+
+                # the callback of gpiozero only queues the event. The handler is run by the event bus
+                self.event_bus.subscribe(device_name, event_name,
+                                         lambda event_handler=event_handler, zone=zone:
+                                         event_handler(self, zone), immediate)
+                setattr(device, event_name, lambda device_name=device_name, event_name=event_name:
+                        self.event_bus.publish(device_name, event_name))
+
+    def add_command(self, name, callback, run_async=True, end_menu=True, needs_hardware=True):
         """ Registers the callback for a specfied command (messages starting
             with '/') If 'end_menu' is true, then the menu will be sent after
-            the callback associated with this handler has ended.
+            the callback associated with this handler has ended. If 'needs_hardware'
+            is true, the callback is not run until the hardware is ready.
             NOTE: callback receives a reference of the FourthBrother object wich
             registered it """
 
         def command_wrapper(update, context):
-            if update.message.chat_id == self.__authorized_chat:
+            chat_id = update.message.chat_id
+            if constants.PERMISSION_CONTROL in self.__authorized_chats.get(chat_id, ()):
+                metrics.REGISTRY.counter("commands_total", "Commands received", command=name).inc()
+                self._last_message_ids[chat_id] = update.message.message_id
+                self.history.record(history.EVENT_COMMAND,
+                                    f"/{name} {' '.join(context.args)}".strip()
+                                    + f" ({update.effective_user.first_name})")
+                if needs_hardware and not self._wait_for_hardware():
+                    return
                 self.is_executing_callback.set()
-                callback(self, update, *context.args)
+                with metrics.REGISTRY.time("handler_seconds", "Time spent executing the commands",
+                                           command=name):
+                    callback(self, update, *context.args)
                 if end_menu:
                     self.send_menu()
                 self.is_executing_callback.clear()
@@ -201,14 +327,23 @@ class FourthBrother:
         self.__dispatcher.add_handler(CommandHandler(name, command_wrapper, run_async=run_async))
 
     def start(self, timeout=10, courtesy_time=2):
-        """ Gets new updates by the long polling method. The last thing the process does bofore
+        """ Gets new updates by the long polling method (or by a webhook if it has been configured
+        and it can be registered). The last thing the process does bofore
         being killed is to gracefully change to normal mode.
         timeout: maximum time until Telegram servers return the reply for 'getUpdates' request
         courtesy_time: extra time to wait before raising a Timeout exception """
 
         self._register_signal_handler()
 
-        self.__updater.start_polling(timeout=timeout, read_latency=courtesy_time)
+        if constants.UPDATES_MODE != "webhook" or not self._start_webhook():
+            self._start_polling(timeout, courtesy_time)
+        else:
+            STARTUP.mark("webhook")
+            STARTUP.log("Webhook ready")
+
+        # the commands can already be received while the camera is being opened
+        self._hardware_thread = threading.Thread(target=self.init_hardware, name="hardware", daemon=True)
+        self._hardware_thread.start()
 
         self.exiting_event.wait()
         if not self.finished_from_signal:
@@ -222,128 +357,536 @@ class FourthBrother:
                 # TODO: log this in a proper manner
                 print("Unknown reason for shutting down")
 
-    
+
+    def _start_polling(self, timeout, courtesy_time):
+        """ Starts the dispatcher and the thread which polls the updates. Unlike
+        Updater.start_polling, the polling slows down when nothing happens (see polling.py) """
+
+        self._start_dispatcher()
+        self.polling_scheduler = polling.PollingScheduler(
+            self.__updater.bot, self.__dispatcher.update_queue, timeout, courtesy_time,
+            constants.POLLING_ACTIVE_WINDOW, constants.POLLING_IDLE_TIMEOUT, constants.POLLING_IDLE_GAP,
+            constants.QUIET_HOURS, constants.QUIET_POLLING_TIMEOUT, constants.QUIET_POLLING_GAP, name="polling",
+            on_first_request=self._on_first_poll)
+
+    def _on_first_poll(self):
+        STARTUP.mark("first getUpdates")
+        STARTUP.log("Polling started")
+
+    def _start_dispatcher(self):
+        """ The dispatcher runs the handlers of the updates received by polling or by the webhook """
+
+        # like Updater does, it waits until it runs: Dispatcher.stop does nothing before that
+        dispatcher_ready = threading.Event()
+        self._dispatcher_thread = threading.Thread(target=self.__dispatcher.start, args=(dispatcher_ready,),
+                                                   name="dispatcher", daemon=True)
+        self._dispatcher_thread.start()
+        dispatcher_ready.wait()
+
+    def notify_activity(self):
+        """ Tells the bot that an answer from the users is likely to arrive soon """
+
+        if self.polling_scheduler is not None:
+            self.polling_scheduler.notify_activity()
+
+    def _start_webhook(self):
+        """ Starts the local server (tornado) Telegram will send the updates to and registers
+        the webhook, so that no connection has to be kept open while nothing happens.
+        Returns False if either of them failed, so that polling is used instead """
+
+        # the path of the url is the secret which proves that a request comes from Telegram
+        url_path = constants.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        webhook_url = f"{constants.WEBHOOK_URL.rstrip('/')}/{url_path}"
+
+        # if the server is not behind a proxy, it needs a certificate to serve https
+        cert = constants.WEBHOOK_CERT or None
+        key = constants.WEBHOOK_KEY or None
+
+        # NOTE: Updater.start_webhook is not used because, if the certificate is wrong or the
+        # port is in use, its thread dies and the bot would neither poll nor get the updates
+        try:
+            server = webhook.WebhookServer(self.__updater.bot, self.__dispatcher.update_queue,
+                                           constants.WEBHOOK_LISTEN, constants.WEBHOOK_PORT, url_path,
+                                           cert, key, name="webhook")
+        except OSError as exc:
+            logger.error(f"The webhook server could not be started ({exc!r}). Using polling instead")
+            return False
+
+        # the server is already listening when Telegram sends the first update
+        certificate = None
+        try:
+            # a self-signed certificate must be uploaded so that Telegram trusts it
+            if cert and constants.WEBHOOK_SELF_SIGNED:
+                certificate = open(cert, "rb")
+            self.__updater.bot.set_webhook(webhook_url, certificate=certificate)
+        except (TelegramError, OSError) as exc:
+            logger.error(f"The webhook could not be registered ({exc!r}). Using polling instead")
+            server.stop()
+            return False
+        finally:
+            if certificate:
+                certificate.close()
+
+        self.webhook_server = server
+        self._start_dispatcher()
+        return True
+
     def change_to_normal_mode(self):
-        """ Switches the relays in such a way that the lamps acts as if there were no pir sensor"""
-
-        with self.__switching_mode_lock:
-            if not self.is_normal_mode:
-                self.relay_manual.off()
-                # leave enough time for the relay to switch state. We don't want a shortcircuit
-                time.sleep(constants.DELAY_RELAYS)
-                self.relay_normal.off()
-                self.is_normal_mode = True
-
-    # TODO: make sure to gracefully change to manual mode when exiting in case
-    # it is not in that mode
-    def change_to_manual_mode(self):
-        """ Switches the relays in such a way that the lamp activate when the relay is on """
-
-        with self.__switching_mode_lock:
-            if self.is_normal_mode:
-                self.relay_normal.on()
-                # leave enough time for the relay to switch state. We don't want a shortcircuit
-                time.sleep(constants.DELAY_RELAYS)
-                self.relay_manual.on()
-                self.is_normal_mode = False
-
-    def get_image_stream(self):
-        """ Takes a photo and returns a bytes object representing the image """
+        """ Switches every zone to normal mode and waits for the relays """
 
-        with self.camera_lock:
-            stream = BytesIO()
-            self.camera.capture(stream, "png")
-            stream.seek(0)
-            return stream
+        switched = [zone.change_to_normal_mode() for zone in self.zones]
+        for future in switched:
+            future.result()
 
-        return None
+    @property
+    def is_camera_armed(self):
+        return self.camera_arbiter is not None and self.camera_arbiter.is_armed
 
-    def get_video_stream(self, video_duration):
-        """ Records a video and returns the byte stream """
+    def video_settings(self, duration):
+        """ Returns the (bitrate, resize) a video of 'duration' seconds must be recorded with
+            so that it can be uploaded in about VIDEO_TARGET_UPLOAD_TIME seconds """
 
-        with self.camera_lock:
-            stream = BytesIO()
-            self.camera.start_recording(stream, format="h264", quality=23)
-            self.camera.wait_recording(video_duration)
-            self.camera.stop_recording()
-            stream.seek(0)
-            return stream
+        bitrate, resize = bandwidth.choose_video_settings(
+            self.uplink.estimate, duration, constants.VIDEO_TARGET_UPLOAD_TIME,
+            self.camera_arbiter.resolution, self.camera_arbiter.framerate,
+            constants.VIDEO_MIN_BITRATE, constants.VIDEO_MAX_BITRATE, constants.VIDEO_MIN_BITS_PER_PIXEL)
+        logger.debug(f"Video settings for {duration}s: {bitrate} bps, resize {resize}")
+        return bitrate, resize
 
-        return None
+    def arm_camera(self):
+        """ Keeps the camera recording all the time (see CameraArbiter.arm). The videos
+            recorded meanwhile are the ones sent after a pir trigger """
+
+        self.camera_arbiter.arm(*self.video_settings(constants.PREROLL_SECONDS
+                                                     + constants.DEFAULT_VIDEO_DURATION))
+
+    def _adapt_armed_camera(self, tolerance=0.25):
+        """ If the camera is armed and the uplink has changed a lot since then, the settings
+            which suit the uplink are used once the next video ends, so the footage of the
+            circular buffer is not lost (see CameraArbiter.update_arm_settings) """
+
+        if not self.is_camera_armed:
+            return
+
+        bitrate, resize = self.video_settings(constants.PREROLL_SECONDS + constants.DEFAULT_VIDEO_DURATION)
+        armed_bitrate, armed_resize = self.camera_arbiter.arm_settings
+        if resize != armed_resize or abs(bitrate - (armed_bitrate or 0)) > tolerance * bitrate:
+            logger.info(f"Camera to be armed again: {armed_bitrate} -> {bitrate} bps, resize {resize}")
+            self.camera_arbiter.update_arm_settings(bitrate, resize)
+
+    def disarm_camera(self):
+        if self.camera_arbiter is not None:
+            self.camera_arbiter.disarm()
+
+    def keep_camera_warm(self, warm):
+        """ While the alarm is on, the camera is never closed (see camera_power.py) """
+
+        self.camera_arbiter.keep_warm(warm)
+
+    def confirm_movement(self, window=constants.MOTION_CONFIRM_WINDOW):
+        """ Returns True if the camera has seen something move around the call """
+
+        return self.camera_arbiter.confirm_movement(window)
+
+    def get_image_stream(self, image_format=constants.PHOTO_FORMAT):
+        """ Takes a photo and returns a bytes object representing the image """
+
+        return self.camera_arbiter.capture(image_format)
+
+    def get_burst_streams(self, count, interval):
+        """ Takes 'count' jpeg photos separated by 'interval' seconds and returns a list
+            with their byte streams """
+
+        return self.camera_arbiter.capture_burst(count, interval)
 
     def send_menu(self):
-        """ Sends a message with an inline keyboard representing the menu """
+        """ Sends a message with an inline keyboard representing the menu. The calls made
+            within 'MENU_REFRESH_DELAY' seconds are coalesced into one refresh. Nothing is
+            sent until the hardware is ready, since the menu shows the state of the zones """
+
+        if not self.hardware_ready.is_set() or self.hardware_error is not None:
+            return
+
+        with self._menu_timer_lock:
+            if self._menu_timer is None:
+                self._menu_timer = threading.Timer(constants.MENU_REFRESH_DELAY, self._refresh_menu)
+                self._menu_timer.daemon = True
+                self._menu_timer.start()
+
+    def _chats_with_permission(self, permission):
+        return [chat_id for chat_id, permissions in self.__authorized_chats.items()
+                if permission in permissions]
+
+    def _recipients(self, priority):
+        """ Chats which receive the messages with that priority. The ones which control the bot
+            receive everything while the ones which only receive alerts get alerts and media """
+
+        recipients = self._chats_with_permission(constants.PERMISSION_CONTROL)
+        if priority <= outbox.PRIORITY_MEDIA:
+            recipients += [chat_id for chat_id in self._chats_with_permission(constants.PERMISSION_ALERTS)
+                           if chat_id not in recipients]
+        return recipients
+
+    def _refresh_menu(self):
+        """ If the menu is the last message of a chat, only its buttons are edited (and only
+            if they have changed). Otherwise, it is deleted and sent again """
+
+        with self._menu_timer_lock:
+            self._menu_timer = None
+
+        with self._menu_refresh_lock:
+            state = menu.menu_state(self)
+            reply_markup = menu.generate_menu_keyboard(self)
+
+            for chat_id in self._chats_with_permission(constants.PERMISSION_CONTROL):
+                self._refresh_chat_menu(chat_id, state, reply_markup)
+
+    def _refresh_chat_menu(self, chat_id, state, reply_markup):
+        menu_message = self._menu_messages.get(chat_id)
+        if menu_message and menu_message.message_id == self._last_message_ids.get(chat_id):
+            if state == self._menu_states.get(chat_id):
+                return
+            try:
+                self.outbox.submit(outbox.PRIORITY_MENU, chat_id,
+                                   self.__updater.bot.edit_message_reply_markup,
+                                   menu_message.message_id, reply_markup=reply_markup).result()
+                self._menu_states[chat_id] = state
+                return
+            except BadRequest:
+                # the message does not exist anymore. Send it again
+                pass
 
-        self.delete_menu()
-        reply_markup = menu.generate_menu_keyboard(self)
-        self._menu_message = self.send_message(menu.MESSAGE, reply_markup=reply_markup)
+        self._delete_chat_menu(chat_id)
+        future = self.outbox.submit_text(outbox.PRIORITY_MENU, chat_id, self.__updater.bot.send_message,
+                                         menu.MESSAGE, reply_markup=reply_markup)
+        self._menu_messages[chat_id] = self._track_last_message(future, chat_id).result()
+        self._menu_states[chat_id] = state
 
-    def record_and_send_video(self, duration, inform=True):
+    def record_and_send_video(self, duration, inform=True, preroll=0):
         """ Records and sends a video with the specified duration. 
         If inform is True then telegram messages will be sent telling the stage of the 
-        process it is i.e (recording, processing, etc)"""
+        process it is i.e (recording, processing, etc)
+        'preroll' is the number of seconds previous to the call the video will
+        contain (only if the camera is armed)
 
-        if inform:
-            self.send_message(f"La grabación durará {duration} segundos")
-            
-        with self.get_video_stream(duration) as video_stream:
-            if inform:
-                self.send_message("Se ha terminado la grabación. Iniciando procesamiento")
-            
-            with helper.convert_to_mp4(video_stream.read(), self.camera.framerate) as mp4_stream:
-                self._retry_network_error(self.send_video, mp4_stream)
+        The video is muxed while it is being recorded, so once the recording has finished
+        only the container has to be finalized before uploading it. Returns a dict with
+        the time (in seconds) spent in each stage
 
-    def send_message(self, message, *args, **kwargs):
-        """ Sends a message to the chat which is authorized to talk to """
+        If a video is already being recorded, no other video is recorded: the request is
+        attached to that one and gets its timings """
 
-        return self.__updater.bot.send_message(self.__authorized_chat, message, *args, **kwargs)
+        if inform and self._in_flight.is_running("video"):
+            self.send_message("Ya hay una grabación en curso. Se enviará esa")
+
+        timings, _ = self._in_flight.run("video", self._record_and_send_video,
+                                         duration, inform, preroll)
+        return timings
+
+    def _record_and_send_video(self, duration, inform, preroll):
+        if not self.is_camera_armed:
+            preroll = 0
+
+        if inform:
+            self.send_message(f"La grabación durará {preroll + duration} segundos")
+
+        # when the camera is armed, the video has the settings chosen when it was armed
+        bitrate, resize = self.video_settings(preroll + duration)
+        muxer = helper.create_muxer(self.camera_arbiter.framerate)
+        start_time = time.monotonic()
+        try:
+            self.camera_arbiter.record(muxer, duration, preroll, bitrate, resize)
+        except BaseException:
+            muxer.abort()
+            raise
+        recorded_time = time.monotonic()
+
+        if inform:
+            self.send_message("Se ha terminado la grabación. Iniciando procesamiento")
+
+        with muxer.finish() as mp4_stream:
+            muxed_time = time.monotonic()
+            self._retry_network_error(self.send_video, mp4_stream,
+                                      media_key=self._new_media_key("video"))
+            uploaded_time = time.monotonic()
+            # the copy to the SD card is slow, so it does not delay the alert
+            self._archive_clip(mp4_stream, preroll + duration)
+        # the upload has updated the estimate of the uplink (see _retry_network_error)
+        self._adapt_armed_camera()
+
+        timings = {
+            "record": recorded_time - start_time,
+            "mux": muxed_time - recorded_time,
+            "upload": uploaded_time - muxed_time,
+            "total": uploaded_time - start_time
+        }
+        for stage, seconds in timings.items():
+            metrics.REGISTRY.histogram("video_stage_seconds", "Time spent in each stage of the videos",
+                                       stage=stage).observe(seconds)
+        logger.info("Video sent. " + ", ".join(f"{stage}: {seconds:.2f}s"
+                                               for stage, seconds in timings.items()))
+        return timings
+
+    def _archive_clip(self, mp4_stream, duration):
+        clip = None
+        if self.clip_archive is not None:
+            try:
+                clip = self.clip_archive.add(mp4_stream)
+            except Exception as exc:
+                # the video has been sent anyway
+                logger.error(f"The video could not be archived: {exc!r}")
+
+        self.history.record(history.EVENT_VIDEO, f"{duration}s", clip)
+
+    def send_archived_clip(self, event_id):
+        """ Sends the video of an event of the history. Returns False if that video is not
+            archived anymore (if it could not be uploaded, it is left to the spool) """
+
+        event = self.history.get(event_id)
+        if event is None or event[4] is None or self.clip_archive is None:
+            return False
+
+        clip_file = self.clip_archive.open(event[4])
+        if clip_file is None:
+            return False
+
+        with clip_file:
+            self._retry_network_error(self.send_video, clip_file,
+                                      caption=time.strftime("Grabado el %d/%m/%Y a las %H:%M:%S",
+                                                            time.localtime(event[1])))
+        return True
+
+    def take_and_send_photo(self):
+        """ Takes a photo and sends it. Requests which overlap in time get the same photo.
+            Returns the message of the photo """
+
+        message, _ = self._in_flight.run("photo", self._take_and_send_photo)
+        return message
+
+    def _take_and_send_photo(self):
+        # the stream must not be closed until it has been uploaded
+        with self.get_image_stream() as image_stream:
+            return self.send_photo(image_stream, media_key=self._new_media_key("photo")).result()
+
+    def send_preview(self, alert_time=None):
+        """ Sends a small animation (or a photo, see PREVIEW_MODE) of what the camera sees
+            right now without waiting for the video, which takes far longer to arrive.
+            'alert_time' (time.monotonic(), now by default) is when the alert was sent.
+            Returns the thread which sends it (None if previews are disabled) """
+
+        if constants.PREVIEW_MODE == "off":
+            return None
+
+        if alert_time is None:
+            alert_time = time.monotonic()
+        thread = threading.Thread(target=self._send_preview, args=(alert_time,),
+                                  name="preview", daemon=True)
+        thread.start()
+        return thread
+
+    def _send_preview(self, alert_time):
+        resize = tuple(max(16, side // constants.PREVIEW_SCALE // 16 * 16)
+                       for side in self.camera_arbiter.resolution)
+        try:
+            if constants.PREVIEW_MODE == "photo":
+                with self.camera_arbiter.capture("jpeg", resize) as image_stream:
+                    self.send_photo(image_stream, priority=outbox.PRIORITY_ALERT).result()
+            else:
+                muxer = helper.create_muxer(self.camera_arbiter.framerate)
+                try:
+                    self.camera_arbiter.record_preview(muxer, constants.PREVIEW_DURATION, resize,
+                                                       constants.PREVIEW_BITRATE)
+                except BaseException:
+                    muxer.abort()
+                    raise
+                with muxer.finish() as mp4_stream:
+                    self.send_animation(mp4_stream, priority=outbox.PRIORITY_ALERT).result()
+        except Exception:
+            # the video is coming anyway
+            logger.exception("The preview could not be sent")
+            return
+
+        metrics.REGISTRY.histogram("alert_preview_seconds", "Time from an alert to its preview",
+                                   kind=constants.PREVIEW_MODE).observe(time.monotonic() - alert_time)
+
+    def resend_media(self, media_key):
+        """ Sends again some media recently sent without uploading it. Returns None if
+            Telegram's id of that media is not known anymore """
+
+        with self._file_ids_lock:
+            file_id = self._file_ids.get(media_key)
+
+        if file_id is None:
+            return None
+
+        sending_func = self.send_video if media_key.startswith("video") else self.send_photo
+        return sending_func(file_id)
+
+    def _new_media_key(self, kind):
+        media_key = f"{kind}-{time.time():.6f}"
+        self.last_media_key = media_key
+        return media_key
+
+    def _cache_file_id(self, future, media_key):
+        """ Remembers the id Telegram gives to the media once 'future' is done """
+
+        def cache_file_id(future):
+            if future.exception() is None:
+                file_id = helper.get_file_id(future.result())
+                if file_id is not None:
+                    with self._file_ids_lock:
+                        self._file_ids[media_key] = file_id
+
+        if media_key is not None:
+            future.add_done_callback(cache_file_id)
+        return future
+
+    def _track_last_message(self, future, chat_id):
+        """ Remembers which is the last message of the chat once 'future' is done """
+
+        def update_last_message_id(future):
+            if future.exception() is None:
+                # if something has been sent, the network is up
+                self.spool.notify_online()
+                sent_messages = future.result()
+                if isinstance(sent_messages, list):
+                    sent_messages = sent_messages[-1]
+                self._last_message_ids[chat_id] = sent_messages.message_id
+
+        future.add_done_callback(update_last_message_id)
+        return future
+
+    def _send_media(self, priority, sending_func_name, media, args, kwargs, media_key=None):
+        """ Uploads the media to the first recipient and, once Telegram has given it an id,
+            sends it to the rest of the chats by that id, in parallel. This way, the media is
+            only uploaded once. Returns the Future of the first chat """
+
+        recipients = self._recipients(priority)
+        bot_function = getattr(self.__updater.bot, sending_func_name)
+
+        def fan_out(future):
+            if future.exception() is not None:
+                return
+
+            sent_messages = future.result()
+            if isinstance(sent_messages, list):
+                # an album. Each photo has its own id
+                media_ids = [InputMediaPhoto(helper.get_file_id(message)) for message in sent_messages]
+            else:
+                media_ids = helper.get_file_id(sent_messages)
+
+            for chat_id in recipients[1:]:
+                self._track_last_message(self.outbox.submit(priority, chat_id, bot_function,
+                                                            media_ids, *args, **kwargs), chat_id)
+
+        future = self.outbox.submit(priority, recipients[0], bot_function, media, *args, **kwargs)
+        future = self._track_last_message(self._cache_file_id(future, media_key), recipients[0])
+        if len(recipients) > 1:
+            future.add_done_callback(fan_out)
+        return future
+
+    # NOTE: the following methods do not wait for the message to be sent. They return a
+    # Future (see outbox.py) whose result is the reply of Telegram (in the first chat)
+
+    def send_message(self, message, *args, priority=outbox.PRIORITY_STATUS, **kwargs):
+        """ Sends a message to the chats which are authorized to talk to. If none of them
+            receives messages with that priority (only chats of alerts are authorized), the
+            Future returned is already done and its result is None """
+
+        futures = []
+        for chat_id in self._recipients(priority):
+            if args:
+                future = self.outbox.submit(priority, chat_id, self.__updater.bot.send_message,
+                                            message, *args, **kwargs)
+            else:
+                future = self.outbox.submit_text(priority, chat_id, self.__updater.bot.send_message,
+                                                 message, **kwargs)
+            futures.append(self._track_last_message(future, chat_id))
+
+        if not futures:
+            future = Future()
+            future.set_result(None)
+            return future
+        return futures[0]
     
-    def send_photo(self, photo, *args, **kwargs):
-        """ Sends a photo (stream of bytes) to the chat which is authorized to talk to """
+    def send_photo(self, photo, *args, priority=outbox.PRIORITY_MEDIA, media_key=None, **kwargs):
+        """ Sends a photo (stream of bytes) to the chats which are authorized to talk to.
+            If 'media_key' is given, the id Telegram gives to the photo is remembered
+            (see resend_media) """
 
-        return self.__updater.bot.send_photo(self.__authorized_chat, photo, *args, **kwargs)
+        return self._send_media(priority, "send_photo", photo, args, kwargs, media_key)
 
-    def send_video(self, video, *args, **kwargs):
-        """ Sends a video (stream of bytes) to the chat which is authorized to talk to """
+    def send_media_group(self, media, *args, priority=outbox.PRIORITY_MEDIA, **kwargs):
+        """ Sends several photos (streams of bytes) as an album to the chats which are authorized to talk to """
 
-        return self.__updater.bot.send_video(self.__authorized_chat, video, *args, **kwargs)
+        media = [InputMediaPhoto(photo) for photo in media]
+        return self._send_media(priority, "send_media_group", media, args, kwargs)
 
-    def delete_message_by_id(self, message_id, *args, **kwargs):
-        """ Deletes a message given it id. If the operation succeeded, return true"""
+    def send_video(self, video, *args, priority=outbox.PRIORITY_MEDIA, media_key=None, **kwargs):
+        """ Sends a video (stream of bytes) to the chats which are authorized to talk to.
+            If 'media_key' is given, the id Telegram gives to the video is remembered
+            (see resend_media) """
 
-        return self.__updater.bot.delete_message(self.__authorized_chat, message_id, *args, **kwargs)
+        return self._send_media(priority, "send_video", video, args, kwargs, media_key)
 
-    def delete_menu(self):
-        """ Deletes the menu message """
+    def send_animation(self, animation, *args, priority=outbox.PRIORITY_MEDIA, **kwargs):
+        """ Sends an animation (a short mp4 without sound) to the chats which are authorized to talk to """
+
+        return self._send_media(priority, "send_animation", animation, args, kwargs)
+
+    def delete_message_by_id(self, chat_id, message_id, *args, priority=outbox.PRIORITY_MENU, **kwargs):
+        """ Deletes a message of a chat given it id. If the operation succeeded, return true"""
+
+        return self.outbox.submit(priority, chat_id, self.__updater.bot.delete_message,
+                                  message_id, *args, **kwargs)
 
-        if self._menu_message:
+    def _delete_chat_menu(self, chat_id):
+        menu_message = self._menu_messages.pop(chat_id, None)
+        if menu_message:
             try:
-                self._menu_message.delete()
+                self.delete_message_by_id(chat_id, menu_message.message_id).result()
             except BadRequest:
                 # don't bother me telling the message does not exist
                 pass
 
-    def add_menu_callback_query(self, callback_data, callback, end_menu=True, run_async=True):
+    def delete_menu(self):
+        """ Deletes the menu message of every chat """
+
+        for chat_id in list(self._menu_messages):
+            self._delete_chat_menu(chat_id)
+
+    def add_menu_callback_query(self, callback_data, callback, end_menu=True, run_async=True,
+                                needs_hardware=True):
         """ Adds a callback query triggered when a button from an inline keyboard is pressed
             and the data associated to it matches the regex. The rule I have established is
             that the menu will become a normal message after an inline button has been pressed
             so that a sort of register with the actions of the users is kept in the chat
 
             If 'end_menu' is True, then the menu message will be sent after the callback has
-            finished"""
+            finished
+
+            NOTE: the data of a button can carry arguments separated by ':' (like the zone
+            in 'lamp:garaje'). They are passed to the callback as the arguments of a command.
+            The buttons of a menu sent before a restart can be pressed before the hardware
+            is ready, so 'needs_hardware' works like in 'add_command' """
             
         def callback_query_wrapper(update, context):
             # there is no need to check who has typed because a callback query can only 
             # be triggered by a command
             query = update.callback_query
             query.answer()
+            comm_args = query.data.split(":")[1:]
+            self.history.record(history.EVENT_COMMAND, f"/{' '.join([callback_data] + comm_args)} "
+                                                       f"({update.effective_user.first_name})")
 
-            callback(self, update)
+            if needs_hardware and not self._wait_for_hardware():
+                return
+            callback(self, update, *comm_args)
             if end_menu:
                 self.send_menu()
 
         self.__dispatcher.add_handler(CallbackQueryHandler(callback_query_wrapper,
-                                        pattern=f"^{callback_data}$", run_async=run_async))
+                                        pattern=f"^{callback_data}(:.+)?$", run_async=run_async))
 
     def add_button_and_command(self, name, callback, *args, **kwargs):
         """ Pressing a button is like executing a command but without typing it. This method
@@ -359,14 +902,48 @@ class FourthBrother:
             NOTE: signal handlers are executed in the main thread so in case this method
             is called after Upater.idle(), it will be called after all threads have finished """
 
+        self._exiting.set()
+        # the devices must not be created while they are being released, but a camera which
+        # does not open must not keep the bot from exiting (or rebooting)
+        if self._hardware_thread is not None:
+            self._hardware_thread.join(constants.HARDWARE_EXIT_TIMEOUT)
+            if self._hardware_thread.is_alive():
+                logger.error("The hardware is still being initialized. Exiting anyway")
+
+        with self._menu_timer_lock:
+            if self._menu_timer is not None:
+                self._menu_timer.cancel()
+                self._menu_timer = None
         self.delete_menu()
 
-        # NOTE: stop() calls join()
-        self.movement_thread.stop()
-
+        # the hardware thread could still be adding zones
+        for zone in list(self.zones):
+            zone.stop()
+        self.event_bus.stop()
+
+        if self.polling_scheduler is not None:
+            self.polling_scheduler.stop()
+        if self.webhook_server is not None:
+            self.webhook_server.stop()
+        # the updater does not own the thread of the dispatcher, so it is stopped here
+        self.__dispatcher.stop()
+        if self._dispatcher_thread is not None:
+            self._dispatcher_thread.join()
         self.__updater.stop()
 
+        self.disarm_camera()
+        if self.camera_power is not None:
+            self.camera_power.close()
         self.change_to_normal_mode()
+        if self.hub_server is not None:
+            self.hub_server.stop()
+
+        # the messages left are sent before exiting
+        self.spool.stop()
+        self.outbox.stop()
+        self.history.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
 
     def _signal_handler(self, sig, frame):
         if not self.exiting_event.is_set():
@@ -383,21 +960,43 @@ class FourthBrother:
         for sig in signals:
             signal(sig, self._signal_handler)
 
-    def _retry_network_error(self, sending_func, stream, attempts=3, *args, **kwargs):
-        """ In case of a NetworkError, retries 'attempts' times before giving up. """
+    def _retry_network_error(self, sending_func, stream, attempts=3, **kwargs):
+        """ In case of a NetworkError, retries 'attempts' times before giving up. Then,
+            the stream is stored in the spool, which will keep trying to send it.
+            NOTE: 'sending_func' must be one of the 'send_*' methods of this class """
 
+        size = stream.seek(0, os.SEEK_END)
         for i in range(1, attempts + 1):
+            future = None
             try:
-                sending_func(stream, *args, **kwargs)
-                break
-            except NetworkError:
-                # NOTE: log error in a proper manner (using logging)
-                print(f"NETWORK ERROR: trying again... {i}/{attempts}")
+                # the stream could have been read by the previous attempt
+                stream.seek(0)
+                future = sending_func(stream, **kwargs)
+                result = future.result()
+                # the time the request waited in the outbox has nothing to do with the uplink
+                self.uplink.observe(size, time.monotonic() - future.sent_time)
+                return result
+            except NetworkError as exc:
+                if isinstance(exc, TimedOut) and future is not None:
+                    # the uplink is not faster than this, which is better than knowing nothing
+                    self.uplink.observe(size, time.monotonic() - future.sent_time)
+                metrics.REGISTRY.counter("upload_retries_total", "Uploads retried after a network error").inc()
+                logger.warning(f"NETWORK ERROR: trying again... {i}/{attempts}")
+                if i < attempts:
+                    time.sleep(helper.backoff_delay(i, constants.SPOOL_RETRY_DELAY / 4,
+                                                    constants.SPOOL_RETRY_DELAY))
+
+        metrics.REGISTRY.counter("uploads_spooled_total", "Uploads left to the spool").inc()
+        self.spool.add(sending_func.__name__, stream, **kwargs)
+        return None
 
 
-def main():
-    pin_dict = generate_pin_dict()
-    bro = FourthBrother(constants.TOKEN, constants.GROUP_CHAT_ID, pin_dict,
+def create_bot():
+    """ Creates the bot with all its commands and handlers, ready to be started """
+
+    STARTUP.mark("imports")
+    authorized_chats = helper.parse_authorized_chats(constants.AUTHORIZED_CHATS)
+    bro = FourthBrother(constants.TOKEN, authorized_chats, zones.read_zones_config(),
                             camera_resolution=(288*2, 576*2), rotation=270)
 
     # add commands
@@ -407,19 +1006,28 @@ def main():
     bro.add_button_and_command(handlers.LAMP, handlers.lamp_command)
     bro.add_button_and_command(handlers.MOVEMENT, handlers.movement_command)
 
-    bro.add_command(handlers.REBOOT, handlers.reboot_command, end_menu=False)
-    bro.add_command(handlers.SHUTDOWN, handlers.shutdown_command, end_menu=False)
+    # these ones do not use the camera nor the zones, so they work while the hardware starts
+    bro.add_command(handlers.RESEND, handlers.resend_command, needs_hardware=False)
+    bro.add_command(handlers.HISTORY, handlers.history_command, needs_hardware=False)
+    bro.add_command(handlers.CLIP, handlers.clip_command, needs_hardware=False)
+    bro.add_command(handlers.STATS, handlers.stats_command, needs_hardware=False)
+    bro.add_command(handlers.REBOOT, handlers.reboot_command, end_menu=False, needs_hardware=False)
+    bro.add_command(handlers.SHUTDOWN, handlers.shutdown_command, end_menu=False, needs_hardware=False)
 
     # add menu
     bro.add_command("menu", menu.start_menu_command, end_menu=False)
 
     # add handlers associated to sensors
-    bro.add_handler_to_device("pir_sensor", when_activated=handlers.movement_handler)
+    bro.add_handler_to_zones("pir_sensor", immediate=True, when_activated=handlers.movement_lamp_handler)
+    bro.add_handler_to_zones("pir_sensor", when_activated=handlers.movement_handler)
+
+    STARTUP.mark("bot")
+    return bro
 
-    bro.start(timeout=15)
 
-    # TODO: polling at night is nonsense. Establish
-    # an interval of time when the bot does not poll? 
+def main():
+    bro = create_bot()
+    bro.start(timeout=15)
 
     # TODO: think about unexpected exception and the way to handle them
 
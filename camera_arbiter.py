@@ -0,0 +1,275 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+
+from picamera import PiCameraCircularIO, PiVideoFrameType
+
+import constants
+import helper
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# every kind of request uses its own splitter port, so they do not have to wait for each other
+PHOTO_PORT = 0
+VIDEO_PORT = 1
+MOTION_PORT = 2
+PREVIEW_PORT = 3
+
+
+def _encoder_options(bitrate, resize):
+    # picamera uses its defaults for the options which are not given
+    options = {}
+    if bitrate:
+        options["bitrate"] = bitrate
+    if resize:
+        options["resize"] = tuple(resize)
+    return options
+
+
+class CameraArbiter:
+    """ Shares the camera between everything that needs it by means of the splitter ports
+        of picamera:
+
+        - port 0: photos. They are taken from the video port, so they do not interrupt
+          the recordings nor wait for them to finish.
+        - port 1: videos and the circular buffer of the armed mode.
+        - port 2: confirmation of the pir triggers (see motion.py).
+        - port 3: previews of the videos (small and short).
+
+        Only requests which need the same port wait for each other. The camera is opened and
+        closed by 'power' (see camera_power.py), so it is only powered while it is needed """
+
+    def __init__(self, power, preroll_buffer_size):
+        self.power = power
+
+        # when the camera is armed, it is always recording into this circular buffer
+        # so that the footage previous to a trigger is not lost. Its size is the
+        # maximum amount of memory (in bytes) the buffer is allowed to use
+        self._preroll_stream = None
+        self._preroll_buffer_size = preroll_buffer_size
+
+        # the motion vectors of the h264 encoder tell whether a pir trigger is real
+        self._motion_detector = None
+
+        self._photo_lock = threading.Lock()
+        self._video_lock = threading.Lock()
+        self._motion_lock = threading.Lock()
+        self._preview_lock = threading.Lock()
+
+        # True while a video (not the circular buffer) is being recorded
+        self.is_recording = False
+        # (bitrate, resize) given to 'arm' and the ones the next video will leave behind
+        # (see update_arm_settings)
+        self.arm_settings = (None, None)
+        self._next_arm_settings = None
+
+    @property
+    def framerate(self):
+        return self.power.framerate
+
+    @property
+    def is_armed(self):
+        return self._preroll_stream is not None
+
+    @property
+    def resolution(self):
+        return self.power.resolution
+
+    def keep_warm(self, warm=True):
+        """ Keeps the camera open while the alarm is on, so that a trigger never has to wait
+            for it to wake up """
+
+        self.power.keep_warm("alarm", warm)
+
+    def arm(self, bitrate=None, resize=None):
+        """ Keeps the camera recording all the time into a bounded circular buffer held in
+            memory. This way, when a video is requested, the encoder is already running and
+            the seconds previous to the request can also be included.
+            NOTE: the videos recorded while it is armed have 'bitrate' and 'resize' """
+
+        with self._video_lock, self.power.use() as camera:
+            if self._preroll_stream is None:
+                # the camera cannot be closed while it is recording
+                self.power.keep_warm("armed")
+                self._start_preroll(camera, bitrate, resize)
+
+    def _start_preroll(self, camera, bitrate, resize):
+        self.arm_settings = (bitrate, resize)
+        self._next_arm_settings = None
+        self._preroll_stream = PiCameraCircularIO(camera, size=self._preroll_buffer_size,
+                                                  splitter_port=VIDEO_PORT)
+        # since the encoder is always running, its motion vectors come for free
+        if constants.MOTION_CONFIRMATION != "off":
+            self._motion_detector = self._create_motion_detector(camera, resize)
+
+        # a keyframe every second so that the buffer can be split at (almost) any second
+        camera.start_recording(self._preroll_stream, format="h264", quality=23,
+                               intra_period=int(camera.framerate),
+                               inline_headers=True,
+                               motion_output=self._motion_detector,
+                               splitter_port=VIDEO_PORT,
+                               **_encoder_options(bitrate, resize))
+
+    def update_arm_settings(self, bitrate=None, resize=None):
+        """ The armed camera records with 'bitrate' and 'resize' from the end of the next
+            video on. Restarting the encoder right now would throw away the footage of the
+            circular buffer, which is what that video starts with """
+
+        if self.is_armed:
+            self._next_arm_settings = (bitrate, resize)
+
+    def disarm(self):
+        """ Stops the recording started by 'arm' and frees the circular buffer """
+
+        with self._video_lock:
+            if self._preroll_stream is not None:
+                self.power.camera.stop_recording(splitter_port=VIDEO_PORT)
+                self._preroll_stream.close()
+                self._preroll_stream = None
+                self._next_arm_settings = None
+                self._motion_detector = None
+                self.power.keep_warm("armed", False)
+
+    def _create_motion_detector(self, camera, size=None):
+        # numpy is only needed if movement is confirmed
+        import motion
+
+        return motion.MotionDetector(camera, constants.MOTION_VECTOR_THRESHOLD,
+                                     constants.MOTION_MIN_BLOCKS,
+                                     motion.parse_roi(constants.MOTION_ROI), size)
+
+    def confirm_movement(self, window):
+        """ Looks at the motion vectors of the h264 encoder to tell whether something has
+            really moved in front of the camera during the 'window' seconds around the call.
+            This way, false triggers of the pir sensor (heat, sunlight...) can be discarded """
+
+        trigger_time = time.monotonic()
+        detector = self._motion_detector
+        if detector is not None:
+            # the movement could have happened a bit before the pir sensor noticed it
+            return detector.wait_for_motion(trigger_time - window, window)
+
+        # a small video is recorded and nothing but its motion vectors is kept
+        resize = tuple(max(16, side // 4 // 16 * 16) for side in self.resolution)
+        with REGISTRY.acquire(self._motion_lock, "motion"), self.power.use() as camera:
+            detector = self._create_motion_detector(camera, resize)
+            camera.start_recording(os.devnull, format="h264", splitter_port=MOTION_PORT,
+                                   resize=resize, motion_output=detector)
+            try:
+                return detector.wait_for_motion(trigger_time, window)
+            finally:
+                camera.stop_recording(splitter_port=MOTION_PORT)
+
+    def capture(self, image_format, resize=None):
+        """ Takes a photo and returns a BytesIO with the image """
+
+        with REGISTRY.acquire(self._photo_lock, "photo"), self.power.use() as camera:
+            start_time = time.monotonic()
+            stream = BytesIO()
+            # jpeg images are taken from the video port, which avoids the mode switch of the
+            # still port. If something is being recorded, the still port would interrupt it
+            use_video_port = image_format == "jpeg" or self.is_armed or self.is_recording
+            camera.capture(stream, image_format, use_video_port=use_video_port,
+                           splitter_port=PHOTO_PORT, **_encoder_options(None, resize))
+            stream.seek(0)
+            elapsed_time = time.monotonic() - start_time
+            REGISTRY.histogram("camera_capture_seconds", "Time spent taking photos",
+                               kind="photo").observe(elapsed_time)
+            logger.debug(f"Photo taken in {elapsed_time:.3f}s")
+            return stream
+
+    def capture_burst(self, count, interval):
+        """ Takes 'count' jpeg photos separated by 'interval' seconds from the video port
+            and returns a list with their byte streams """
+
+        streams = []
+
+        def outputs():
+            start_time = time.monotonic()
+            for i in range(count):
+                # the camera keeps capturing frames while this generator is waiting
+                time.sleep(max(0, start_time + i * interval - time.monotonic()))
+                stream = BytesIO()
+                streams.append(stream)
+                yield stream
+
+        with REGISTRY.acquire(self._photo_lock, "photo"), self.power.use() as camera, \
+                REGISTRY.time("camera_capture_seconds", "Time spent taking photos", kind="burst"):
+            camera.capture_sequence(outputs(), "jpeg", use_video_port=True,
+                                    splitter_port=PHOTO_PORT)
+
+        for stream in streams:
+            stream.seek(0)
+        return streams
+
+    def record(self, output, video_duration, preroll=0, bitrate=None, resize=None):
+        """ Records a video and writes it into 'output' (any object with a 'write' method)
+            while it is being recorded. If the camera is armed, the video will also contain
+            the 'preroll' seconds previous to the call (but it will have the bitrate and the
+            resolution given to 'arm') """
+
+        with REGISTRY.acquire(self._video_lock, "video"), self.power.use() as camera:
+            self.is_recording = True
+            try:
+                if self._preroll_stream is not None:
+                    live_output = helper.DeferredOutput(output)
+                    # from the next keyframe on, the encoder writes into the output, so the
+                    # circular buffer ends up holding just what happened before
+                    camera.split_recording(live_output, splitter_port=VIDEO_PORT)
+                    if preroll > 0:
+                        # the clip must start with the headers or it could not be decoded
+                        self._preroll_stream.copy_to(output, seconds=preroll,
+                                                     first_frame=PiVideoFrameType.sps_header)
+                    live_output.release()
+
+                    camera.wait_recording(video_duration, splitter_port=VIDEO_PORT)
+                    next_arm_settings = self._next_arm_settings
+                    if next_arm_settings is None or next_arm_settings == self.arm_settings:
+                        camera.split_recording(self._preroll_stream, splitter_port=VIDEO_PORT)
+                    else:
+                        # the buffer only holds what this video started with, so nothing
+                        # is lost by restarting the encoder now
+                        logger.info(f"Camera armed again: {self.arm_settings} -> {next_arm_settings}")
+                        camera.stop_recording(splitter_port=VIDEO_PORT)
+                        self._preroll_stream.close()
+                        self._start_preroll(camera, *next_arm_settings)
+                else:
+                    camera.start_recording(output, format="h264", quality=23,
+                                           splitter_port=VIDEO_PORT,
+                                           **_encoder_options(bitrate, resize))
+                    camera.wait_recording(video_duration, splitter_port=VIDEO_PORT)
+                    camera.stop_recording(splitter_port=VIDEO_PORT)
+            finally:
+                self.is_recording = False
+
+    def record_preview(self, output, duration, resize, bitrate):
+        """ Records a small video in its own splitter port, so it can be recorded at the
+            same time as a normal video and sent long before it """
+
+        with REGISTRY.acquire(self._preview_lock, "preview"), self.power.use() as camera, \
+                REGISTRY.time("camera_capture_seconds", "Time spent taking photos", kind="preview"):
+            camera.start_recording(output, format="h264", splitter_port=PREVIEW_PORT,
+                                   **_encoder_options(bitrate, resize))
+            try:
+                camera.wait_recording(duration, splitter_port=PREVIEW_PORT)
+            finally:
+                camera.stop_recording(splitter_port=PREVIEW_PORT)
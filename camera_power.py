@@ -0,0 +1,184 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from picamera import PiCamera, PiCameraError
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class CameraPower:
+    """ Opens the camera when something needs it and closes it (which powers the sensor down)
+        once nothing has used it for 'idle_timeout' seconds, unless there is a reason to keep
+        it warm (see keep_warm). If 'idle_timeout' is 0, the camera is never closed.
+
+        Opening the camera takes a while and then the automatic exposure and white balance
+        need 'cold_settle' seconds to converge. That is why their values are kept when the
+        camera is closed and given to it the next time it is opened: starting from them, it
+        only needs 'warm_settle' seconds """
+
+    def __init__(self, framerate, resolution, rotation=0, idle_timeout=300, cold_settle=2.0,
+                 warm_settle=0.3):
+        self.framerate = framerate
+        self.resolution = tuple(resolution)
+        self.rotation = rotation
+        self.idle_timeout = idle_timeout
+        self.cold_settle = cold_settle
+        self.warm_settle = warm_settle
+
+        # None while the camera is closed
+        self.camera = None
+        # exposure and white balance the camera had when it was closed
+        self._gains = None
+        # seconds the last wake-up took
+        self.last_wake_seconds = None
+
+        # requests using the camera right now and reasons to keep it open (like the alarm)
+        self._users = 0
+        self._warm_reasons = set()
+        self._idle_timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.camera is not None
+
+    @contextmanager
+    def use(self):
+        """ Opens the camera if it is closed and gives it to the block. It is not closed
+            while the block is running """
+
+        with self._lock:
+            self._cancel_idle_timer()
+            camera = self._open()
+            self._users += 1
+
+        try:
+            yield camera
+        finally:
+            with self._lock:
+                self._users -= 1
+                self._schedule_idle_timer()
+
+    def wake(self):
+        """ Opens the camera now, so that whatever comes next does not have to wait for it """
+
+        with self.use():
+            pass
+
+    def keep_warm(self, reason, warm=True):
+        """ While there is any reason (like 'alarm'), the camera stays open. If it is closed
+            when the first reason is given, it is opened right away """
+
+        with self._lock:
+            if warm:
+                self._warm_reasons.add(reason)
+                self._cancel_idle_timer()
+                self._open()
+            else:
+                self._warm_reasons.discard(reason)
+                self._schedule_idle_timer()
+
+    def close(self):
+        with self._lock:
+            self._cancel_idle_timer()
+            self._close()
+
+    def _open(self):
+        """ Must be called with the lock held """
+
+        if self.camera is not None:
+            return self.camera
+
+        start_time = time.monotonic()
+        camera = PiCamera(framerate=self.framerate, resolution=self.resolution)
+        camera.rotation = self.rotation
+
+        gains = self._gains
+        if gains is None:
+            time.sleep(self.cold_settle)
+        else:
+            self._apply_gains(camera, gains)
+            time.sleep(self.warm_settle)
+            # the automatic algorithms go on from the values they have been given
+            camera.shutter_speed = 0
+            camera.awb_mode = "auto"
+
+        self.camera = camera
+        self.last_wake_seconds = time.monotonic() - start_time
+        REGISTRY.histogram("camera_wake_seconds", "Time the camera takes to be ready after being closed",
+                           start="cold" if gains is None else "warm").observe(self.last_wake_seconds)
+        REGISTRY.gauge("camera_open", "Whether the camera is powered").set(1)
+        logger.info(f"Camera opened in {self.last_wake_seconds:.2f}s ({'cold' if gains is None else 'warm'})")
+        return camera
+
+    @staticmethod
+    def _apply_gains(camera, gains):
+        camera.shutter_speed = gains["exposure_speed"]
+        camera.awb_mode = "off"
+        camera.awb_gains = gains["awb_gains"]
+        try:
+            # only picamera 1.13 (and a recent firmware) can set the gains of the sensor
+            camera.analog_gain = gains["analog_gain"]
+            camera.digital_gain = gains["digital_gain"]
+        except (AttributeError, PiCameraError) as exc:
+            logger.debug(f"The gains of the sensor could not be restored: {exc!r}")
+
+    def _close(self):
+        """ Must be called with the lock held """
+
+        camera = self.camera
+        if camera is None:
+            return
+
+        self._gains = {"exposure_speed": camera.exposure_speed, "awb_gains": camera.awb_gains,
+                       "analog_gain": camera.analog_gain, "digital_gain": camera.digital_gain}
+        camera.close()
+        self.camera = None
+        REGISTRY.gauge("camera_open", "Whether the camera is powered").set(0)
+        logger.info("Camera closed")
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _schedule_idle_timer(self):
+        """ Must be called with the lock held """
+
+        if self.camera is None or self._users or self._warm_reasons or self.idle_timeout <= 0:
+            return
+
+        self._cancel_idle_timer()
+        self._idle_timer = threading.Timer(self.idle_timeout, lambda: self._on_idle_timer(timer))
+        timer = self._idle_timer
+        timer.daemon = True
+        timer.start()
+
+    def _on_idle_timer(self, timer):
+        with self._lock:
+            # a cancelled timer could have fired anyway
+            if self._idle_timer is not timer:
+                return
+            self._idle_timer = None
+            if not self._users and not self._warm_reasons:
+                self._close()
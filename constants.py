@@ -20,15 +20,167 @@ from decouple import config
 TOKEN = config("TOKEN")
 GROUP_CHAT_ID = config("GROUP_CHAT_ID", cast=int)
 
+# permissions of the chats:
+# - control: can use the commands and the menu and receives every message
+# - alerts: only receives alerts, photos and videos
+PERMISSION_CONTROL = "control"
+PERMISSION_ALERTS = "alerts"
+# chats allowed to talk to the bot, like '-1001234:control,5678:alerts'
+AUTHORIZED_CHATS = config("AUTHORIZED_CHATS", default=f"{GROUP_CHAT_ID}:{PERMISSION_CONTROL}")
+# empty means the official one
+BOT_API_URL = config("BOT_API_URL", default="")
+
+# how updates are received: 'polling' or 'webhook'. If the webhook server cannot be started
+# (certificate, port) or the webhook cannot be registered, polling is used instead
+UPDATES_MODE = config("UPDATES_MODE", default="polling")
+# public url (without the secret path) Telegram sends the updates to
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+# address and port the local server listens to (Telegram only supports 443, 80, 88 and 8443)
+WEBHOOK_LISTEN = config("WEBHOOK_LISTEN", default="0.0.0.0")
+WEBHOOK_PORT = config("WEBHOOK_PORT", default=8443, cast=int)
+# secret path of the webhook url. If empty, a random one is generated on every start
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="")
+# certificate and private key of the local https server. Leave them empty if the server
+# is behind a proxy which already serves https
+WEBHOOK_CERT = config("WEBHOOK_CERT", default="")
+WEBHOOK_KEY = config("WEBHOOK_KEY", default="")
+WEBHOOK_SELF_SIGNED = config("WEBHOOK_SELF_SIGNED", default=False, cast=bool)
+
+# names of the zones separated by commas (see zones.read_zones_config). If empty, there
+# is only one zone whose pins are PIR_SENSOR_PIN, RELAY_A_PIN and RELAY_B_PIN
+ZONES = config("ZONES", default="")
+
+# zones whose '{ZONE}_NODE' is not empty are connected to another Pi (a node, see node.py)
+# which connects to HUB_LISTEN:HUB_PORT of the Pi running the bot (the hub, see hub.py).
+# Both must have the same NODE_SECRET
+HUB_LISTEN = config("HUB_LISTEN", default="0.0.0.0")
+HUB_PORT = config("HUB_PORT", default=7070, cast=int)
+NODE_SECRET = config("NODE_SECRET", default="")
+# only used by the nodes: their name and the 'host:port' of the hub
+NODE_NAME = config("NODE_NAME", default="")
+HUB_ADDRESS = config("HUB_ADDRESS", default="")
+# seconds a node has to answer a request (videos have their duration on top of it)
+RPC_TIMEOUT = config("RPC_TIMEOUT", default=30.0, cast=float)
+
 CAMERA_FRAMERATE = config("CAMERA_FRAMERATE", default=30, cast=int)
+# the camera is closed (and the sensor powered down) after this number of seconds without
+# being used, unless the alarm is on. 0 keeps it always open
+CAMERA_IDLE_TIMEOUT = config("CAMERA_IDLE_TIMEOUT", default=300, cast=int)
+# seconds the automatic exposure and white balance need after opening the camera. The first
+# time, they start from scratch. Later on, they start from the values the camera had when
+# it was closed
+CAMERA_COLD_SETTLE = config("CAMERA_COLD_SETTLE", default=2.0, cast=float)
+CAMERA_WARM_SETTLE = config("CAMERA_WARM_SETTLE", default=0.3, cast=float)
+# seconds the bot waits for the camera and the zones to be set up before exiting anyway
+HARDWARE_EXIT_TIMEOUT = config("HARDWARE_EXIT_TIMEOUT", default=15.0, cast=float)
 DELAY_RELAYS = config("DELAY_RELAYS", default=0.5, cast=float)
 LAMP_ON_TIME = config("LAMP_ON_TIM", default=10, cast=int)
 
+# seconds previous to a pir trigger included in the video when the alarm is on
+PREROLL_SECONDS = config("PREROLL_SECONDS", default=3, cast=int)
+# hard limit (in bytes) of the memory used by the circular buffer of the camera
+PREROLL_BUFFER_SIZE = config("PREROLL_BUFFER_SIZE", default=32 * 1024 * 1024, cast=int)
+
+# after an update, updates are polled as fast as possible during this number of seconds
+POLLING_ACTIVE_WINDOW = config("POLLING_ACTIVE_WINDOW", default=120, cast=int)
+# timeout of the polls and seconds between them when nothing has happened lately. An update
+# can wait up to POLLING_IDLE_GAP seconds, but far fewer requests are made
+POLLING_IDLE_TIMEOUT = config("POLLING_IDLE_TIMEOUT", default=50, cast=int)
+POLLING_IDLE_GAP = config("POLLING_IDLE_GAP", default=5, cast=int)
+# periods of time when the users are not expected to send anything, like '23:00-07:00,13:30-15:00'
+QUIET_HOURS = config("QUIET_HOURS", default="")
+# timeout of the polls and seconds between them during the quiet hours
+QUIET_POLLING_TIMEOUT = config("QUIET_POLLING_TIMEOUT", default=50, cast=int)
+QUIET_POLLING_GAP = config("QUIET_POLLING_GAP", default=60, cast=int)
+
+# requests per second to the Bot API allowed per chat and maximum burst of requests
+OUTBOX_RATE = config("OUTBOX_RATE", default=1.0, cast=float)
+OUTBOX_BURST = config("OUTBOX_BURST", default=5, cast=int)
+# number of chats which can be sent requests at the same time
+OUTBOX_WORKERS = config("OUTBOX_WORKERS", default=4, cast=int)
+
+# media which could not be sent is kept in this directory until it can be sent. It never
+# holds more than SPOOL_MAX_BYTES bytes nor files older than SPOOL_MAX_AGE seconds
+SPOOL_DIR = config("SPOOL_DIR", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+SPOOL_MAX_BYTES = config("SPOOL_MAX_BYTES", default=200 * 1024 * 1024, cast=int)
+SPOOL_MAX_AGE = config("SPOOL_MAX_AGE", default=2 * 24 * 60 * 60, cast=int)
+# seconds to wait after the first failed attempt. The delay doubles after each failure
+SPOOL_RETRY_DELAY = config("SPOOL_RETRY_DELAY", default=5.0, cast=float)
+SPOOL_MAX_RETRY_DELAY = config("SPOOL_MAX_RETRY_DELAY", default=600.0, cast=float)
+
+# every pir trigger, command and change of mode is stored in this SQLite database
+HISTORY_DB = config("HISTORY_DB", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.db"))
+# a copy of the videos is kept in this directory. It never holds more than ARCHIVE_MAX_BYTES
+# bytes nor clips older than ARCHIVE_MAX_AGE seconds. An empty directory disables the archive
+ARCHIVE_DIR = config("ARCHIVE_DIR", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+ARCHIVE_MAX_BYTES = config("ARCHIVE_MAX_BYTES", default=1024 * 1024 * 1024, cast=int)
+ARCHIVE_MAX_AGE = config("ARCHIVE_MAX_AGE", default=7 * 24 * 60 * 60, cast=int)
+# maximum number of events listed by /historial
+HISTORY_MAX_EVENTS = config("HISTORY_MAX_EVENTS", default=30, cast=int)
+
+# events of the sensors which can wait to be handled, seconds within which the edges of
+# the same sensor are merged into one event and threads which run the handlers
+EVENT_QUEUE_SIZE = config("EVENT_QUEUE_SIZE", default=16, cast=int)
+EVENT_MERGE_WINDOW = config("EVENT_MERGE_WINDOW", default=1.0, cast=float)
+EVENT_WORKERS = config("EVENT_WORKERS", default=2, cast=int)
+
+# if it is not 0, the metrics are served in http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_LISTEN = config("METRICS_LISTEN", default="127.0.0.1")
+METRICS_PORT = config("METRICS_PORT", default=0, cast=int)
+
+# number of recently sent photos and videos which can be sent again without uploading them
+FILE_ID_CACHE_SIZE = config("FILE_ID_CACHE_SIZE", default=32, cast=int)
+
+# refreshes of the menu requested within this number of seconds are coalesced
+MENU_REFRESH_DELAY = config("MENU_REFRESH_DELAY", default=0.5, cast=float)
+
+# either 'jpeg' (fast, taken from the video port) or 'png'
+PHOTO_FORMAT = config("PHOTO_FORMAT", default="jpeg")
+# seconds between the photos of a burst
+BURST_INTERVAL = config("BURST_INTERVAL", default=0.5, cast=float)
+
+# whether the motion vectors of the camera must confirm a pir trigger before recording:
+# 'off', 'log' (the result is only logged) or 'drop' (unconfirmed triggers are ignored)
+MOTION_CONFIRMATION = config("MOTION_CONFIRMATION", default="off")
+# seconds around the trigger where movement is looked for
+MOTION_CONFIRM_WINDOW = config("MOTION_CONFIRM_WINDOW", default=2.0, cast=float)
+# minimum length of a motion vector and number of macroblocks that must exceed it
+MOTION_VECTOR_THRESHOLD = config("MOTION_VECTOR_THRESHOLD", default=60, cast=int)
+MOTION_MIN_BLOCKS = config("MOTION_MIN_BLOCKS", default=10, cast=int)
+# left,top,right,bottom of the region of interest as fractions of the image
+MOTION_ROI = config("MOTION_ROI", default="0,0,1,1")
+
+# either 'builtin' (see mp4.py, which does not need ffmpeg to be installed) or 'ffmpeg'. If
+# ffmpeg is installed, it also muxes the videos the builtin muxer cannot handle
+MUXER = config("MUXER", default="builtin")
+
+# the bitrate (and, if it is too low, the resolution) of the videos is chosen so that their
+# upload takes about VIDEO_TARGET_UPLOAD_TIME seconds with the throughput of the last
+# UPLINK_ESTIMATE_WINDOW uploads. 0 records every video with the best quality
+VIDEO_TARGET_UPLOAD_TIME = config("VIDEO_TARGET_UPLOAD_TIME", default=10.0, cast=float)
+UPLINK_ESTIMATE_WINDOW = config("UPLINK_ESTIMATE_WINDOW", default=5, cast=int)
+# what is sent right after the alert of a pir trigger, long before the video: 'animation'
+# (PREVIEW_DURATION seconds recorded in parallel with the video), 'photo' or 'off'. Both
+# are PREVIEW_SCALE times smaller than the camera resolution
+PREVIEW_MODE = config("PREVIEW_MODE", default="animation")
+PREVIEW_DURATION = config("PREVIEW_DURATION", default=1.0, cast=float)
+PREVIEW_SCALE = config("PREVIEW_SCALE", default=4, cast=int)
+PREVIEW_BITRATE = config("PREVIEW_BITRATE", default=300000, cast=int)
+
+# bits per second. The maximum is the default of picamera
+VIDEO_MIN_BITRATE = config("VIDEO_MIN_BITRATE", default=250000, cast=int)
+VIDEO_MAX_BITRATE = config("VIDEO_MAX_BITRATE", default=17000000, cast=int)
+# below this, the resolution is halved rather than making every pixel look worse
+VIDEO_MIN_BITS_PER_PIXEL = config("VIDEO_MIN_BITS_PER_PIXEL", default=0.05, cast=float)
+
 # measured in seconds
 DEFAULT_VIDEO_DURATION = 8
 MAXIMUM_VIDEO_DURATION = 30
 MINIMUM_DELAY_PIR = 45
 
+# Telegram does not allow more photos in an album
+MAXIMUM_BURST_PHOTOS = 10
+
 # reasons for quitting the program
 REASON_SHUTDOWN = 1
 REASON_REBOOT = 2
@@ -0,0 +1,162 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceEvent:
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+        # monotonic time of the first edge and number of edges merged into this event
+        self.time = time.monotonic()
+        self.count = 1
+
+    @property
+    def key(self):
+        return self.device, self.name
+
+
+class EventBus:
+    """ The callbacks of gpiozero are run in the thread which watches the pins, so a slow
+        handler (one which records a video, for instance) would delay or lose the next edges.
+        The callbacks only publish an event here and the handlers are run by 'workers' threads:
+
+        - the handlers of the same event never run at the same time. Events are handled
+          in order.
+        - an event which arrives within 'merge_window' seconds of another one of the same kind
+          that has not been handled yet is merged into it.
+        - no more than 'max_pending' events wait to be handled. The ones beyond are dropped
+
+        Immediate handlers are the exception: they are run by 'publish' itself, so they are
+        not delayed by a slow handler of the same event which is still running """
+
+    def __init__(self, max_pending=16, merge_window=1.0, workers=2):
+        self.max_pending = max_pending
+        self.merge_window = merge_window
+
+        self._handlers = {}
+        self._immediate_handlers = {}
+        self._pending = deque()
+        self._busy_keys = set()
+        self._condition = threading.Condition()
+        self._finished = False
+
+        self.published = 0
+        self.merged = 0
+        self.dropped = 0
+
+        self._workers = [threading.Thread(target=self._work, name=f"events-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def subscribe(self, device, name, handler, immediate=False):
+        """ 'handler' will be called (without arguments) every time the event is published.
+            If 'immediate' is true, it is called from 'publish', so it must return at once
+            (setting a threading.Event, for instance) """
+
+        handlers = self._immediate_handlers if immediate else self._handlers
+        handlers.setdefault((device, name), []).append(handler)
+
+    def publish(self, device, name):
+        """ Queues an event. It never blocks, so it can be called from the callbacks of gpiozero """
+
+        event = DeviceEvent(device, name)
+        try:
+            for handler in self._immediate_handlers.get(event.key, ()):
+                handler()
+        except Exception:
+            logger.exception(f"Error handling '{device}.{name}'")
+        if event.key not in self._handlers:
+            return
+
+        with self._condition:
+            self.published += 1
+            REGISTRY.counter("device_events_total", "Events published by the devices",
+                             event=f"{device}.{name}").inc()
+
+            for pending_event in reversed(self._pending):
+                if pending_event.key == event.key:
+                    if event.time - pending_event.time <= self.merge_window:
+                        pending_event.count += 1
+                        self.merged += 1
+                        REGISTRY.counter("device_events_merged_total", "Events merged into a pending one").inc()
+                        return
+                    break
+
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                REGISTRY.counter("device_events_dropped_total", "Events dropped because the queue was full").inc()
+                logger.warning(f"Too many pending events. '{device}.{name}' dropped")
+                return
+
+            self._pending.append(event)
+            self._condition.notify()
+
+    def _next_event(self):
+        while True:
+            if self._finished:
+                return None
+
+            for event in self._pending:
+                if event.key not in self._busy_keys:
+                    self._pending.remove(event)
+                    self._busy_keys.add(event.key)
+                    return event
+
+            self._condition.wait()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                event = self._next_event()
+                if event is None:
+                    return
+
+            REGISTRY.histogram("device_event_delay_seconds", "Time from an edge to its handler",
+                               event=f"{event.device}.{event.name}").observe(time.monotonic() - event.time)
+            try:
+                for handler in self._handlers.get(event.key, ()):
+                    handler()
+            except Exception:
+                logger.exception(f"Error handling '{event.device}.{event.name}'")
+            finally:
+                with self._condition:
+                    self._busy_keys.discard(event.key)
+                    self._condition.notify_all()
+
+    def stop(self):
+        """ Discards the events which have not been handled yet and waits for the handlers
+            which are running """
+
+        with self._condition:
+            self._finished = True
+            self._pending.clear()
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+        logger.info(f"{self.published} device events published ({self.merged} merged, "
+                    f"{self.dropped} dropped)")
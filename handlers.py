@@ -15,9 +15,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import logging
+import threading
 
 import time
 import constants
+import history
+import metrics
+import outbox
+
+logger = logging.getLogger(__name__)
 
 PHOTO = "foto"
 LAMP = "lamp"
@@ -26,6 +33,10 @@ VIDEO = "video"
 ALARM = "alarma"
 REBOOT = "reiniciar"
 SHUTDOWN = "apagar"
+RESEND = "reenviar"
+HISTORY = "historial"
+CLIP = "clip"
+STATS = "stats"
 MOVEMENT = "movimiento"
 
 # NOTE: is this the best solution?
@@ -53,40 +64,174 @@ def _exiting_commands(bro, sender, reason):
 
 def lamp_command(bro, update, *com_args):
     sender = update.effective_user.first_name
+    # '/lamp garaje' switches the lamp of that zone
+    zone, _ = bro.zone_from_args(com_args)
 
-    if bro.is_normal_mode:
-        bro.switch_on_from_button.set()
-        bro.send_message(f"{sender} ha encendido la lámpara")
-        bro.change_to_manual_mode()
+    if zone.is_normal_mode:
+        zone.switch_on_from_button.set()
+        bro.send_message(f"{sender} ha encendido la lámpara{bro.zone_label(zone)}")
+        switched = zone.change_to_manual_mode()
     else:
-        bro.switch_on_from_button.clear()
-        bro.send_message(f"{sender} ha apagado la lámpara")
-        bro.change_to_normal_mode()
+        zone.switch_on_from_button.clear()
+        bro.send_message(f"{sender} ha apagado la lámpara{bro.zone_label(zone)}")
+        switched = zone.change_to_normal_mode()
+
+    # the menu sent when the command ends could be too early to show the new state
+    switched.add_done_callback(lambda future: bro.send_menu())
 
 def photo_command(bro, update, *comm_args):
     sender = update.effective_user.first_name
-    bro.send_message(f"{sender} ha hecho una foto")
 
-    if bro.camera_lock.locked():
-        bro.send_message("La cámara no se encuentra disponible en estos momentos")
+    # '/foto 5 0.5' takes a burst of 5 photos, one every half a second
+    count = 1
+    interval = constants.BURST_INTERVAL
+    if comm_args:
+        try:
+            count = int(comm_args[0])
+            if len(comm_args) > 1:
+                interval = float(comm_args[1])
+        except ValueError:
+            bro.send_message("Por favor, introduce un número")
+            return
+
+    if not 1 <= count <= constants.MAXIMUM_BURST_PHOTOS or interval < 0:
+        bro.send_message(f"Solo puedes hacer entre 1 y {constants.MAXIMUM_BURST_PHOTOS} fotos seguidas")
+        return
+
+    if count == 1:
+        bro.send_message(f"{sender} ha hecho una foto")
+    else:
+        bro.send_message(f"{sender} ha hecho {count} fotos")
+
+    # NOTE: the camera is never busy. If a video is being recorded, the photos are
+    # taken from it
+    camera_zone = bro.camera_zone
+    if camera_zone:
+        # the lamp must be on before the photo is taken
+        camera_zone.change_to_manual_mode().result()
+
+    if count == 1:
+        # if somebody else has just asked for a photo, both get the same one
+        bro.take_and_send_photo()
+    else:
+        image_streams = bro.get_burst_streams(count, interval)
+        bro.send_media_group(image_streams).result()
+        for image_stream in image_streams:
+            image_stream.close()
+
+    if camera_zone:
+        camera_zone.change_to_normal_mode()
+
+def resend_command(bro, update, *comm_args):
+    # the last photo or video is sent again without uploading it
+    if bro.last_media_key is None or bro.resend_media(bro.last_media_key) is None:
+        bro.send_message("No hay ninguna foto o vídeo reciente que reenviar")
+
+def _parse_history_range(comm_args):
+    """ '/historial' shows the last 24 hours, '/historial 6' the last 6 hours,
+        '/historial 01/09/2021' that day and '/historial 01/09/2021 03/09/2021' those days.
+        Returns the range as values of time.time() """
+
+    now = time.time()
+    if not comm_args:
+        return now - 24 * 60 * 60, now
+    if len(comm_args) == 1 and comm_args[0].isdigit():
+        return now - int(comm_args[0]) * 60 * 60, now
+
+    start_day, end_day = comm_args[0], comm_args[-1]
+    start = time.mktime(time.strptime(start_day, "%d/%m/%Y"))
+    # the last day is included
+    end = time.mktime(time.strptime(end_day, "%d/%m/%Y")) + 24 * 60 * 60
+    return start, end
+
+def _describe_event(event):
+    event_id, when, kind, detail, clip = event
+
+    if kind == history.EVENT_PIR:
+        description = "Movimiento detectado" + (f" ({detail})" if detail else "")
+    elif kind == history.EVENT_COMMAND:
+        description = f"Comando {detail}"
+    elif kind == history.EVENT_MODE:
+        description = f"Modo {detail}"
+    elif kind == history.EVENT_VIDEO:
+        description = f"Vídeo de {detail}" + (f" (/{CLIP} {event_id})" if clip else "")
+    else:
+        description = f"{kind} {detail}"
+
+    return f"{time.strftime('%d/%m %H:%M:%S', time.localtime(when))} {description}"
+
+def history_command(bro, update, *comm_args):
+    try:
+        start, end = _parse_history_range(comm_args)
+    except ValueError:
+        bro.send_message("Por favor, introduce un número de horas o fechas con el formato dd/mm/aaaa")
         return
-    
-    bro.change_to_manual_mode()
 
-    with bro.get_image_stream() as image_stream:
-        bro.send_photo(image_stream)
+    # the commands asking for the history itself are not interesting
+    events = [event for event in bro.history.query(start, end, limit=constants.HISTORY_MAX_EVENTS + 1)
+              if not (event[2] == history.EVENT_COMMAND and event[3].startswith(f"/{HISTORY}"))]
 
-    bro.change_to_normal_mode()
+    if not events:
+        bro.send_message("No ha pasado nada en ese periodo de tiempo")
+        return
+
+    events = events[-constants.HISTORY_MAX_EVENTS:]
+    bro.send_message("\n".join(_describe_event(event) for event in events))
+
+def clip_command(bro, update, *comm_args):
+    # '/clip 42' sends the video of the event 42 of the history
+    try:
+        event_id = int(comm_args[0])
+    except (IndexError, ValueError):
+        bro.send_message("Por favor, introduce el número del vídeo")
+        return
+
+    if not bro.send_archived_clip(event_id):
+        bro.send_message("Ese vídeo ya no está guardado")
+
+def stats_command(bro, update, *comm_args):
+    estimate = bro.uplink.estimate
+    if estimate is None:
+        uplink = "Ancho de banda de subida: sin estimar todavía"
+    elif bro.camera_arbiter is None:
+        # the camera is still being opened (see FourthBrother.init_hardware)
+        uplink = f"Ancho de banda de subida: {estimate * 8 / 1000000:.2f} Mbit/s"
+    else:
+        bitrate, resize = bro.video_settings(constants.DEFAULT_VIDEO_DURATION)
+        resolution = "x".join(str(side) for side in resize) if resize else "completa"
+        uplink = (f"Ancho de banda de subida: {estimate * 8 / 1000000:.2f} Mbit/s "
+                  f"(vídeos a {bitrate / 1000000:.2f} Mbit/s, resolución {resolution})")
+
+    lines = [uplink]
+    camera_power = bro.camera_power
+    if camera_power is not None and camera_power.last_wake_seconds is not None:
+        state = "encendida" if camera_power.is_open else "apagada"
+        lines.append(f"Cámara: {state} (el último arranque tardó {camera_power.last_wake_seconds:.2f}s)")
+
+    summary = "\n".join(lines) + "\n" + metrics.REGISTRY.summary()
+    # telegram does not accept longer messages
+    bro.send_message(summary[:4096])
 
 def alarm_command(bro, update, *comm_args):
     sender = update.effective_user.first_name
-
-    if bro.pir_activated:
-        bro.send_message(f"{sender} ha desactivado la alarma")
-        bro.pir_activated = False
+    zone, _ = bro.zone_from_args(comm_args)
+
+    if zone.pir_activated:
+        bro.send_message(f"{sender} ha desactivado la alarma{bro.zone_label(zone)}")
+        zone.pir_activated = False
+        if zone.has_camera:
+            bro.disarm_camera()
+            bro.keep_camera_warm(False)
     else:
-        bro.send_message(f"{sender} ha activado la alarma")
-        bro.pir_activated = True
+        bro.send_message(f"{sender} ha activado la alarma{bro.zone_label(zone)}")
+        zone.pir_activated = True
+        if zone.has_camera:
+            # a trigger must not wait for the camera to wake up
+            bro.keep_camera_warm(True)
+            # the camera is always recording while the alarm is on, so that the video
+            # also shows what happened just before the pir sensor was triggered
+            if constants.PREROLL_SECONDS > 0:
+                bro.arm_camera()
 
 def video_command(bro, update, *comm_args):
     sender = update.effective_user.first_name
@@ -104,17 +249,18 @@ def video_command(bro, update, *comm_args):
     if duration > constants.MAXIMUM_VIDEO_DURATION:
         bro.send_message(f"No puedes hacer grabaciones de más de {MAXIMUM_VIDEO_DURATION} segundos")
         return
-    
-    # we don't want threads to be waiting for the camera to be ready because,
-    # during a period of time , we could run out of them if commands of this kind are received
-    # very rapidly and it would be impossible to handle in time other commands
-    if bro.camera_lock.locked():
-        bro.send_message("La cámara no se encuentra disponible en estos momentos")
-        return
 
-    bro.change_to_manual_mode()
-    bro.record_and_send_video(duration)
-    bro.change_to_normal_mode()
+    # if a video is already being recorded, this request gets that video instead of
+    # waiting for the camera
+    camera_zone = bro.camera_zone
+    if camera_zone:
+        camera_zone.change_to_manual_mode().result()
+    try:
+        bro.record_and_send_video(duration)
+    finally:
+        # the lamp must not be left in manual mode if the video fails
+        if camera_zone:
+            camera_zone.change_to_normal_mode()
 
 # in order for this to work, the bot has to be executed as a root user
 def reboot_command(bro, update, *comm_args):
@@ -127,34 +273,75 @@ def shutdown_command(bro, update, *comm_args):
 
 def movement_command(bro, update, *comm_args):
     sender = update.effective_user.first_name
+    zone, _ = bro.zone_from_args(comm_args)
 
-    if bro.movement_activated:
-        bro.send_message(f"{sender} ha desactivado el movimiento")
-        bro.movement_activated = False
+    if zone.movement_activated:
+        bro.send_message(f"{sender} ha desactivado el movimiento{bro.zone_label(zone)}")
+        zone.movement_activated = False
     else:
-        bro.send_message(f"{sender} ha activado el movimiento")
-        bro.movement_activated = True
-
-def movement_handler(bro):
-    if bro.movement_activated and not bro.switch_on_from_button.is_set():
-        bro.movement_event.set()
-
-    if not bro.pir_activated or time.time() - bro.last_time_pir < constants.MINIMUM_DELAY_PIR:
+        bro.send_message(f"{sender} ha activado el movimiento{bro.zone_label(zone)}")
+        zone.movement_activated = True
+
+def movement_lamp_handler(bro, zone):
+    # it is run right away (see EventBus), so the lamp does not wait for the video of
+    # the previous trigger
+    if zone.movement_activated and not zone.switch_on_from_button.is_set():
+        zone.movement_event.set()
+
+def _confirm_movement(bro, zone):
+    confirmed = bro.confirm_movement()
+    logger.info(f"PIR trigger {'confirmed' if confirmed else 'not confirmed'} by the camera")
+    bro.history.record(history.EVENT_PIR, f"{zone.name}, {'confirmado' if confirmed else 'no confirmado'}")
+    return confirmed
+
+def _log_movement_confirmation(bro, zone):
+    try:
+        _confirm_movement(bro, zone)
+    except Exception:
+        logger.exception("The camera could not confirm the pir trigger")
+
+def movement_handler(bro, zone):
+    if not zone.pir_activated or time.time() - zone.last_time_pir < constants.MINIMUM_DELAY_PIR:
         return
 
-    bro.send_message("¡¡ATENCIÓN: EL SENSOR PIR HA DETECTADO MOVIMIENTO!!")
-    bro.last_time_pir = time.time()
-
-    # if the camera is being used, wait until it is freed before sending message informing about the sitation
-    # I do it in this way because, if the camera is being used, it is very likely it catches the source which
-    # triggered the pir sensor
-    # NOTE: the aquire() method from Lock() is the one which make the thread to sleep
-    if bro.camera_lock.locked():
-        bro.send_message("La cámara está siendo usada. Esperando a que termine")
+    metrics.REGISTRY.counter("pir_triggers_total", "Triggers of the pir sensor while the alarm is on",
+                             zone=zone.name).inc()
 
-    bro.change_to_manual_mode()
+    # a false trigger would cost a whole video, so the camera is asked first
+    confirmation = constants.MOTION_CONFIRMATION if zone.has_camera else "off"
+    if confirmation == "drop":
+        # the lamp is switched on first or, at night, the camera would look at a dark scene
+        zone.change_to_manual_mode().result()
 
-    bro.record_and_send_video(constants.DEFAULT_VIDEO_DURATION)
+    try:
+        if confirmation == "drop" and not _confirm_movement(bro, zone):
+            return
+        if confirmation == "off":
+            bro.history.record(history.EVENT_PIR, zone.name)
+
+        bro.send_message(f"¡¡ATENCIÓN: EL SENSOR PIR HA DETECTADO MOVIMIENTO{bro.zone_label(zone).upper()}!!",
+                         priority=outbox.PRIORITY_ALERT)
+        # the users will probably want to do something after the alert
+        bro.notify_activity()
+        zone.last_time_pir = time.time()
+
+        # if a video is already being recorded, it is very likely it catches the source which
+        # triggered the pir sensor, so that video is the one sent
+        if zone.has_camera:
+            alert_time = time.monotonic()
+            if confirmation != "drop":
+                zone.change_to_manual_mode().result()
+            if confirmation == "log":
+                # the result is only logged, so neither the alert nor the video wait for it
+                threading.Thread(target=_log_movement_confirmation, args=(bro, zone),
+                                 name="motion-confirmation", daemon=True).start()
+            # it is recorded at the same time as the video, but it arrives in about a second. It
+            # is not started until the lamp is on or it would be taken in the dark
+            bro.send_preview(alert_time)
+            bro.record_and_send_video(constants.DEFAULT_VIDEO_DURATION, preroll=constants.PREROLL_SECONDS)
+    finally:
+        # whatever happens, the lamp must not be left in manual mode
+        if zone.has_camera:
+            zone.change_to_normal_mode()
 
-    bro.change_to_normal_mode()
     bro.send_menu()
@@ -14,36 +14,263 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import time
+import logging
+import random
+import threading
+import shutil
 import subprocess
-import os
+from concurrent.futures import Future
+from io import BytesIO
 
-FFMPEG_COMMAND = "ffmpeg -framerate {} -i pipe: -c:v copy {}"
+import constants
+import mp4
 
-def convert_to_mp4(stream, framerate):
-    """ Puts h264 video stream in a mp4 container, which is the one Telegram supports
-    Framerate is necessary because that information is not held by a video codec 
-    stream must be a byte object"""
+# ffmpeg reads the h264 stream from stdin and writes a fragmented mp4 to stdout. A
+# fragmented mp4 does not need to seek back to write its header, so no file is needed
+FFMPEG_COMMAND = "ffmpeg -framerate {} -i pipe: -c:v copy -f mp4 -movflags frag_keyframe+empty_moov pipe:"
+CHUNK_SIZE = 64 * 1024
 
-    # I use unix time as the name of the file to avoid having two mp4 with the same name
-    # This could happen because once during processing, another video can be recorded 
-    timestamp = int(time.time())
-    file_name = f"{timestamp}.mp4"
-    command = FFMPEG_COMMAND.format(framerate, file_name).split()
+logger = logging.getLogger(__name__)
 
-    subprocess.run(command, input=stream, stderr=subprocess.DEVNULL)
+class FFmpegMuxer:
+    """ File-like object which puts the h264 chunks written into it in a mp4 container while
+        they are still arriving, so the video can be muxed during the recording. The output
+        of ffmpeg is collected by a background thread """
 
-    mp4_container_stream = None
+    def __init__(self, framerate):
+        self.command = FFMPEG_COMMAND.format(framerate).split()
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._mp4_stream = BytesIO()
 
-    try:
-        mp4_container_stream = open(file_name, "rb")
-        return mp4_container_stream
-    except IOError as exc:
-        if mp4_container_stream:
-            mp4_container_stream.close()
-        raise exc
-    finally:
-       if os.path.isfile(file_name):
-           os.remove(file_name)
+        # stdout is read from another thread. Otherwise, ffmpeg could get blocked writing into
+        # a full stdout pipe while we are blocked writing into its stdin
+        self._reader = threading.Thread(target=shutil.copyfileobj,
+                                        args=(self._process.stdout, self._mp4_stream, CHUNK_SIZE))
+        self._reader.start()
+        self._broken_pipe = False
+
+    def write(self, data):
+        if not self._broken_pipe:
+            try:
+                self._process.stdin.write(data)
+            except BrokenPipeError:
+                # ffmpeg has died. Its return code will tell what happened
+                self._broken_pipe = True
+        return len(data)
+
+    def flush(self):
+        # NOTE: picamera calls this method when the recording stops
+        pass
+
+    def finish(self):
+        """ Tells ffmpeg there is no more video and returns a BytesIO with the mp4 """
+
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self._reader.join()
+        self._process.stdout.close()
+
+        if self._process.wait() != 0:
+            self._mp4_stream.close()
+            raise subprocess.CalledProcessError(self._process.returncode, self.command)
+
+        self._mp4_stream.seek(0)
+        return self._mp4_stream
+
+    def abort(self):
+        """ Kills ffmpeg and discards the video """
+
+        self._process.kill()
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        self._process.stdout.close()
+        self._process.wait()
+        self._mp4_stream.close()
+
+class DeferredOutput:
+    """ Holds the chunks written into it until 'release' is called. From then on, they are
+        passed straight to 'output'. This way, something else can be written into 'output'
+        before the chunks which are already arriving """
+
+    def __init__(self, output):
+        self._output = output
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            if self._pending is not None:
+                # the buffer of the writer could be reused later
+                self._pending.append(bytes(data))
+                return len(data)
+
+        return self._output.write(data)
+
+    def flush(self):
+        pass
+
+    def release(self):
+        with self._lock:
+            for chunk in self._pending:
+                self._output.write(chunk)
+            self._pending = None
+
+class InFlight:
+    """ Coalesces calls which overlap in time: while a call with some key is running, the
+        calls made with the same key do not run the function again but wait for the first
+        one to finish and get its result """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def is_running(self, key):
+        return key in self._futures
+
+    def run(self, key, function, *args, **kwargs):
+        """ Returns the result of function(*args, **kwargs) and whether it has been shared
+            with (i.e. computed by) another call """
+
+        with self._lock:
+            future = self._futures.get(key)
+            is_shared = future is not None
+            if not is_shared:
+                future = self._futures[key] = Future()
+
+        if is_shared:
+            return future.result(), True
+
+        try:
+            result = function(*args, **kwargs)
+            future.set_result(result)
+            return result, False
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+class FallbackMuxer:
+    """ mp4.Mp4Muxer which gives the video to ffmpeg if it cannot mux it (mp4.MuxerError).
+        The h264 chunks are kept until the video finishes, so they can be written again """
+
+    def __init__(self, framerate):
+        self.framerate = framerate
+        self._muxer = mp4.Mp4Muxer(framerate)
+        self._h264 = BytesIO()
+        self._failed = False
+
+    def write(self, data):
+        self._h264.write(data)
+        if not self._failed:
+            try:
+                self._muxer.write(data)
+            except mp4.MuxerError as exc:
+                self._fail(exc)
+        return len(data)
+
+    def flush(self):
+        # NOTE: picamera calls this method when the recording stops
+        pass
+
+    def finish(self):
+        """ Returns a BytesIO with the mp4 """
+
+        try:
+            if not self._failed:
+                try:
+                    return self._muxer.finish()
+                except mp4.MuxerError as exc:
+                    self._fail(exc)
+
+            self._h264.seek(0)
+            return convert_to_mp4(self._h264, self.framerate, FFmpegMuxer)
+        finally:
+            self._h264.close()
+
+    def abort(self):
+        if not self._failed:
+            self._muxer.abort()
+        self._h264.close()
+
+    def _fail(self, exc):
+        logger.warning(f"The builtin muxer failed ({exc}). The video is muxed with ffmpeg")
+        self._failed = True
+        self._muxer.abort()
+
+def parse_authorized_chats(authorized_chats):
+    """ Converts a string like '-1001234:control,5678:alerts' into a dict whose keys are the ids
+        of the chats and whose values are the sets of their permissions (several permissions
+        are separated by '+'). See constants.PERMISSION_* """
+
+    chats = {}
+    for chat in filter(None, (chat.strip() for chat in authorized_chats.split(","))):
+        chat_id, _, permissions = chat.partition(":")
+        permissions = set(filter(None, permissions.split("+"))) or {constants.PERMISSION_CONTROL}
+
+        unknown_permissions = permissions - {constants.PERMISSION_CONTROL, constants.PERMISSION_ALERTS}
+        if unknown_permissions:
+            raise ValueError(f"Unknown permissions for chat {chat_id}: {unknown_permissions}")
+
+        chats[int(chat_id)] = permissions
+
+    if not chats:
+        raise ValueError("At least one chat must be authorized")
+
+    return chats
+
+def get_file_id(message):
+    """ Returns the id Telegram has given to the media of a message (None if it has no media) """
+
+    for attribute in ("video", "animation", "document"):
+        media = getattr(message, attribute, None)
+        if media:
+            return media.file_id
+
+    # the last one is the biggest size
+    if getattr(message, "photo", None):
+        return message.photo[-1].file_id
 
     return None
+
+def backoff_delay(attempt, base, maximum):
+    """ Exponential backoff with jitter: a random time between the half and the whole
+        of base * 2^(attempt - 1) seconds, which is never greater than 'maximum' """
+
+    delay = min(maximum, base * 2 ** min(attempt - 1, 32))
+    return random.uniform(delay / 2, delay)
+
+def create_muxer(framerate):
+    """ Returns the muxer chosen in the configuration. The one built in FourthBrother is used
+        unless ffmpeg is explicitly asked for. If ffmpeg is installed, it is kept as a fallback
+        (see FallbackMuxer) """
+
+    if constants.MUXER == "ffmpeg":
+        return FFmpegMuxer(framerate)
+    if shutil.which("ffmpeg"):
+        return FallbackMuxer(framerate)
+    return mp4.Mp4Muxer(framerate)
+
+def convert_to_mp4(stream, framerate, muxer_class=None):
+    """ Puts h264 video stream in a mp4 container, which is the one Telegram supports
+    Framerate is necessary because that information is not held by a video codec 
+    stream must be a file-like object. It is read by chunks, so the h264 video is never
+    copied as a whole. 'muxer_class' is the muxer of the configuration by default.
+    Returns a BytesIO with the mp4 video """
+
+    muxer = create_muxer(framerate) if muxer_class is None else muxer_class(framerate)
+    try:
+        shutil.copyfileobj(stream, muxer, CHUNK_SIZE)
+    except BaseException:
+        muxer.abort()
+        raise
+
+    return muxer.finish()
@@ -0,0 +1,187 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import helper
+
+logger = logging.getLogger(__name__)
+
+# kinds of events
+EVENT_PIR = "pir"
+EVENT_COMMAND = "command"
+EVENT_MODE = "mode"
+EVENT_VIDEO = "video"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    clip TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+"""
+
+
+class EventStore:
+    """ Keeps every pir trigger, command, change of mode and recording in a SQLite database
+        indexed by time, so that what happened in a period of time can be found without
+        scrolling the chat. It can be used from any thread """
+
+    def __init__(self, path):
+        self.path = path
+        # the connection is shared by every thread, so the accesses are serialized
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            # the events are written while the camera is recording. WAL mode does not block
+            # the readers and syncs the disk far less often
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+
+    def record(self, kind, detail="", clip=None, when=None):
+        """ Stores an event and returns its id. 'when' is a value of time.time() (now by default) """
+
+        if when is None:
+            when = time.time()
+
+        try:
+            with self._lock, self._connection:
+                cursor = self._connection.execute(
+                    "INSERT INTO events (time, kind, detail, clip) VALUES (?, ?, ?, ?)",
+                    (when, kind, detail, clip))
+                return cursor.lastrowid
+        except sqlite3.Error as exc:
+            # the history must never stop the bot from working
+            logger.error(f"The event could not be stored: {exc!r}")
+            return None
+
+    def query(self, start, end, kinds=None, limit=50):
+        """ Returns the last 'limit' events between 'start' and 'end' (values of time.time()),
+            oldest first, as (id, time, kind, detail, clip) tuples """
+
+        sql = "SELECT id, time, kind, detail, clip FROM events WHERE time >= ? AND time < ?"
+        parameters = [start, end]
+        if kinds:
+            sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            parameters.extend(kinds)
+        sql += " ORDER BY time DESC LIMIT ?"
+        parameters.append(limit)
+
+        with self._lock:
+            events = self._connection.execute(sql, parameters).fetchall()
+        events.reverse()
+        return events
+
+    def get(self, event_id):
+        with self._lock:
+            return self._connection.execute("SELECT id, time, kind, detail, clip FROM events WHERE id = ?",
+                                            (event_id,)).fetchone()
+
+    def forget_clip(self, clip):
+        """ The events keep existing after their clip has been removed from the archive """
+
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE events SET clip = NULL WHERE clip = ?", (clip,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ClipArchive:
+    """ Keeps a copy of the videos in disk. The archive never holds more than 'max_bytes'
+        bytes nor clips older than 'max_age' seconds. When it is full, the clips which have
+        been used the least recently go first. 'on_evict' is called with the name of each
+        clip removed """
+
+    def __init__(self, directory, max_bytes, max_age, on_evict=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.on_evict = on_evict
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def add(self, stream, extension="mp4"):
+        """ Copies the content of 'stream' into the archive and returns the name of the clip """
+
+        # the name tells when the clip was recorded
+        name = f"{time.time():.6f}.{extension}"
+        temporal_path = os.path.join(self.directory, f".{name}.tmp")
+
+        stream.seek(0)
+        with open(temporal_path, "wb") as clip_file:
+            shutil.copyfileobj(stream, clip_file, helper.CHUNK_SIZE)
+        os.replace(temporal_path, os.path.join(self.directory, name))
+        stream.seek(0)
+
+        self._evict()
+        return name
+
+    def open(self, name):
+        """ Returns the clip opened in binary mode or None if it is not in the archive anymore """
+
+        path = os.path.join(self.directory, os.path.basename(name))
+        with self._lock:
+            try:
+                clip_file = open(path, "rb")
+            except FileNotFoundError:
+                return None
+            # the clip has just been used, so it is the last one to be evicted
+            os.utime(path)
+            return clip_file
+
+    def _evict(self):
+        with self._lock:
+            clips = []
+            for name in os.listdir(self.directory):
+                if name.startswith("."):
+                    continue
+                try:
+                    created = float(os.path.splitext(name)[0])
+                except ValueError:
+                    # not a clip ('lost+found' of the SD card, for instance), so it is left alone
+                    continue
+                stats = os.stat(os.path.join(self.directory, name))
+                clips.append((stats.st_mtime, stats.st_size, name, created))
+
+            # least recently used first
+            clips.sort()
+            total_size = sum(size for _, size, _, _ in clips)
+            oldest_allowed = time.time() - self.max_age
+
+            evicted = []
+            for _, size, name, created in clips:
+                if total_size <= self.max_bytes and created >= oldest_allowed:
+                    continue
+                logger.info(f"Evicting '{name}' from the archive")
+                os.remove(os.path.join(self.directory, name))
+                total_size -= size
+                evicted.append(name)
+
+        if self.on_evict is not None:
+            for name in evicted:
+                self.on_evict(name)
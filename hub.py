@@ -0,0 +1,352 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hmac
+import json
+import logging
+import secrets
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import constants
+import rpc
+import zones
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# seconds a node has to introduce itself after connecting
+HELLO_TIMEOUT = 10
+
+
+class NodeLink:
+    """ The connection with a node (see node.py). It can be lost and restored at any time,
+        so requests made while the node is not connected fail with a ConnectionError """
+
+    def __init__(self, name):
+        self.name = name
+        # what the node told about its camera in its last hello (None if it has no camera)
+        self.camera_info = None
+        self._caller = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_connected(self):
+        return self._caller is not None
+
+    def attach(self, caller, hello):
+        """ Returns the caller it replaces, if any """
+
+        with self._lock:
+            previous_caller = self._caller
+            self._caller = caller
+            self.camera_info = hello.get("camera")
+        return previous_caller
+
+    def detach(self, caller):
+        with self._lock:
+            if self._caller is caller:
+                self._caller = None
+
+    def call(self, method, timeout=constants.RPC_TIMEOUT, output=None, **params):
+        caller = self._caller
+        if caller is None:
+            raise ConnectionError(f"The node '{self.name}' is not connected")
+
+        with REGISTRY.time("rpc_call_seconds", "Time spent in the requests to the nodes",
+                           node=self.name, method=method):
+            return caller.call(method, timeout, output, **params)
+
+
+class RemoteSensor:
+    """ Stands for a sensor of a node. The hub calls its callbacks when the node sends an event """
+
+    def __init__(self):
+        self.when_activated = None
+        self.when_deactivated = None
+
+
+class RemoteZone(zones.BaseZone):
+    """ A zone whose devices are connected to a node. The state of the lamp is the last one
+        the node reported """
+
+    def __init__(self, bro, name, link, lamp_on_time, camera=False):
+        self.link = link
+        self.pir_sensor = RemoteSensor()
+        self._is_normal_mode = True
+        # the requests to switch the lamp are sent in order without blocking the caller
+        self._switch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"switch-{name}")
+
+        super().__init__(bro, name, lamp_on_time, camera)
+
+    @property
+    def is_normal_mode(self):
+        return self._is_normal_mode
+
+    def sync(self, is_normal_mode):
+        self._is_normal_mode = is_normal_mode
+
+    def _switch(self, manual):
+        return self._switch_executor.submit(self._remote_switch, manual)
+
+    def _remote_switch(self, manual):
+        try:
+            result = self.link.call("switch", zone=self.name, manual=manual)
+        except (ConnectionError, TimeoutError, rpc.RpcError) as exc:
+            logger.error(f"The lamp of '{self.name}' could not be switched: {exc!r}")
+            return False
+
+        self._is_normal_mode = result["is_normal_mode"]
+        return result["changed"]
+
+
+class _StreamList:
+    """ Every chunk written into it is a stream of its own """
+
+    def __init__(self):
+        self.streams = []
+
+    def write(self, data):
+        self.streams.append(BytesIO(data))
+        return len(data)
+
+
+class RemoteCamera:
+    """ Same interface as CameraArbiter for the camera of a node. Photos and videos come
+        through the network while they are being taken """
+
+    def __init__(self, link):
+        self.link = link
+        # whether the camera should be armed and kept warm. If the node reconnects, it is
+        # told again
+        self._armed = False
+        self._warm = False
+        self.arm_settings = (None, None)
+        self.is_recording = False
+
+    @property
+    def framerate(self):
+        camera_info = self.link.camera_info or {}
+        return camera_info.get("framerate", constants.CAMERA_FRAMERATE)
+
+    @property
+    def resolution(self):
+        camera_info = self.link.camera_info or {}
+        return tuple(camera_info.get("resolution", (576, 288)))
+
+    @property
+    def is_armed(self):
+        return self._armed
+
+    def arm(self, bitrate=None, resize=None):
+        self._armed = True
+        self.arm_settings = (bitrate, resize)
+        self.link.call("arm", bitrate=bitrate, resize=resize)
+
+    def update_arm_settings(self, bitrate=None, resize=None):
+        if self._armed:
+            # if the node reconnects, it is armed with these ones
+            self.arm_settings = (bitrate, resize)
+            try:
+                self.link.call("update_arm_settings", bitrate=bitrate, resize=resize)
+            except (ConnectionError, TimeoutError, rpc.RpcError) as exc:
+                # the video has been sent anyway. If the node has lost the connection, it is
+                # armed with them when it connects again
+                logger.error(f"The camera of '{self.link.name}' could not be armed again: {exc!r}")
+
+    def disarm(self):
+        self._armed = False
+        try:
+            self.link.call("disarm")
+        except ConnectionError:
+            # a node disarms its camera when it loses the connection
+            pass
+
+    @property
+    def is_warm(self):
+        return self._warm
+
+    def keep_warm(self, warm=True):
+        self._warm = warm
+        try:
+            self.link.call("keep_warm", warm=warm)
+        except ConnectionError:
+            # the node stops keeping it warm when it loses the connection
+            if warm:
+                raise
+
+    def confirm_movement(self, window):
+        return self.link.call("confirm_movement", timeout=window * 2 + constants.RPC_TIMEOUT, window=window)
+
+    def capture(self, image_format, resize=None):
+        stream = BytesIO()
+        self.link.call("capture", output=stream, image_format=image_format, resize=resize)
+        stream.seek(0)
+        return stream
+
+    def capture_burst(self, count, interval):
+        output = _StreamList()
+        self.link.call("capture_burst", timeout=count * interval + constants.RPC_TIMEOUT, output=output,
+                       count=count, interval=interval)
+        return output.streams
+
+    def record(self, output, video_duration, preroll=0, bitrate=None, resize=None):
+        self.is_recording = True
+        try:
+            self.link.call("record", timeout=video_duration + preroll + constants.RPC_TIMEOUT, output=output,
+                           duration=video_duration, preroll=preroll, bitrate=bitrate, resize=resize)
+        finally:
+            self.is_recording = False
+
+    def record_preview(self, output, duration, resize, bitrate):
+        self.link.call("record_preview", timeout=duration + constants.RPC_TIMEOUT, output=output,
+                       duration=duration, resize=resize, bitrate=bitrate)
+
+
+class HubServer(threading.Thread):
+    """ Waits for the nodes to connect. A node must introduce itself with the name of one of
+        the 'links' and prove it knows the shared 'secret' (see rpc.hello_proof). Then, the
+        hub can make requests to it and the events it sends are given to the devices of
+        its zones """
+
+    def __init__(self, bro, links, listen, port, secret, *args, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+
+        self.bro = bro
+        self.links = links
+        self.secret = secret
+        self._server_socket = socket.create_server((listen, port))
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._finished = threading.Event()
+        self.start()
+
+    @property
+    def port(self):
+        """ The port the server listens to (useful if it was 0) """
+
+        return self._server_socket.getsockname()[1]
+
+    def run(self):
+        while not self._finished.is_set():
+            try:
+                sock, address = self._server_socket.accept()
+            except OSError:
+                # the socket has been closed by 'stop'
+                break
+
+            threading.Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _serve(self, sock, address):
+        connection = rpc.Connection(sock)
+        with self._connections_lock:
+            self._connections.add(connection)
+
+        # a new nonce for every connection, so a hello seen in the network cannot be replayed
+        nonce = secrets.token_hex(16)
+        try:
+            sock.settimeout(HELLO_TIMEOUT)
+            connection.send({"type": "challenge", "nonce": nonce})
+            # nobody can send data before being authenticated
+            hello, _ = connection.receive(maximum_data_size=0)
+            sock.settimeout(None)
+        except (OSError, ValueError) as exc:
+            logger.warning(f"{address} has not introduced itself: {exc!r}")
+            self._forget(connection)
+            return
+
+        link = self.links.get(hello.get("node"))
+        if hello.get("type") != "hello" or link is None or \
+                not hmac.compare_digest(str(hello.get("proof", "")).encode(),
+                                        rpc.hello_proof(self.secret, nonce, link.name).encode()):
+            logger.warning(f"Node rejected from {address}: {json.dumps(hello.get('node'))}")
+            REGISTRY.counter("nodes_rejected_total", "Connections rejected by the hub").inc()
+            self._forget(connection)
+            return
+
+        caller = rpc.Caller(connection, lambda header, data: self._on_frame(link, header))
+        previous_caller = link.attach(caller, hello)
+        if previous_caller is not None:
+            previous_caller.connection.close()
+        logger.info(f"Node '{link.name}' connected from {address}")
+        REGISTRY.counter("node_connections_total", "Connections of the nodes", node=link.name).inc()
+
+        # the requests made from here need the receive loop, so it must be run by another thread
+        threading.Thread(target=self._on_connect, args=(link, hello), daemon=True).start()
+        try:
+            caller.receive_loop()
+        finally:
+            link.detach(caller)
+            self._forget(connection)
+            logger.warning(f"Node '{link.name}' disconnected")
+
+    def _zones_of(self, link):
+        return [zone for zone in self.bro.zones if isinstance(zone, RemoteZone) and zone.link is link]
+
+    def _on_connect(self, link, hello):
+        # the node could have been restarted, so what it says is the truth
+        node_zones = hello.get("zones", {})
+        for zone in self._zones_of(link):
+            if zone.name in node_zones:
+                zone.sync(node_zones[zone.name])
+
+        camera_arbiter = self.bro.camera_arbiter
+        if isinstance(camera_arbiter, RemoteCamera) and camera_arbiter.link is link:
+            try:
+                if camera_arbiter.is_warm:
+                    camera_arbiter.keep_warm()
+                if camera_arbiter.is_armed:
+                    camera_arbiter.arm(*camera_arbiter.arm_settings)
+            except (ConnectionError, TimeoutError, rpc.RpcError) as exc:
+                logger.error(f"The camera of '{link.name}' could not be armed again: {exc!r}")
+
+        self.bro.send_menu()
+
+    def _on_frame(self, link, header):
+        if header.get("type") != "event":
+            return
+
+        zone = next((zone for zone in self._zones_of(link) if zone.name == header.get("zone")), None)
+        device = getattr(zone, str(header.get("device")), None)
+        if not isinstance(device, RemoteSensor):
+            logger.warning(f"Unknown event from '{link.name}': {header}")
+            return
+
+        # the callbacks only publish the event (see FourthBrother.add_handler_to_zones)
+        callback = getattr(device, str(header.get("name")), None)
+        if callable(callback):
+            callback()
+
+    def _forget(self, connection):
+        with self._connections_lock:
+            self._connections.discard(connection)
+        connection.close()
+
+    def stop(self):
+        self._finished.set()
+        try:
+            # close() alone does not wake up accept()
+            self._server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server_socket.close()
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+        self.join()
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 import handlers
@@ -28,18 +30,45 @@ def _generate_keyboard_markup(keyboard):
     ]
     return InlineKeyboardMarkup(inline_keyboard)
 
-def generate_menu_keyboard(bro):
-    pir_option_msg = "Desactivar alarma" if bro.pir_activated else "Activar alarma"
-    lamp_option_msg = "Encender lámpara" if bro.is_normal_mode else "Apagar lámpara"
-    movement_option_msg = "Desactivar movimiento" if bro.movement_activated else "Activar movimiento"
+def menu_state(bro):
+    """ Returns the flags of the bot the labels of the menu depend on (for every zone) """
+
+    return tuple((zone.name, zone.pir_activated, zone.is_normal_mode, zone.movement_activated)
+                 for zone in bro.zones)
+
+def _zone_options(zone_state):
+    _, pir_activated, is_normal_mode, movement_activated = zone_state
 
-    reply_markup = _generate_keyboard_markup([
-        [(pir_option_msg, handlers.ALARM), (lamp_option_msg, handlers.LAMP)],
-        [("Hacer Foto", handlers.PHOTO), (movement_option_msg, handlers.MOVEMENT)],
-        [("Hacer Video", handlers.VIDEO)]
-    ])
+    pir_option_msg = "Desactivar alarma" if pir_activated else "Activar alarma"
+    lamp_option_msg = "Encender lámpara" if is_normal_mode else "Apagar lámpara"
+    movement_option_msg = "Desactivar movimiento" if movement_activated else "Activar movimiento"
+    return pir_option_msg, lamp_option_msg, movement_option_msg
 
-    return reply_markup
+# there are only 8 possible states per zone, so the keyboard of each one is only built once
+@lru_cache(maxsize=256)
+def _generate_menu_keyboard_for_state(state):
+    if len(state) == 1:
+        pir_option_msg, lamp_option_msg, movement_option_msg = _zone_options(state[0])
+        return _generate_keyboard_markup([
+            [(pir_option_msg, handlers.ALARM), (lamp_option_msg, handlers.LAMP)],
+            [("Hacer Foto", handlers.PHOTO), (movement_option_msg, handlers.MOVEMENT)],
+            [("Hacer Video", handlers.VIDEO)]
+        ])
+
+    # the buttons of each zone carry its name (see FourthBrother.add_menu_callback_query)
+    keyboard = []
+    for zone_state in state:
+        name = zone_state[0]
+        pir_option_msg, lamp_option_msg, movement_option_msg = _zone_options(zone_state)
+        keyboard.append([(f"{pir_option_msg} ({name})", f"{handlers.ALARM}:{name}"),
+                         (f"{lamp_option_msg} ({name})", f"{handlers.LAMP}:{name}")])
+        keyboard.append([(f"{movement_option_msg} ({name})", f"{handlers.MOVEMENT}:{name}")])
+    keyboard.append([("Hacer Foto", handlers.PHOTO), ("Hacer Video", handlers.VIDEO)])
+
+    return _generate_keyboard_markup(keyboard)
+
+def generate_menu_keyboard(bro):
+    return _generate_menu_keyboard_for_state(menu_state(bro))
 
 def start_menu_command(bro, update, *comm_args):
     bro.send_menu()
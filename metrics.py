@@ -0,0 +1,225 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (in seconds) of the buckets of the histograms. They go from the time it takes
+# to acquire a free lock to the time it takes to upload a long video
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """ A value which can go up and down, like an estimate """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram:
+    """ Counts how many observations fall into each bucket. The memory it uses does not
+        grow with the number of observations """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.maximum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.maximum = max(self.maximum, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket where the 'q' quantile is (the maximum if it is in the last one) """
+
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            accumulated = 0
+            for bound, count in zip(self.buckets, self.counts):
+                accumulated += count
+                if accumulated >= rank:
+                    return min(bound, self.maximum)
+            return self.maximum
+
+    @contextmanager
+    def time(self):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time)
+
+
+_TYPE_NAMES = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+
+
+class Registry:
+    """ Keeps every counter, gauge and histogram of the bot. Each metric can have several series,
+        one for each combination of the values of its labels """
+
+    def __init__(self):
+        self._metrics = {}
+        self._descriptions = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type, name, description, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = metric_type(*args)
+                self._descriptions.setdefault(name, (metric_type, description))
+            return metric
+
+    def counter(self, name, description="", **labels):
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name, description="", **labels):
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name, description="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, description, labels, buckets)
+
+    def time(self, name, description="", **labels):
+        """ Context manager which observes the seconds its block takes in a histogram """
+
+        return self.histogram(name, description, **labels).time()
+
+    @contextmanager
+    def acquire(self, lock, name):
+        """ Acquires 'lock' observing how long it has had to wait for it """
+
+        with self.time("lock_wait_seconds", "Time spent waiting for a lock", lock=name):
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _series(self):
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def render_prometheus(self):
+        """ Returns every metric in the text format of Prometheus """
+
+        lines = []
+        last_name = None
+        for (name, labels), metric in self._series():
+            if name != last_name:
+                metric_type, description = self._descriptions[name]
+                if description:
+                    lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {_TYPE_NAMES[metric_type]}")
+                last_name = name
+
+            if isinstance(metric, (Counter, Gauge)):
+                lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+                continue
+
+            accumulated = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                accumulated += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {accumulated}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """ Returns a short human readable text with the value of the counters and the
+            number of observations, mean, median, 95th percentile and maximum of the histograms """
+
+        lines = []
+        for (name, labels), metric in self._series():
+            if isinstance(metric, (Counter, Gauge)):
+                lines.append(f"{name}{_format_labels(labels)}: {metric.value}")
+            elif metric.count:
+                lines.append(f"{name}{_format_labels(labels)}: n={metric.count} "
+                             f"media={metric.sum / metric.count:.3f}s p50={metric.quantile(0.5):.3f}s "
+                             f"p95={metric.quantile(0.95):.3f}s max={metric.maximum:.3f}s")
+
+        return "\n".join(lines)
+
+
+# every module uses the same registry
+REGISTRY = Registry()
+
+
+class _ScrapeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a request every few seconds would fill the log
+        pass
+
+
+def start_http_server(listen, port):
+    """ Serves the metrics in '/metrics' from a background thread. Returns the server
+        (call its 'shutdown' method to stop it) """
+
+    server = ThreadingHTTPServer((listen, port), _ScrapeHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics served in http://{listen}:{port}/metrics")
+    return server
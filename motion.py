@@ -0,0 +1,84 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import numpy as np
+from picamera.array import PiMotionAnalysis
+
+
+def parse_roi(roi):
+    """ Converts a string like '0.25,0,1,0.8' (left, top, right, bottom as fractions of
+        the image) into a tuple of floats """
+
+    left, top, right, bottom = (float(value) for value in roi.split(","))
+    if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+        raise ValueError(f"Invalid region of interest: '{roi}'")
+
+    return left, top, right, bottom
+
+
+class MotionDetector(PiMotionAnalysis):
+    """ Receives the motion vectors the h264 encoder computes for every frame and
+        decides whether enough macroblocks inside the region of interest have moved.
+        The instance must be passed to picamera as the 'motion_output' of a recording """
+
+    def __init__(self, camera, threshold, min_blocks, roi=(0, 0, 1, 1), size=None):
+        super().__init__(camera, size)
+
+        # the magnitude is compared squared to avoid computing square roots
+        self._squared_threshold = threshold ** 2
+        self.min_blocks = min_blocks
+        self.roi = roi
+        self._mask = None
+
+        self._condition = threading.Condition()
+        # monotonic time of the last frame which showed movement
+        self.last_motion_time = None
+
+    def analyse(self, a):
+        if self._mask is None or self._mask.shape != a.shape:
+            self._mask = self._generate_mask(a.shape)
+
+        x = a["x"].astype(np.int32)
+        y = a["y"].astype(np.int32)
+        moving_blocks = np.count_nonzero((x * x + y * y > self._squared_threshold) & self._mask)
+
+        if moving_blocks >= self.min_blocks:
+            with self._condition:
+                self.last_motion_time = time.monotonic()
+                self._condition.notify_all()
+
+    def wait_for_motion(self, since, timeout):
+        """ Returns True if movement has been detected after 'since' (a value of time.monotonic())
+            or if it is detected before 'timeout' seconds have passed """
+
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.last_motion_time is not None and self.last_motion_time >= since,
+                timeout)
+
+    def _generate_mask(self, shape):
+        rows, columns = shape
+        # the encoder adds an extra column which does not belong to the image
+        columns -= 1
+        left, top, right, bottom = self.roi
+
+        mask = np.zeros(shape, dtype=bool)
+        mask[int(top * rows):int(np.ceil(bottom * rows)),
+             int(left * columns):int(np.ceil(right * columns))] = True
+        return mask
@@ -0,0 +1,397 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Puts the h264 stream (Annex B format, the one the camera generates) in a mp4
+# container without the need of ffmpeg. Since the container only holds one video
+# track with a constant framerate, the mp4 is quite simple:
+#
+#   ftyp
+#   moov    (sizes and positions of the frames, SPS, PPS, ...)
+#   mdat    (the frames, with their NAL units prefixed by their length)
+#
+# The moov box goes before the frames (like 'ffmpeg -movflags faststart') so that
+# the video can be played before it has been downloaded as a whole. Since the moov
+# box is not known until the video has finished, the frames are kept apart while
+# they arrive and the file is put together by 'finish'.
+
+import struct
+from fractions import Fraction
+from io import BytesIO
+
+START_CODE = b"\x00\x00\x01"
+
+# types of NAL units
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# profiles whose SPS contains information about the chroma format
+HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+# profiles whose avcC box also carries the chroma format and the bit depths
+AVCC_EXTENDED_PROFILES = (100, 110, 122, 144)
+
+MOVIE_TIMESCALE = 1000
+
+IDENTITY_MATRIX = (0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+class MuxerError(Exception):
+    pass
+
+
+class _BitReader:
+    """ Reads the fields of a RBSP (the payload of a NAL unit without the
+        emulation prevention bytes) """
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def read_bit(self):
+        byte_index = self._position >> 3
+        if byte_index >= len(self._data):
+            raise MuxerError("Unexpected end of NAL unit")
+
+        bit = (self._data[byte_index] >> (7 - (self._position & 7))) & 1
+        self._position += 1
+        return bit
+
+    def read_bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.read_bit()
+        return value
+
+    def read_ue(self):
+        """ Unsigned Exp-Golomb code """
+
+        leading_zeros = 0
+        while self.read_bit() == 0:
+            leading_zeros += 1
+        return (1 << leading_zeros) - 1 + self.read_bits(leading_zeros)
+
+    def read_se(self):
+        """ Signed Exp-Golomb code """
+
+        value = self.read_ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def _unescape(nal):
+    """ Removes the emulation prevention bytes (00 00 03 -> 00 00) """
+
+    return bytes(nal).replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+def _skip_scaling_list(reader, size):
+    last_scale = next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last_scale + reader.read_se() + 256) % 256
+        last_scale = next_scale or last_scale
+
+
+def parse_sps(sps):
+    """ Returns a dict with the profile, the chroma format, the bit depths and the
+        resolution ('width' and 'height') of the video described by a SPS NAL unit """
+
+    reader = _BitReader(_unescape(sps[1:]))
+    profile_idc = reader.read_bits(8)
+    # constraint flags and level
+    reader.read_bits(16)
+    reader.read_ue()
+
+    chroma_format_idc = 1
+    separate_colour_plane = 0
+    bit_depth_luma_minus8 = bit_depth_chroma_minus8 = 0
+    if profile_idc in HIGH_PROFILES:
+        chroma_format_idc = reader.read_ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = reader.read_bit()
+        bit_depth_luma_minus8 = reader.read_ue()
+        bit_depth_chroma_minus8 = reader.read_ue()
+        # qpprime_y_zero_transform_bypass_flag
+        reader.read_bit()
+        if reader.read_bit():
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.read_bit():
+                    _skip_scaling_list(reader, 16 if i < 6 else 64)
+
+    # log2_max_frame_num_minus4
+    reader.read_ue()
+    pic_order_cnt_type = reader.read_ue()
+    if pic_order_cnt_type == 0:
+        reader.read_ue()
+    elif pic_order_cnt_type == 1:
+        reader.read_bit()
+        reader.read_se()
+        reader.read_se()
+        for _ in range(reader.read_ue()):
+            reader.read_se()
+
+    # max_num_ref_frames and gaps_in_frame_num_value_allowed_flag
+    reader.read_ue()
+    reader.read_bit()
+
+    width_in_mbs = reader.read_ue() + 1
+    height_in_map_units = reader.read_ue() + 1
+    frame_mbs_only = reader.read_bit()
+    if not frame_mbs_only:
+        reader.read_bit()
+    reader.read_bit()
+
+    width = width_in_mbs * 16
+    height = (2 - frame_mbs_only) * height_in_map_units * 16
+
+    if reader.read_bit():
+        crop_left, crop_right = reader.read_ue(), reader.read_ue()
+        crop_top, crop_bottom = reader.read_ue(), reader.read_ue()
+
+        if chroma_format_idc == 0 or separate_colour_plane:
+            crop_unit_x, crop_unit_y = 1, 2 - frame_mbs_only
+        else:
+            crop_unit_x = 1 if chroma_format_idc == 3 else 2
+            crop_unit_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+
+        width -= crop_unit_x * (crop_left + crop_right)
+        height -= crop_unit_y * (crop_top + crop_bottom)
+
+    return {"profile_idc": profile_idc, "chroma_format_idc": chroma_format_idc,
+            "bit_depth_luma_minus8": bit_depth_luma_minus8,
+            "bit_depth_chroma_minus8": bit_depth_chroma_minus8,
+            "width": width, "height": height}
+
+
+def _first_mb_in_slice(nal):
+    return _BitReader(nal[1:6]).read_ue()
+
+
+def _box(box_type, *payloads):
+    payload = b"".join(payloads)
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type, version, flags, *payloads):
+    return _box(box_type, struct.pack(">I", (version << 24) | flags), *payloads)
+
+
+class Mp4Muxer:
+    """ File-like object which puts the h264 chunks written into it in a mp4 container
+        while they are still arriving. It has the same interface as helper.FFmpegMuxer
+        but everything happens in this process """
+
+    def __init__(self, framerate):
+        framerate = Fraction(framerate).limit_denominator(1001)
+        # every frame lasts 'sample_delta' units of 'timescale'
+        self.timescale = framerate.numerator
+        self.sample_delta = framerate.denominator
+
+        # payload of the mdat box. The boxes before it are written by 'finish'
+        self._mdat = BytesIO()
+
+        self._buffer = bytearray()
+        # position from where the next start code will be looked for
+        self._scan_position = 0
+
+        self._sps = None
+        self._pps = None
+
+        # NAL units of the frame which is being received
+        self._access_unit = []
+        self._access_unit_has_slice = False
+
+        self._sample_sizes = []
+        self._keyframes = []
+
+    def write(self, data):
+        self._buffer += data
+
+        while True:
+            start = self._buffer.find(START_CODE)
+            if start < 0:
+                break
+
+            end = self._buffer.find(START_CODE, max(start + 3, self._scan_position))
+            if end < 0:
+                # the NAL unit is not complete yet
+                self._scan_position = max(start + 3, len(self._buffer) - 2)
+                if start > 0:
+                    del self._buffer[:start]
+                    self._scan_position -= start
+                break
+
+            # the zeros before a start code belong to the start code, not to the NAL unit
+            self._handle_nal(bytes(self._buffer[start + 3:end]).rstrip(b"\x00"))
+            del self._buffer[:end]
+            self._scan_position = 0
+
+        return len(data)
+
+    def flush(self):
+        # NOTE: picamera calls this method when the recording stops
+        pass
+
+    def finish(self):
+        """ Writes the frames left and the moov box. Returns a BytesIO with the mp4 """
+
+        start = self._buffer.find(START_CODE)
+        if start >= 0:
+            self._handle_nal(bytes(self._buffer[start + 3:]).rstrip(b"\x00"))
+        self._buffer = bytearray()
+        self._end_access_unit()
+
+        if not self._sample_sizes:
+            self._mdat.close()
+            raise MuxerError("The stream does not contain any decodable frame")
+
+        ftyp = _box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isom", b"iso2", b"avc1", b"mp41")
+        # the size of the moov box does not depend on where the frames are
+        moov_size = len(self._moov(0))
+        mdat_payload = self._mdat.getbuffer()
+
+        output = BytesIO()
+        output.write(ftyp)
+        # all the frames are in one chunk, which starts right after the mdat header
+        output.write(self._moov(len(ftyp) + moov_size + 8))
+        output.write(struct.pack(">I4s", 8 + len(mdat_payload), b"mdat"))
+        output.write(mdat_payload)
+        del mdat_payload
+        self._mdat.close()
+
+        output.seek(0)
+        return output
+
+    def abort(self):
+        self._buffer = bytearray()
+        self._mdat.close()
+
+    def _handle_nal(self, nal):
+        if not nal:
+            return
+
+        nal_type = nal[0] & 0x1f
+        if nal_type in (NAL_SLICE, NAL_IDR_SLICE):
+            # a slice which starts at the first macroblock is the beginning of a new frame
+            if self._access_unit_has_slice and _first_mb_in_slice(nal) == 0:
+                self._end_access_unit()
+            self._access_unit.append(nal)
+            self._access_unit_has_slice = True
+            return
+
+        # any other NAL unit after the slices means that the frame has finished
+        if self._access_unit_has_slice:
+            self._end_access_unit()
+
+        # SPS and PPS are stored in the moov box. Access unit delimiters are not needed
+        if nal_type == NAL_SPS:
+            if self._sps is None:
+                self._sps = nal
+        elif nal_type == NAL_PPS:
+            if self._pps is None:
+                self._pps = nal
+        elif nal_type != NAL_AUD:
+            self._access_unit.append(nal)
+
+    def _end_access_unit(self):
+        access_unit = self._access_unit
+        self._access_unit = []
+        self._access_unit_has_slice = False
+
+        is_keyframe = any(nal[0] & 0x1f == NAL_IDR_SLICE for nal in access_unit)
+        # frames previous to the first keyframe cannot be decoded
+        if not access_unit or self._sps is None or self._pps is None \
+                or (not self._sample_sizes and not is_keyframe):
+            return
+
+        sample_size = 0
+        for nal in access_unit:
+            self._mdat.write(struct.pack(">I", len(nal)))
+            self._mdat.write(nal)
+            sample_size += 4 + len(nal)
+
+        self._sample_sizes.append(sample_size)
+        if is_keyframe:
+            self._keyframes.append(len(self._sample_sizes))
+
+    def _avcc(self):
+        """ AVCDecoderConfigurationRecord (ISO/IEC 14496-15). The high profiles need the
+            chroma format and the bit depths on top of the SPS and the PPS """
+
+        sps_info = parse_sps(self._sps)
+        avcc = [struct.pack(">BBBBBB", 1, self._sps[1], self._sps[2], self._sps[3], 0xff, 0xe1),
+                struct.pack(">H", len(self._sps)), self._sps,
+                struct.pack(">BH", 1, len(self._pps)), self._pps]
+        if sps_info["profile_idc"] in AVCC_EXTENDED_PROFILES:
+            # the reserved bits are set to 1 and there are no SPS extensions
+            avcc.append(struct.pack(">BBBB", 0xfc | sps_info["chroma_format_idc"],
+                                    0xf8 | sps_info["bit_depth_luma_minus8"],
+                                    0xf8 | sps_info["bit_depth_chroma_minus8"], 0))
+        return _box(b"avcC", *avcc)
+
+    def _moov(self, chunk_offset):
+        """ 'chunk_offset' is the position of the first frame in the file """
+
+        sps_info = parse_sps(self._sps)
+        width, height = sps_info["width"], sps_info["height"]
+        sample_count = len(self._sample_sizes)
+        media_duration = sample_count * self.sample_delta
+        movie_duration = media_duration * MOVIE_TIMESCALE // self.timescale
+        matrix = struct.pack(">9I", *IDENTITY_MATRIX)
+
+        mvhd = _full_box(b"mvhd", 0, 0,
+                         struct.pack(">IIII", 0, 0, MOVIE_TIMESCALE, movie_duration),
+                         struct.pack(">IH10x", 0x00010000, 0x0100), matrix,
+                         struct.pack(">24xI", 2))
+
+        tkhd = _full_box(b"tkhd", 0, 3,
+                         struct.pack(">IIIII", 0, 0, 1, 0, movie_duration),
+                         struct.pack(">8xhhh2x", 0, 0, 0), matrix,
+                         struct.pack(">II", width << 16, height << 16))
+
+        # 0x55c4 is the language 'und' (undetermined)
+        mdhd = _full_box(b"mdhd", 0, 0,
+                         struct.pack(">IIIIHH", 0, 0, self.timescale, media_duration, 0x55c4, 0))
+
+        hdlr = _full_box(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"vide"), b"VideoHandler\x00")
+
+        avcc = self._avcc()
+
+        compressor_name = b"FourthBrother"
+        avc1 = _box(b"avc1",
+                    struct.pack(">6xHHH12xHHIIIH", 1, 0, 0, width, height,
+                                0x00480000, 0x00480000, 0, 1),
+                    struct.pack(">B31s", len(compressor_name), compressor_name),
+                    struct.pack(">Hh", 0x18, -1), avcc)
+
+        stbl = _box(b"stbl",
+                    _full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+                    _full_box(b"stts", 0, 0, struct.pack(">III", 1, sample_count, self.sample_delta)),
+                    _full_box(b"stss", 0, 0, struct.pack(f">I{len(self._keyframes)}I",
+                                                         len(self._keyframes), *self._keyframes)),
+                    _full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, sample_count, 1)),
+                    _full_box(b"stsz", 0, 0, struct.pack(f">II{sample_count}I", 0, sample_count,
+                                                         *self._sample_sizes)),
+                    _full_box(b"stco", 0, 0, struct.pack(">II", 1, chunk_offset)))
+
+        dinf = _box(b"dinf", _full_box(b"dref", 0, 0, struct.pack(">I", 1),
+                                       _full_box(b"url ", 0, 1)))
+        minf = _box(b"minf", _full_box(b"vmhd", 0, 1, struct.pack(">H3H", 0, 0, 0, 0)), dinf, stbl)
+
+        trak = _box(b"trak", tkhd, _box(b"mdia", mdhd, hdlr, minf))
+        return _box(b"moov", mvhd, trak)
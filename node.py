@@ -0,0 +1,242 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import socket
+import threading
+from signal import signal, SIGINT, SIGTERM
+
+from gpiozero import MotionSensor
+
+import constants
+import helper
+import rpc
+import zones
+
+logger = logging.getLogger(__name__)
+
+
+class NodeZone:
+    """ The devices of a zone connected to a node. Its state is kept by the hub """
+
+    def __init__(self, name, pins, camera=False):
+        self.name = name
+        self.has_camera = camera
+        self.pir_sensor = MotionSensor(pins["PIR_SENSOR"])
+        self.lamp = zones.LampRelays(pins["RELAY_A"], pins["RELAY_B"], name)
+
+
+class NodeAgent:
+    """ Runs in a Pi without its own Telegram bot. It connects to the hub (see hub.py), which
+        owns the only connection to Telegram, and lets it use the camera and the relays of
+        this Pi. The pir triggers are sent to the hub as events.
+
+        If the connection to the hub is lost, the lamps go back to normal mode (the hub is
+        the one which switches them off) and the node keeps trying to connect again """
+
+    def __init__(self, name, hub_address, secret, zones_config, camera_framerate=constants.CAMERA_FRAMERATE,
+                 camera_resolution=(576, 288), rotation=0, preroll_buffer_size=constants.PREROLL_BUFFER_SIZE):
+        self.name = name
+        host, _, port = hub_address.rpartition(":")
+        self.hub_address = (host, int(port))
+        self.secret = secret
+
+        self.zones = {zone_config["name"]: NodeZone(zone_config["name"], zone_config["pins"],
+                                                    zone_config["camera"])
+                      for zone_config in zones_config}
+
+        self.camera_arbiter = None
+        if any(zone.has_camera for zone in self.zones.values()):
+            # picamera is only needed if the camera is connected to this node
+            from camera_arbiter import CameraArbiter
+            from camera_power import CameraPower
+
+            camera_power = CameraPower(camera_framerate, camera_resolution, rotation, constants.CAMERA_IDLE_TIMEOUT,
+                                       constants.CAMERA_COLD_SETTLE, constants.CAMERA_WARM_SETTLE)
+            camera_power.wake()
+            self.camera_arbiter = CameraArbiter(camera_power, preroll_buffer_size)
+
+        for zone in self.zones.values():
+            zone.pir_sensor.when_activated = lambda zone=zone: self._send_event(zone.name, "pir_sensor",
+                                                                                "when_activated")
+
+        self._connection = None
+        self._finished = threading.Event()
+
+    def _hello(self, nonce):
+        camera = None
+        if self.camera_arbiter is not None:
+            camera = {"framerate": float(self.camera_arbiter.framerate),
+                      "resolution": list(self.camera_arbiter.resolution)}
+
+        # the secret itself never goes through the network
+        return {"type": "hello", "node": self.name, "proof": rpc.hello_proof(self.secret, nonce, self.name),
+                "camera": camera, "zones": {name: zone.lamp.is_normal_mode for name, zone in self.zones.items()}}
+
+    def run(self):
+        """ Connects to the hub and serves its requests until 'stop' is called """
+
+        failures = 0
+        while not self._finished.is_set():
+            try:
+                sock = socket.create_connection(self.hub_address, timeout=10)
+            except OSError as exc:
+                failures += 1
+                logger.warning(f"The hub could not be reached: {exc!r}")
+                self._finished.wait(helper.backoff_delay(failures, 1, 60))
+                continue
+
+            failures = 0
+            connection = rpc.Connection(sock)
+            self._connection = connection
+            logger.info(f"Connected to the hub {self.hub_address}")
+            try:
+                # the hub starts with a challenge (see rpc.hello_proof)
+                challenge, _ = connection.receive(maximum_data_size=0)
+                sock.settimeout(None)
+                connection.send(self._hello(str(challenge.get("nonce", ""))))
+                self._serve(connection)
+            except (OSError, ValueError) as exc:
+                logger.warning(f"Connection to the hub lost: {exc!r}")
+            finally:
+                self._connection = None
+                connection.close()
+                self._on_disconnect()
+
+            # the hub could have rejected the node
+            self._finished.wait(1)
+
+    def _serve(self, connection):
+        while True:
+            # the requests never carry data
+            header, _ = connection.receive(maximum_data_size=0)
+            if header.get("type") == "request":
+                # a video takes a while, so every request has its own thread
+                threading.Thread(target=self._handle, args=(connection, header), daemon=True).start()
+
+    def _on_disconnect(self):
+        switched = [zone.lamp.switch(False) for zone in self.zones.values()]
+        for future in switched:
+            future.result()
+        if self.camera_arbiter is not None:
+            self.camera_arbiter.disarm()
+            self.camera_arbiter.keep_warm(False)
+
+    def _send_event(self, zone, device, name):
+        connection = self._connection
+        if connection is None:
+            logger.warning(f"'{zone}.{device}.{name}' lost: the hub is not connected")
+            return
+
+        try:
+            connection.send({"type": "event", "zone": zone, "device": device, "name": name})
+        except OSError as exc:
+            logger.warning(f"'{zone}.{device}.{name}' lost: {exc!r}")
+
+    def _handle(self, connection, request):
+        request_id = request.get("id")
+        response = {"type": "response", "id": request_id, "result": None, "error": None}
+        try:
+            method = getattr(self, f"rpc_{request.get('method')}", None)
+            if method is None:
+                raise rpc.RpcError(f"Unknown method '{request.get('method')}'")
+            response["result"] = method(rpc.ChunkWriter(connection, request_id), **request.get("params", {}))
+        except Exception as exc:
+            logger.exception(f"Request '{request.get('method')}' failed")
+            response["error"] = repr(exc)
+
+        try:
+            connection.send(response)
+        except OSError:
+            # the hub will know the request failed when the connection is closed
+            pass
+
+    def _camera(self):
+        if self.camera_arbiter is None:
+            raise rpc.RpcError(f"The node '{self.name}' has no camera")
+        return self.camera_arbiter
+
+    # methods the hub can call. 'output' sends chunks of data to the hub
+
+    def rpc_switch(self, output, zone, manual):
+        lamp = self.zones[zone].lamp
+        changed = lamp.switch(manual).result()
+        return {"changed": changed, "is_normal_mode": lamp.is_normal_mode}
+
+    def rpc_arm(self, output, bitrate=None, resize=None):
+        self._camera().arm(bitrate, resize)
+        return True
+
+    def rpc_update_arm_settings(self, output, bitrate=None, resize=None):
+        self._camera().update_arm_settings(bitrate, resize)
+        return True
+
+    def rpc_disarm(self, output):
+        self._camera().disarm()
+        return False
+
+    def rpc_keep_warm(self, output, warm):
+        self._camera().keep_warm(warm)
+        return warm
+
+    def rpc_confirm_movement(self, output, window):
+        return self._camera().confirm_movement(window)
+
+    def rpc_capture(self, output, image_format, resize=None):
+        with self._camera().capture(image_format, resize) as stream:
+            output.write(stream.getvalue())
+
+    def rpc_capture_burst(self, output, count, interval):
+        # every photo is a chunk of its own
+        for stream in self._camera().capture_burst(count, interval):
+            with stream:
+                output.write(stream.getvalue())
+
+    def rpc_record(self, output, duration, preroll=0, bitrate=None, resize=None):
+        # the h264 stream goes to the hub while it is being recorded. The hub muxes it
+        self._camera().record(output, duration, preroll, bitrate, resize)
+
+    def rpc_record_preview(self, output, duration, resize, bitrate):
+        self._camera().record_preview(output, duration, resize, bitrate)
+
+    def stop(self):
+        self._finished.set()
+        connection = self._connection
+        if connection is not None:
+            connection.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if not constants.NODE_NAME or not constants.HUB_ADDRESS or not constants.NODE_SECRET:
+        raise ValueError("NODE_NAME, HUB_ADDRESS and NODE_SECRET must be set in the .env file")
+
+    # the node shares the .env file of the hub (at least the zones section)
+    zones_config = [zone_config for zone_config in zones.read_zones_config(local_node=constants.NODE_NAME)
+                    if zone_config["node"] == constants.NODE_NAME]
+    agent = NodeAgent(constants.NODE_NAME, constants.HUB_ADDRESS, constants.NODE_SECRET,
+                      zones_config, camera_resolution=(288*2, 576*2), rotation=270)
+
+    for sig in (SIGINT, SIGTERM):
+        signal(sig, lambda sig, frame: agent.stop())
+
+    agent.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import RetryAfter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# the lower the value, the sooner the request is sent
+PRIORITY_ALERT = 0
+PRIORITY_MEDIA = 1
+PRIORITY_STATUS = 2
+PRIORITY_MENU = 3
+
+# times a request is sent again after Telegram has asked to wait (RetryAfter)
+MAXIMUM_FLOOD_RETRIES = 5
+
+
+class TokenBucket:
+    """ Allows 'rate' requests per second on average and bursts of up to 'capacity' requests """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+
+    def time_until_available(self):
+        """ Seconds until a request can be made (0 if it can be made right now) """
+
+        self._refill()
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self._tokens -= 1
+
+
+class _Request:
+
+    def __init__(self, priority, sequence, chat_id, function, args, kwargs, text=None):
+        self.priority = priority
+        self.sequence = sequence
+        self.chat_id = chat_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        # only plain status texts can be merged with the ones next to them
+        self.text = text
+        self.future = Future()
+        self.submitted_time = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class Outbox:
+    """ Every request to the Bot API is made from the threads of the outbox. The requests are
+        sent by priority (alerts, media, status texts and, at last, menu refreshes) and the
+        number of requests per chat is limited so that Telegram does not refuse them.
+        Requests to different chats are sent in parallel by 'workers' threads, but the ones
+        to the same chat are sent one after another, in order.
+        Each submitted request returns a Future with the reply of Telegram. Its 'sent_time'
+        is the time.monotonic() at which the request was really made (after waiting in the
+        queue and for the limits) """
+
+    def __init__(self, rate=1.0, burst=5, workers=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._finished = False
+
+        # chats which have a request being sent
+        self._busy_chats = set()
+        self._workers = [threading.Thread(target=self._work, name=f"outbox-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, priority, chat_id, function, *args, **kwargs):
+        """ Queues the call function(chat_id, *args, **kwargs) """
+
+        return self._put(_Request(priority, next(self._sequence), chat_id, function, args, kwargs))
+
+    def submit_text(self, priority, chat_id, function, text, **kwargs):
+        """ Like 'submit' but, if 'text' is a plain status message, it can be merged with
+            the status messages queued right after it (as long as the result fits in a
+            message of Telegram) """
+
+        mergeable = priority == PRIORITY_STATUS and not kwargs
+        return self._put(_Request(priority, next(self._sequence), chat_id, function, (text,),
+                                  kwargs, text if mergeable else None))
+
+    def _put(self, request):
+        with self._condition:
+            heapq.heappush(self._queue, request)
+            self._condition.notify_all()
+        return request.future
+
+    def _bucket(self, chat_id):
+        if chat_id not in self._buckets:
+            self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return self._buckets[chat_id]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                requests = self._next_requests()
+                if requests is None:
+                    return
+                chat_id = requests[0].chat_id
+                self._busy_chats.add(chat_id)
+
+            try:
+                self._perform(requests)
+            finally:
+                with self._condition:
+                    self._busy_chats.discard(chat_id)
+                    self._condition.notify_all()
+
+    def _next_requests(self):
+        """ Waits until a request can be sent and takes it out of the queue (together with the
+            status texts it is merged with). Returns None when the outbox has been stopped """
+
+        while True:
+            if not self._queue:
+                if self._finished:
+                    return None
+                self._condition.wait()
+                continue
+
+            # the most urgent request of a chat which is neither busy nor over its limit
+            wait_time = None
+            for request in sorted(self._queue):
+                if request.chat_id in self._busy_chats:
+                    continue
+                bucket = self._bucket(request.chat_id)
+                request_wait_time = bucket.time_until_available()
+                if request_wait_time == 0:
+                    break
+                wait_time = min(wait_time or request_wait_time, request_wait_time)
+            else:
+                # something more urgent could arrive (or a chat could stop being busy) meanwhile
+                self._condition.wait(wait_time)
+                continue
+
+            self._queue.remove(request)
+            requests = [request]
+            if request.text is not None:
+                length = len(request.text)
+                for other in sorted(self._queue):
+                    if other.priority != request.priority or other.chat_id != request.chat_id:
+                        continue
+                    # Telegram would refuse the whole message (and every merged text with it)
+                    if other.text is None or length + 1 + len(other.text) > MAX_MESSAGE_LENGTH:
+                        break
+                    length += 1 + len(other.text)
+                    self._queue.remove(other)
+                    requests.append(other)
+            heapq.heapify(self._queue)
+
+            bucket.consume()
+            return requests
+
+    def _perform(self, requests):
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+
+        first = requests[0]
+        method = getattr(first.function, "__name__", "unknown")
+        REGISTRY.histogram("outbox_queue_seconds", "Time the requests wait in the outbox",
+                           priority=first.priority).observe(time.monotonic() - first.submitted_time)
+        args = first.args
+        if len(requests) > 1:
+            args = ("\n".join(request.text for request in requests),)
+
+        for attempt in range(MAXIMUM_FLOOD_RETRIES + 1):
+            sent_time = time.monotonic()
+            for request in requests:
+                request.future.sent_time = sent_time
+            try:
+                with REGISTRY.time("bot_api_request_seconds", "Duration of the requests to the Bot API",
+                                   method=method):
+                    result = first.function(first.chat_id, *args, **first.kwargs)
+                break
+            except RetryAfter as exc:
+                REGISTRY.counter("bot_api_flood_waits_total", "Times Telegram has asked to wait").inc()
+                if attempt == MAXIMUM_FLOOD_RETRIES:
+                    result = exc
+                    break
+                logger.warning(f"Flood limit reached. Waiting {exc.retry_after}s")
+                # nothing else is sent meanwhile. Telegram would refuse it too
+                time.sleep(exc.retry_after)
+            except Exception as exc:
+                result = exc
+                break
+
+        for request in requests:
+            if isinstance(result, Exception):
+                request.future.set_exception(result)
+            else:
+                request.future.set_result(result)
+
+        if isinstance(result, Exception):
+            REGISTRY.counter("bot_api_errors_total", "Requests to the Bot API which failed",
+                             method=method).inc()
+            logger.warning(f"Request to the Bot API failed: {result!r}")
+
+    def stop(self):
+        """ Sends the requests left and waits for the threads to finish """
+
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,160 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from telegram.error import TelegramError
+
+import helper
+
+logger = logging.getLogger(__name__)
+
+
+def parse_quiet_hours(quiet_hours):
+    """ Converts a string like '23:00-07:00,13:30-15:00' into a list of (start, end)
+        tuples measured in minutes since midnight """
+
+    windows = []
+    for window in filter(None, (window.strip() for window in quiet_hours.split(","))):
+        start, end = window.split("-")
+        windows.append(tuple(int(hours) * 60 + int(minutes)
+                             for hours, minutes in (start.split(":"), end.split(":"))))
+
+    return windows
+
+
+def is_quiet_time(windows, now=None):
+    current_time = time.localtime(now)
+    minutes = current_time.tm_hour * 60 + current_time.tm_min
+
+    for start, end in windows:
+        # a window can go through midnight (23:00-07:00)
+        if start <= minutes < end or (end < start and (minutes >= start or minutes < end)):
+            return True
+
+    return False
+
+
+class PollingScheduler(threading.Thread):
+    """ Gets the updates from Telegram (like Updater.start_polling does) and puts them in the
+        queue of the dispatcher, but the time between requests depends on the activity:
+
+        - right after an update ('active_window' seconds): 'getUpdates' is called again as
+          soon as it returns, with a 'timeout' seconds long polling.
+        - during the quiet hours: there is a 'quiet_gap' seconds pause between requests, which
+          last 'quiet_timeout' seconds.
+        - the rest of the time: there is a 'idle_gap' seconds pause between requests, which
+          last 'idle_timeout' seconds.
+
+        Only inbound updates are slowed down. Alerts are sent by the outbox as usual """
+
+    def __init__(self, bot, update_queue, timeout, read_latency, active_window, idle_timeout, idle_gap,
+                 quiet_hours, quiet_timeout, quiet_gap, *args, on_first_request=None, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+
+        self.bot = bot
+        self.update_queue = update_queue
+        self.timeout = timeout
+        self.read_latency = read_latency
+        self.active_window = active_window
+        self.idle_timeout = idle_timeout
+        self.idle_gap = idle_gap
+        self.quiet_hours = parse_quiet_hours(quiet_hours)
+        self.quiet_timeout = quiet_timeout
+        self.quiet_gap = quiet_gap
+
+        self._offset = None
+        self._last_activity_time = time.monotonic()
+        self._finished = threading.Event()
+
+        self.requests = 0
+        # requests a fixed 'timeout' seconds long polling would have done in the same time
+        self._baseline_requests = 0.0
+        # set when the first 'getUpdates' request is made. Then, 'on_first_request' is called
+        self.first_request_time = None
+        self._on_first_request = on_first_request
+        self.start()
+
+    def notify_activity(self):
+        """ Polls as fast as possible for a while. Something (an alert, for instance) is
+            likely to be answered soon """
+
+        self._last_activity_time = time.monotonic()
+
+    def current_schedule(self):
+        """ Returns the timeout of the next request and the pause after it if it brings nothing """
+
+        if time.monotonic() - self._last_activity_time < self.active_window:
+            return self.timeout, 0
+        if is_quiet_time(self.quiet_hours):
+            return self.quiet_timeout, self.quiet_gap
+        return self.idle_timeout, self.idle_gap
+
+    @property
+    def requests_avoided(self):
+        return max(0, int(self._baseline_requests) - self.requests)
+
+    def run(self):
+        # updates cannot be polled while there is a webhook
+        failures = 0
+        while not self._finished.is_set():
+            try:
+                self.bot.delete_webhook()
+                break
+            except TelegramError as exc:
+                failures += 1
+                logger.warning(f"The webhook could not be deleted: {exc!r}")
+                self._finished.wait(helper.backoff_delay(failures, 1, 30))
+
+        failures = 0
+        while not self._finished.is_set():
+            timeout, gap = self.current_schedule()
+            start_time = time.monotonic()
+            if self.first_request_time is None:
+                self.first_request_time = start_time
+                if self._on_first_request is not None:
+                    self._on_first_request()
+
+            try:
+                self.requests += 1
+                updates = self.bot.get_updates(offset=self._offset, timeout=timeout,
+                                               read_latency=self.read_latency)
+                failures = 0
+            except TelegramError as exc:
+                failures += 1
+                logger.warning(f"Error while getting updates: {exc!r}")
+                self._finished.wait(helper.backoff_delay(failures, 1, 30))
+                continue
+
+            if updates:
+                self.notify_activity()
+                self._offset = updates[-1].update_id + 1
+                for update in updates:
+                    self.update_queue.put(update)
+                self._baseline_requests += 1
+                continue
+
+            self._finished.wait(gap)
+            self._baseline_requests += (time.monotonic() - start_time) / self.timeout
+
+    def stop(self):
+        """ Stops polling. The request in progress is not waited for """
+
+        self._finished.set()
+        logger.info(f"Polling stopped after {self.requests} requests "
+                    f"({self.requests_avoided} avoided)")
@@ -0,0 +1,212 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Protocol spoken between the hub and the nodes (see hub.py and node.py) over TCP.
+
+    Every frame is a 4 bytes big-endian length, a JSON header of that length and, if the
+    header has a 'size', that number of raw bytes (a piece of a photo or a video, for instance,
+    never bigger than MAXIMUM_DATA_SIZE). Only chunks carry raw bytes:
+
+    - challenge: {"type": "challenge", "nonce": random text}   (hub -> node, right after connecting)
+    - hello:    {"type": "hello", "node": name, "proof": hello_proof(...), ...}   (node -> hub)
+    - request:  {"type": "request", "id": n, "method": name, "params": {...}}
+    - chunk:    {"type": "chunk", "id": n, "size": k} + k bytes   (part of the result)
+    - response: {"type": "response", "id": n, "result": ..., "error": null or text}
+    - event:    {"type": "event", ...}   (node -> hub, no response) """
+
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+HEADER_LENGTH = struct.Struct(">I")
+# no header is that big. Anything longer means the other end does not speak this protocol
+MAXIMUM_HEADER_SIZE = 64 * 1024
+# the raw bytes of a frame are never more than this. Bigger pieces of media are split
+MAXIMUM_DATA_SIZE = 1024 * 1024
+
+
+def hello_proof(secret, nonce, node):
+    """ Shows that the node knows the shared secret without sending it: an HMAC of the
+        nonce the hub has just chosen, which is useless for any other connection """
+
+    return hmac.new(secret.encode(), f"{node}:{nonce}".encode(), hashlib.sha256).hexdigest()
+
+
+class RpcError(Exception):
+    """ The other end could not do what was asked """
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+class Connection:
+    """ A socket which sends and receives frames. Frames can be sent from any thread """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = sock.makefile("rb")
+        self._write_lock = threading.Lock()
+
+    def send(self, header, data=b""):
+        if data:
+            header = dict(header, size=len(data))
+        encoded_header = json.dumps(header).encode()
+
+        with self._write_lock:
+            self.sock.sendall(HEADER_LENGTH.pack(len(encoded_header)) + encoded_header)
+            if data:
+                self.sock.sendall(data)
+
+    def receive(self, maximum_data_size=MAXIMUM_DATA_SIZE):
+        """ Returns the next frame as (header, data). Raises ConnectionClosed when the other
+            end closes the connection or sends a frame with more than 'maximum_data_size'
+            bytes of data (0 if no data is expected, like before the hello) """
+
+        length = self._read_exactly(HEADER_LENGTH.size)
+        length, = HEADER_LENGTH.unpack(length)
+        if length > MAXIMUM_HEADER_SIZE:
+            raise ConnectionClosed(f"Header too long ({length} bytes)")
+
+        header = json.loads(self._read_exactly(length))
+        if not isinstance(header, dict):
+            raise ConnectionClosed("The header is not a JSON object")
+
+        size = header.get("size") or 0
+        if not isinstance(size, int) or not 0 <= size <= maximum_data_size:
+            raise ConnectionClosed(f"Unexpected size of the data ({size!r} bytes)")
+
+        data = self._read_exactly(size) if size else b""
+        return header, data
+
+    def _read_exactly(self, size):
+        data = self._reader.read(size)
+        if len(data) < size:
+            raise ConnectionClosed("The connection has been closed")
+        return data
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ChunkWriter:
+    """ File-like object which sends what is written into it as chunks of the result of
+        a request, so media goes through the network while it is being produced """
+
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+
+    def write(self, data):
+        # the other end does not accept frames with more than MAXIMUM_DATA_SIZE bytes
+        data = memoryview(data).cast("B")
+        for start in range(0, len(data), MAXIMUM_DATA_SIZE):
+            self.connection.send({"type": "chunk", "id": self.request_id},
+                                 bytes(data[start:start + MAXIMUM_DATA_SIZE]))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _PendingCall:
+
+    def __init__(self, output):
+        self.output = output
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Caller:
+    """ Makes requests through a connection and waits for their responses. 'receive_loop'
+        must be run by a thread. Frames which are not responses are given to 'on_frame' """
+
+    def __init__(self, connection, on_frame=None):
+        self.connection = connection
+        self.on_frame = on_frame
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def call(self, method, timeout=None, output=None, **params):
+        """ Returns the result of 'method'. The chunks of the result are written into
+            'output' while they arrive """
+
+        request_id = next(self._ids)
+        pending = _PendingCall(output)
+        with self._lock:
+            if self.closed:
+                raise ConnectionClosed("The connection has been closed")
+            self._pending[request_id] = pending
+
+        try:
+            self.connection.send({"type": "request", "id": request_id, "method": method, "params": params})
+            if not pending.done.wait(timeout):
+                raise TimeoutError(f"'{method}' has not answered in {timeout}s")
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+        if pending.error is not None:
+            if isinstance(pending.error, Exception):
+                raise pending.error
+            raise RpcError(pending.error)
+        return pending.result
+
+    def receive_loop(self):
+        try:
+            while True:
+                header, data = self.connection.receive()
+                frame_type = header.get("type")
+
+                if frame_type in ("chunk", "response"):
+                    with self._lock:
+                        pending = self._pending.get(header.get("id"))
+                    if pending is None:
+                        continue
+                    if frame_type == "chunk":
+                        if pending.output is not None:
+                            pending.output.write(data)
+                    else:
+                        pending.result = header.get("result")
+                        pending.error = header.get("error")
+                        pending.done.set()
+                elif self.on_frame is not None:
+                    self.on_frame(header, data)
+        except (OSError, ValueError) as exc:
+            logger.info(f"Connection closed: {exc!r}")
+        finally:
+            with self._lock:
+                self.closed = True
+                pending_calls = list(self._pending.values())
+            for pending in pending_calls:
+                pending.error = ConnectionClosed("The connection has been closed")
+                pending.done.set()
+            self.connection.close()
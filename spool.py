@@ -0,0 +1,201 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from telegram.error import NetworkError
+
+import helper
+
+logger = logging.getLogger(__name__)
+
+
+class UploadSpool(threading.Thread):
+    """ Keeps in disk the media which could not be sent (a video recorded during a Wi-Fi
+        drop, for instance) and tries to send it again from this thread, oldest first,
+        waiting more and more between attempts while the network is down.
+
+        Each entry is made of two files: '<name>.data' with the media and '<name>.json'
+        with the name of the method of 'sender' which sends it and its arguments.
+        The spool never holds more than 'max_bytes' bytes nor media older than 'max_age'
+        seconds: the oldest entries are removed first """
+
+    def __init__(self, sender, directory, max_bytes, max_age, retry_delay, max_retry_delay,
+                 *args, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+
+        self._sender = sender
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._finished = False
+        self._online = False
+        self.start()
+
+    def add(self, sending_func_name, stream, **kwargs):
+        """ Stores the content of 'stream' so that 'sender.<sending_func_name>(stream, **kwargs)'
+            is called later """
+
+        created = time.time()
+        name = os.path.join(self.directory, f"{created:.6f}_{next(self._counter)}")
+
+        try:
+            stream.seek(0)
+            # the data is written before the metadata, which is what makes the entry visible
+            with open(f"{name}.data", "wb") as data_file:
+                shutil.copyfileobj(stream, data_file, helper.CHUNK_SIZE)
+
+            metadata = {"function": sending_func_name, "kwargs": kwargs, "created": created}
+            with open(f"{name}.json.tmp", "w") as metadata_file:
+                json.dump(metadata, metadata_file)
+            os.replace(f"{name}.json.tmp", f"{name}.json")
+
+            logger.info(f"'{sending_func_name}' stored in the spool")
+            self._evict()
+        except Exception as exc:
+            # the media is lost, but whoever sent it must go on (the lamp has to be switched
+            # back to normal mode, for instance)
+            logger.error(f"'{sending_func_name}' could not be stored in the spool: {exc!r}")
+            self._remove(name)
+            return
+
+        with self._condition:
+            self._condition.notify()
+
+    def notify_online(self):
+        """ Tells the spool that something has just been sent, so the network is up again """
+
+        with self._condition:
+            self._online = True
+            self._condition.notify()
+
+    def _entries(self):
+        """ Returns the entries as (time of creation, name without extension), oldest first """
+
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            name = file_name[:-len(".json")]
+            try:
+                created = float(name.split("_")[0])
+            except ValueError:
+                # not an entry of the spool, so it is left alone
+                continue
+            entries.append((created, os.path.join(self.directory, name)))
+
+        entries.sort()
+        return entries
+
+    def _remove(self, name):
+        for extension in (".json", ".json.tmp", ".data"):
+            try:
+                os.remove(name + extension)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        entries = self._entries()
+        sizes = {}
+        for _, name in entries:
+            try:
+                sizes[name] = os.path.getsize(f"{name}.data")
+            except FileNotFoundError:
+                sizes[name] = 0
+
+        total_size = sum(sizes.values())
+        oldest_allowed = time.time() - self.max_age
+        for created, name in entries:
+            if total_size <= self.max_bytes and created >= oldest_allowed:
+                break
+
+            logger.warning(f"Evicting '{name}' from the spool")
+            self._remove(name)
+            total_size -= sizes[name]
+
+    def run(self):
+        failures = 0
+        while True:
+            with self._condition:
+                if self._finished:
+                    return
+
+            try:
+                self._evict()
+                entries = self._entries()
+                if entries and self._send(entries[0][1]):
+                    failures = 0
+                    continue
+                pending = bool(entries)
+            except Exception:
+                # the spool must keep trying (the SD card could be failing only for a while)
+                logger.exception("Error flushing the spool")
+                pending = True
+
+            delay = None
+            if pending:
+                failures += 1
+                delay = helper.backoff_delay(failures, self.retry_delay, self.max_retry_delay)
+
+            # wait until something is added, something else is sent or it is time to try again
+            with self._condition:
+                if not self._finished and not self._online:
+                    self._condition.wait(delay)
+                if self._online:
+                    failures = 0
+                self._online = False
+
+    def _send(self, name):
+        """ Tries to send an entry. Returns False if it has to be tried again later """
+
+        try:
+            with open(f"{name}.json") as metadata_file:
+                metadata = json.load(metadata_file)
+
+            kwargs = metadata["kwargs"]
+            if "caption" not in kwargs:
+                kwargs["caption"] = time.strftime("Grabado el %d/%m/%Y a las %H:%M:%S",
+                                                  time.localtime(metadata["created"]))
+
+            with open(f"{name}.data", "rb") as data_file:
+                getattr(self._sender, metadata["function"])(data_file, **kwargs).result()
+        except NetworkError:
+            return False
+        except Exception as exc:
+            # this entry will never be sent
+            logger.error(f"Discarding '{name}' from the spool: {exc!r}")
+
+        self._remove(name)
+        return True
+
+    def stop(self):
+        with self._condition:
+            self._finished = True
+            self._condition.notify()
+        self.join()
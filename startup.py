@@ -0,0 +1,95 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+def _read_uptimes():
+    """ Returns the seconds since the system booted and the seconds since this process started
+        (None, None if they cannot be known, like outside Linux) """
+
+    try:
+        with open("/proc/uptime") as uptime_file:
+            system_uptime = float(uptime_file.read().split()[0])
+        with open("/proc/self/stat") as stat_file:
+            # the name of the process can have spaces, so the fields are counted after it.
+            # The start time (field 22) is measured in clock ticks since the system booted
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        process_start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+    return system_uptime, system_uptime - process_start
+
+
+class StartupTimer:
+    """ Remembers when each stage of the start has been reached, measured from the moment the
+        process was started (not from when this module was imported, so the time spent by the
+        interpreter and the imports is also counted) """
+
+    def __init__(self):
+        system_uptime, process_age = _read_uptimes()
+        now = time.monotonic()
+        self.start_time = now - (process_age or 0)
+        # seconds between the boot of the system and the start of the process. After a
+        # reboot, this is what the init system has taken to start the bot
+        self.boot_delay = None if system_uptime is None else system_uptime - process_age
+
+        self._stages = []
+        self._lock = threading.Lock()
+
+    def mark(self, stage):
+        """ Records that 'stage' has been reached. Returns the seconds since the process started """
+
+        elapsed_time = time.monotonic() - self.start_time
+        with self._lock:
+            if any(name == stage for name, _ in self._stages):
+                return elapsed_time
+            self._stages.append((stage, elapsed_time))
+
+        REGISTRY.gauge("startup_seconds", "Seconds from the start of the process to each stage",
+                       stage=stage).set(round(elapsed_time, 3))
+        return elapsed_time
+
+    def report(self):
+        """ Text with the time at which every stage was reached and how long it took """
+
+        parts = []
+        if self.boot_delay is not None:
+            parts.append(f"boot -> process: {self.boot_delay:.2f}s")
+
+        previous_time = 0
+        with self._lock:
+            stages = list(self._stages)
+        for stage, elapsed_time in stages:
+            parts.append(f"{stage}: {elapsed_time:.2f}s (+{elapsed_time - previous_time:.2f}s)")
+            previous_time = elapsed_time
+
+        return ", ".join(parts)
+
+    def log(self, message):
+        logger.info(f"{message}. {self.report()}")
+
+
+# the whole process shares it
+STARTUP = StartupTimer()
@@ -0,0 +1,92 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The tests run without a Raspberry Pi: the pins are the mock pins of gpiozero and the
+    camera is the fake one of benchmark.py """
+
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# constants.py reads the configuration when it is imported
+_work_directory = tempfile.mkdtemp(prefix="bro-tests-")
+os.environ.setdefault("TOKEN", "123456:tests")
+os.environ.setdefault("GROUP_CHAT_ID", "-1")
+os.environ.setdefault("SPOOL_DIR", os.path.join(_work_directory, "spool"))
+os.environ.setdefault("HISTORY_DB", os.path.join(_work_directory, "history.db"))
+os.environ.setdefault("ARCHIVE_DIR", os.path.join(_work_directory, "archive"))
+# the relays of the lamps do not need to wait that long for the mock pins
+os.environ.setdefault("DELAY_RELAYS", "0.05")
+
+import benchmark
+
+# even on a Pi, the tests never touch the real camera
+benchmark.install_fake_picamera(2000000)
+
+
+@pytest.fixture
+def mock_pins():
+    """ Every gpiozero device created by the test uses a mock pin """
+
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory
+
+    previous_factory = Device.pin_factory
+    Device.pin_factory = MockFactory()
+    yield Device.pin_factory
+    Device.pin_factory.reset()
+    Device.pin_factory = previous_factory
+
+
+@pytest.fixture
+def bot_api():
+    """ Local server which answers like the Bot API (see benchmark.FakeBotApi) """
+
+    api = benchmark.FakeBotApi(latency=0, upload_bandwidth=0)
+    thread = threading.Thread(target=api.serve_forever, daemon=True)
+    thread.start()
+    yield api
+    api.shutdown()
+    api.server_close()
+
+
+@pytest.fixture
+def make_bro(bot_api, monkeypatch, tmp_path):
+    """ Creates FourthBrother objects which talk to 'bot_api' and have no zones (by default,
+        only the chat of the benchmark is authorized). They are stopped at the end of the test """
+
+    import bro
+    import constants
+
+    monkeypatch.setattr(constants, "BOT_API_URL", bot_api.base_url)
+    monkeypatch.setattr(constants, "SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(constants, "HISTORY_DB", str(tmp_path / "history.db"))
+    monkeypatch.setattr(constants, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    created = []
+
+    def make(zones_config=(), authorized_chats=benchmark.BENCH_CHAT_ID, **kwargs):
+        instance = bro.FourthBrother(benchmark.BENCH_TOKEN, authorized_chats, list(zones_config), **kwargs)
+        created.append(instance)
+        return instance
+
+    yield make
+    for instance in created:
+        instance._on_exit()
@@ -0,0 +1,79 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from io import BytesIO
+
+import benchmark
+import constants
+import helper
+import outbox
+
+ALERTS_CHAT_ID = -2000
+OTHER_CONTROL_CHAT_ID = -3000
+AUTHORIZED_CHATS = {benchmark.BENCH_CHAT_ID: {constants.PERMISSION_CONTROL},
+                    ALERTS_CHAT_ID: {constants.PERMISSION_ALERTS},
+                    OTHER_CONTROL_CHAT_ID: {constants.PERMISSION_CONTROL}}
+
+
+def _requests(bot_api, method, count, timeout=5):
+    """ Waits until 'count' requests of 'method' have arrived and returns them as {chat id: size} """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        requests = {int(request[2]): request[4] for request in bot_api.requests if request[1] == method}
+        if len(requests) >= count or time.monotonic() > deadline:
+            return requests
+        time.sleep(0.02)
+
+
+def test_media_is_uploaded_once(make_bro, bot_api):
+    bro = make_bro(authorized_chats=AUTHORIZED_CHATS)
+    video = b"video" * 20000
+
+    bro.send_video(BytesIO(video)).result(5)
+
+    sizes = _requests(bot_api, "sendVideo", 3)
+    assert set(sizes) == set(AUTHORIZED_CHATS)
+    # the first chat gets the upload and the rest, the id Telegram gave to it
+    assert sizes[benchmark.BENCH_CHAT_ID] > len(video)
+    assert sizes[ALERTS_CHAT_ID] < 1000 and sizes[OTHER_CONTROL_CHAT_ID] < 1000
+
+
+def test_chats_of_alerts_only_get_alerts_and_media(make_bro, bot_api):
+    bro = make_bro(authorized_chats=AUTHORIZED_CHATS)
+
+    bro.send_message("estado").result(5)
+    bro.send_message("alerta", priority=outbox.PRIORITY_ALERT).result(5)
+
+    time.sleep(0.2)
+    texts = {}
+    for request in bot_api.requests:
+        if request[1] == "sendMessage":
+            texts.setdefault(request[3], set()).add(int(request[2]))
+    assert texts["estado"] == {benchmark.BENCH_CHAT_ID, OTHER_CONTROL_CHAT_ID}
+    assert texts["alerta"] == set(AUTHORIZED_CHATS)
+
+
+def test_bot_without_control_chats_only_sends_alerts(make_bro, bot_api):
+    bro = make_bro(authorized_chats=helper.parse_authorized_chats(f"{ALERTS_CHAT_ID}:alerts"))
+
+    # nobody receives the status messages
+    assert bro.send_message("estado").result(5) is None
+    bro.send_message("alerta", priority=outbox.PRIORITY_ALERT).result(5)
+
+    texts = [(int(request[2]), request[3]) for request in bot_api.requests if request[1] == "sendMessage"]
+    assert texts == [(ALERTS_CHAT_ID, "alerta")]
@@ -0,0 +1,169 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The camera is the fake one of benchmark.py (see conftest.py) """
+
+import time
+from io import BytesIO
+
+import pytest
+from picamera import PiCamera
+
+import camera_arbiter
+import camera_power
+import mp4
+
+RESOLUTION = (576, 288)
+
+
+@pytest.fixture
+def power():
+    instance = camera_power.CameraPower(30, RESOLUTION, idle_timeout=0, cold_settle=0, warm_settle=0)
+    yield instance
+    instance.close()
+
+
+@pytest.fixture
+def arbiter(power):
+    instance = camera_arbiter.CameraArbiter(power, 4 * 1024 * 1024)
+    yield instance
+    instance.disarm()
+
+
+def encoder_resolution(power):
+    sps_info = mp4.parse_sps(power.camera._encoders[camera_arbiter.VIDEO_PORT]._sps[4:])
+    return sps_info["width"], sps_info["height"]
+
+
+def test_new_arm_settings_wait_for_the_end_of_the_next_video(arbiter, power):
+    arbiter.arm(1000000, None)
+    preroll_stream = arbiter._preroll_stream
+    time.sleep(1.2)
+
+    arbiter.update_arm_settings(500000, (288, 144))
+    # the footage of the circular buffer is still there for the next video
+    assert arbiter._preroll_stream is preroll_stream
+    assert arbiter.arm_settings == (1000000, None)
+
+    start_time = time.monotonic()
+    video = BytesIO()
+    arbiter.record(video, 0.2, preroll=1)
+    assert time.monotonic() - start_time < 1
+    # the preroll comes first: it is not the only keyframe of the video
+    assert video.getvalue().count(b"\x00\x00\x00\x01\x65") > 1
+    assert mp4.parse_sps(video.getvalue()[4:40])["width"] == RESOLUTION[0]
+
+    # the video is over, so the encoder restarts with the new settings
+    assert arbiter.arm_settings == (500000, (288, 144))
+    assert arbiter._preroll_stream is not preroll_stream
+    assert encoder_resolution(power) == (288, 144)
+    assert arbiter.is_armed
+
+
+def test_same_arm_settings_keep_the_encoder(arbiter, power):
+    arbiter.arm(1000000, None)
+    preroll_stream = arbiter._preroll_stream
+
+    arbiter.update_arm_settings(1000000, None)
+    arbiter.record(BytesIO(), 0.1)
+
+    assert arbiter._preroll_stream is preroll_stream
+    assert encoder_resolution(power) == RESOLUTION
+
+
+def test_arm_settings_of_a_disarmed_camera_are_ignored(arbiter):
+    arbiter.update_arm_settings(500000, (288, 144))
+    arbiter.arm(1000000, None)
+    arbiter.record(BytesIO(), 0.1)
+
+    assert arbiter.arm_settings == (1000000, None)
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class RecordingCamera(PiCamera):
+    """ Fake camera which remembers the settings it is given, in order """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settings = []
+
+    def __setattr__(self, name, value):
+        if name != "settings" and hasattr(self, "settings"):
+            self.settings.append((name, value))
+        super().__setattr__(name, value)
+
+
+def test_warm_wake_starts_from_the_cached_gains(monkeypatch):
+    monkeypatch.setattr(camera_power, "PiCamera", RecordingCamera)
+    power = camera_power.CameraPower(30, RESOLUTION, idle_timeout=0.1, cold_settle=0.3, warm_settle=0.05)
+    try:
+        power.wake()
+        assert power.last_wake_seconds >= 0.3
+        assert ("awb_mode", "off") not in power.camera.settings
+
+        # what the automatic exposure and white balance have reached
+        power.camera.exposure_speed = 12345
+        power.camera.awb_gains = (2.0, 1.1)
+        power.camera.analog_gain = 3.0
+        power.camera.digital_gain = 1.5
+        assert _wait_until(lambda: not power.is_open)
+
+        power.wake()
+        assert power.last_wake_seconds < 0.2
+        assert power.camera.settings == [("rotation", 0), ("shutter_speed", 12345), ("awb_mode", "off"),
+                                         ("awb_gains", (2.0, 1.1)), ("analog_gain", 3.0),
+                                         ("digital_gain", 1.5),
+                                         # and the automatic algorithms go on from there
+                                         ("shutter_speed", 0), ("awb_mode", "auto")]
+    finally:
+        power.close()
+
+
+def test_idle_camera_is_closed_unless_it_is_kept_warm():
+    power = camera_power.CameraPower(30, RESOLUTION, idle_timeout=0.1, cold_settle=0, warm_settle=0)
+    try:
+        with power.use():
+            time.sleep(0.3)
+            # it is not closed while it is being used
+            assert power.is_open
+        assert _wait_until(lambda: not power.is_open)
+
+        # the first reason opens it right away
+        power.keep_warm("alarm")
+        assert power.is_open
+        power.keep_warm("armed")
+        power.keep_warm("alarm", False)
+        time.sleep(0.3)
+        assert power.is_open
+
+        power.keep_warm("armed", False)
+        assert _wait_until(lambda: not power.is_open)
+    finally:
+        power.close()
+
+
+def test_camera_without_idle_timeout_is_never_closed(power):
+    power.wake()
+    time.sleep(0.2)
+    assert power.is_open
@@ -0,0 +1,124 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import pytest
+
+import constants
+import events
+import handlers
+
+
+@pytest.fixture
+def bus():
+    instance = events.EventBus(max_pending=4, merge_window=0.5, workers=2)
+    yield instance
+    instance.stop()
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_handlers_of_the_same_event_do_not_overlap(bus):
+    release = threading.Event()
+    calls = []
+
+    def slow_handler():
+        calls.append(time.monotonic())
+        release.wait(5)
+
+    bus.subscribe("pir", "when_activated", slow_handler)
+    bus.publish("pir", "when_activated")
+    assert _wait_until(lambda: len(calls) == 1)
+
+    # it waits for the first one, and the third one is merged into it
+    bus.publish("pir", "when_activated")
+    bus.publish("pir", "when_activated")
+    time.sleep(0.1)
+    assert len(calls) == 1
+
+    release.set()
+    assert _wait_until(lambda: len(calls) == 2)
+    assert bus.merged == 1
+
+
+def test_immediate_handlers_are_not_delayed_by_a_running_handler(bus):
+    release = threading.Event()
+    started = threading.Event()
+    immediate_calls = []
+
+    bus.subscribe("pir", "when_activated", lambda: started.set() or release.wait(5))
+    bus.subscribe("pir", "when_activated", lambda: immediate_calls.append(1), immediate=True)
+
+    bus.publish("pir", "when_activated")
+    assert started.wait(5)
+    bus.publish("pir", "when_activated")
+
+    # while the first trigger is still being handled
+    assert immediate_calls == [1, 1]
+    release.set()
+
+
+def test_full_queue_drops_events(bus):
+    release = threading.Event()
+    bus.merge_window = 0
+    bus.subscribe("button", "when_pressed", lambda: release.wait(5))
+    bus.subscribe("door", "when_pressed", lambda: release.wait(5))
+
+    # one event of each device is being handled and 4 wait
+    bus.publish("button", "when_pressed")
+    bus.publish("door", "when_pressed")
+    for _ in range(4 + 3):
+        time.sleep(0.01)
+        bus.publish("button", "when_pressed")
+
+    assert bus.dropped == 3
+    release.set()
+
+
+def test_lamp_is_switched_on_while_an_alert_is_handled(make_bro, mock_pins, monkeypatch):
+    monkeypatch.setattr(constants, "CAMERA_COLD_SETTLE", 0)
+    bro = make_bro([{"name": "garaje", "pins": {"PIR_SENSOR": 17, "RELAY_A": 22, "RELAY_B": 23},
+                     "lamp_on_time": 1, "camera": False, "node": ""}])
+    handling = threading.Event()
+    release = threading.Event()
+
+    def slow_movement_handler(bro, zone):
+        # the video of the first trigger, for instance
+        handling.set()
+        release.wait(5)
+
+    bro.add_handler_to_zones("pir_sensor", immediate=True, when_activated=handlers.movement_lamp_handler)
+    bro.add_handler_to_zones("pir_sensor", when_activated=slow_movement_handler)
+    bro.init_hardware()
+    zone = bro.zones[0]
+    zone.movement_activated = False
+    zone.pir_sensor.when_activated()
+    assert handling.wait(5)
+
+    zone.movement_activated = True
+    zone.pir_sensor.when_activated()
+    assert _wait_until(lambda: not zone.is_normal_mode)
+    assert not release.is_set()
+    release.set()
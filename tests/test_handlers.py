@@ -0,0 +1,148 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import benchmark
+import constants
+import handlers
+import history
+
+CAMERA_ZONE = {"name": "entrada", "pins": {"PIR_SENSOR": 17, "RELAY_A": 22, "RELAY_B": 23},
+               "lamp_on_time": 1, "camera": True, "node": ""}
+
+
+@pytest.fixture
+def alarm_bro(make_bro, mock_pins, monkeypatch):
+    monkeypatch.setattr(constants, "CAMERA_COLD_SETTLE", 0)
+    bro = make_bro([CAMERA_ZONE])
+    bro.init_hardware()
+    zone = bro.zones[0]
+    zone.pir_activated = True
+    zone.movement_activated = False
+    return bro
+
+
+def test_preview_is_taken_once_the_lamp_is_on(alarm_bro, monkeypatch):
+    zone = alarm_bro.zones[0]
+    lamp_when_taken = {}
+
+    def send_preview(alert_time=None):
+        lamp_when_taken["preview"] = zone.is_normal_mode, zone.lamp.relay_manual.value
+
+    def record_and_send_video(duration, inform=False, preroll=0):
+        lamp_when_taken["video"] = zone.is_normal_mode, zone.lamp.relay_manual.value
+
+    monkeypatch.setattr(alarm_bro, "send_preview", send_preview)
+    monkeypatch.setattr(alarm_bro, "record_and_send_video", record_and_send_video)
+
+    handlers.movement_handler(alarm_bro, zone)
+
+    # in manual mode, with the relay of manual mode on
+    assert lamp_when_taken == {"preview": (False, True), "video": (False, True)}
+
+
+@pytest.fixture
+def alert_log(alarm_bro, monkeypatch):
+    """ What the movement handler does, in order. The video is not recorded """
+
+    log = []
+    monkeypatch.setattr(alarm_bro, "send_message", lambda text, **kwargs: log.append(("message", text)))
+    monkeypatch.setattr(alarm_bro, "send_preview", lambda alert_time=None: log.append(("preview",)))
+    monkeypatch.setattr(alarm_bro, "record_and_send_video",
+                        lambda duration, inform=False, preroll=0: log.append(("video",)))
+    return log
+
+
+def test_lamp_is_on_before_the_camera_confirms_the_trigger(alarm_bro, alert_log, monkeypatch):
+    monkeypatch.setattr(constants, "MOTION_CONFIRMATION", "drop")
+    zone = alarm_bro.zones[0]
+
+    def confirm_movement():
+        alert_log.append(("confirm", zone.is_normal_mode, zone.lamp.relay_manual.value))
+        return True
+
+    monkeypatch.setattr(alarm_bro, "confirm_movement", confirm_movement)
+    handlers.movement_handler(alarm_bro, zone)
+
+    assert [entry[0] for entry in alert_log] == ["confirm", "message", "preview", "video"]
+    assert alert_log[0] == ("confirm", False, True)
+
+
+def test_unconfirmed_trigger_is_dropped_and_the_lamp_restored(alarm_bro, alert_log, monkeypatch):
+    monkeypatch.setattr(constants, "MOTION_CONFIRMATION", "drop")
+    monkeypatch.setattr(alarm_bro, "confirm_movement", lambda: False)
+    zone = alarm_bro.zones[0]
+    normal_mode_futures = []
+    real_change_to_normal_mode = zone.change_to_normal_mode
+
+    def change_to_normal_mode():
+        normal_mode_futures.append(real_change_to_normal_mode())
+        return normal_mode_futures[-1]
+
+    monkeypatch.setattr(zone, "change_to_normal_mode", change_to_normal_mode)
+
+    handlers.movement_handler(alarm_bro, zone)
+
+    assert alert_log == []
+    normal_mode_futures[0].result(5)
+    assert zone.is_normal_mode
+    pir_events = alarm_bro.history.query(0, time.time() + 1, kinds=[history.EVENT_PIR])
+    assert [event[3] for event in pir_events] == ["entrada, no confirmado"]
+
+
+def test_logged_confirmation_does_not_delay_the_alert(alarm_bro, alert_log, monkeypatch):
+    monkeypatch.setattr(constants, "MOTION_CONFIRMATION", "log")
+    answer = threading.Event()
+    confirmed = threading.Event()
+
+    def confirm_movement():
+        answer.wait(5)
+        confirmed.set()
+        return False
+
+    monkeypatch.setattr(alarm_bro, "confirm_movement", confirm_movement)
+    handlers.movement_handler(alarm_bro, alarm_bro.zones[0])
+
+    # neither the alert nor the video have waited for the camera, nor has the trigger been dropped
+    assert [entry[0] for entry in alert_log] == ["message", "preview", "video"]
+    assert not confirmed.is_set()
+
+    answer.set()
+    assert confirmed.wait(5)
+
+
+def test_lamp_is_restored_if_the_video_fails(alarm_bro, monkeypatch):
+    zone = alarm_bro.zones[0]
+
+    def record_and_send_video(duration, inform=False, preroll=0):
+        assert not zone.is_normal_mode
+        raise OSError("the camera has failed")
+
+    monkeypatch.setattr(alarm_bro, "send_preview", lambda alert_time=None: None)
+    monkeypatch.setattr(alarm_bro, "record_and_send_video", record_and_send_video)
+
+    with pytest.raises(OSError):
+        handlers.movement_handler(alarm_bro, zone)
+    assert benchmark.wait_until(lambda: zone.is_normal_mode, 5)
+
+    with pytest.raises(OSError):
+        handlers.video_command(alarm_bro, SimpleNamespace(effective_user=SimpleNamespace(first_name="Ana")))
+    assert benchmark.wait_until(lambda: zone.is_normal_mode, 5)
@@ -0,0 +1,87 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import time
+
+import handlers
+import history
+
+
+def test_foreign_files_of_the_archive_are_left_alone(tmp_path):
+    (tmp_path / "lost+found").mkdir()
+    (tmp_path / "notes.txt").write_text("notes")
+    archive = history.ClipArchive(str(tmp_path), max_bytes=1, max_age=3600)
+
+    archive.add(io.BytesIO(b"video"))
+
+    # the clip does not fit, but the rest is not a clip
+    assert sorted(os.listdir(tmp_path)) == ["lost+found", "notes.txt"]
+
+
+def test_least_recently_used_clips_go_first(tmp_path):
+    evicted = []
+    archive = history.ClipArchive(str(tmp_path), max_bytes=10, max_age=3600, on_evict=evicted.append)
+    first = archive.add(io.BytesIO(b"1" * 4))
+    second = archive.add(io.BytesIO(b"2" * 4))
+    # the first one is used, so the second one is the oldest
+    os.utime(tmp_path / second, (time.time() - 10, time.time() - 10))
+    archive.open(first).close()
+
+    third = archive.add(io.BytesIO(b"3" * 4))
+
+    assert evicted == [second]
+    assert sorted(os.listdir(tmp_path)) == sorted([first, third])
+
+
+def test_clip_too_old_is_evicted(tmp_path):
+    archive = history.ClipArchive(str(tmp_path), max_bytes=100, max_age=3600)
+    old = f"{time.time() - 7200:.6f}.mp4"
+    (tmp_path / old).write_bytes(b"old")
+
+    new = archive.add(io.BytesIO(b"new"))
+
+    assert os.listdir(tmp_path) == [new]
+
+
+def test_archive_failures_do_not_lose_the_event(make_bro, monkeypatch):
+    bro = make_bro()
+
+    def broken_add(stream, extension="mp4"):
+        raise ValueError("broken archive")
+
+    monkeypatch.setattr(bro.clip_archive, "add", broken_add)
+    bro._archive_clip(io.BytesIO(b"video"), 10)
+
+    event = bro.history.query(0, time.time() + 1)[-1]
+    assert event[2:] == (history.EVENT_VIDEO, "10s", None)
+
+
+def test_spooled_clip_is_not_reported_as_missing(make_bro, monkeypatch):
+    bro = make_bro()
+    bro._archive_clip(io.BytesIO(b"video"), 10)
+    event_id = bro.history.query(0, time.time() + 1)[-1][0]
+    messages = []
+    monkeypatch.setattr(bro, "send_message", lambda message, *args, **kwargs: messages.append(message))
+
+    # the upload failed, so the clip was left to the spool
+    monkeypatch.setattr(bro, "_retry_network_error", lambda *args, **kwargs: None)
+    handlers.clip_command(bro, None, str(event_id))
+    assert messages == []
+
+    handlers.clip_command(bro, None, str(event_id + 1))
+    assert messages == ["Ese vídeo ya no está guardado"]
@@ -0,0 +1,94 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The menu is refreshed once for several changes and, if it is still the last message of
+    the chat, only its buttons are edited """
+
+import pytest
+
+import benchmark
+import constants
+import menu
+
+ZONE = {"name": "entrada", "pins": {"PIR_SENSOR": 17, "RELAY_A": 22, "RELAY_B": 23},
+        "lamp_on_time": 1, "camera": False, "node": ""}
+
+
+class MenuRequests:
+    """ The requests made to the Bot API from the moment it is created """
+
+    def __init__(self, bot_api):
+        self.bot_api = bot_api
+        self._seen = len(self._all())
+
+    def _all(self):
+        return [(method, text) for _, method, _, text, _ in self.bot_api.requests if method != "getUpdates"]
+
+    def new(self):
+        """ Waits until the bot has been quiet for a while and returns what it has sent since
+            the last call, as (method, text) tuples """
+
+        benchmark.wait_until_quiet(self.bot_api, 0.3, 5)
+        requests = self._all()
+        new_requests, self._seen = requests[self._seen:], len(requests)
+        return new_requests
+
+
+@pytest.fixture
+def menu_bro(make_bro, mock_pins, bot_api, monkeypatch):
+    monkeypatch.setattr(constants, "MENU_REFRESH_DELAY", 0.1)
+    # the limit of requests per chat would make the bot look quiet while it waits
+    monkeypatch.setattr(constants, "OUTBOX_RATE", 100)
+    bro = make_bro([ZONE])
+    bro.init_hardware()
+    # the hardware sends the first menu once it is ready. The tests start without it
+    benchmark.wait_until_quiet(bot_api, 0.3, 5)
+    bro.delete_menu()
+    return bro
+
+
+def test_menu_refreshes(menu_bro, bot_api, monkeypatch):
+    requests = MenuRequests(bot_api)
+    zone = menu_bro.zones[0]
+    refreshes = []
+    refresh_menu = menu_bro._refresh_menu
+    monkeypatch.setattr(menu_bro, "_refresh_menu", lambda: refreshes.append(True) or refresh_menu())
+
+    # several calls in a row make a single refresh
+    for _ in range(3):
+        menu_bro.send_menu()
+    assert requests.new() == [("sendMessage", menu.MESSAGE)]
+    assert refreshes == [True]
+
+    # nothing has changed
+    menu_bro.send_menu()
+    assert requests.new() == []
+
+    # the menu is still the last message, so only its buttons change
+    zone.movement_activated = not zone.movement_activated
+    menu_bro.send_menu()
+    assert requests.new() == [("editMessageReplyMarkup", "")]
+
+    # once something else has been sent, the menu is sent again below it, even if nothing
+    # has changed
+    menu_bro.send_message("hola").result(5)
+    menu_bro.send_menu()
+    assert requests.new() == [("sendMessage", "hola"), ("deleteMessage", ""), ("sendMessage", menu.MESSAGE)]
+
+    # the new menu is the one whose buttons are edited
+    zone.movement_activated = not zone.movement_activated
+    menu_bro.send_menu()
+    assert requests.new() == [("editMessageReplyMarkup", "")]
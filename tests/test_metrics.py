@@ -0,0 +1,81 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_histogram_quantiles_are_bucket_bounds():
+    histogram = metrics.Histogram(buckets=(0.1, 1, 10))
+    for value in (0.05, 0.05, 0.5, 5):
+        histogram.observe(value)
+
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1
+    # the last bucket is bounded by the maximum
+    assert histogram.quantile(1) == 5
+    assert metrics.Histogram().quantile(0.5) == 0.0
+
+
+def test_prometheus_format():
+    registry = metrics.Registry()
+    registry.counter("alerts_total", "Alerts sent", zone="garaje").inc(2)
+    registry.gauge("camera_open", "Whether the camera is powered").set(1)
+    registry.histogram("upload_seconds", "Uploads", buckets=(1, 10)).observe(5)
+
+    assert registry.render_prometheus().splitlines() == [
+        "# HELP alerts_total Alerts sent",
+        "# TYPE alerts_total counter",
+        'alerts_total{zone="garaje"} 2',
+        "# HELP camera_open Whether the camera is powered",
+        "# TYPE camera_open gauge",
+        "camera_open 1",
+        "# HELP upload_seconds Uploads",
+        "# TYPE upload_seconds histogram",
+        'upload_seconds_bucket{le="1"} 0',
+        'upload_seconds_bucket{le="10"} 1',
+        'upload_seconds_bucket{le="+Inf"} 1',
+        "upload_seconds_sum 5.0",
+        "upload_seconds_count 1",
+    ]
+
+
+def test_summary_only_shows_histograms_with_observations():
+    registry = metrics.Registry()
+    registry.histogram("unused_seconds")
+    with registry.time("photo_seconds", kind="burst"):
+        pass
+
+    lines = registry.summary().splitlines()
+    assert len(lines) == 1 and lines[0].startswith('photo_seconds{kind="burst"}: n=1 ')
+
+
+def test_scrape_endpoint():
+    metrics.REGISTRY.counter("scrape_test_total").inc()
+    server = metrics.start_http_server("127.0.0.1", 0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert "scrape_test_total 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
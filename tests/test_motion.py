@@ -0,0 +1,113 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import motion
+
+# 8 rows and 10 columns of macroblocks, plus the extra column of the encoder
+ROWS, COLUMNS = 8, 10
+MOTION_DTYPE = np.dtype([("x", "i1"), ("y", "i1"), ("sad", "u2")])
+
+
+def motion_vectors(moving=(), x=40, y=30):
+    """ Motion vectors of a frame where only the macroblocks 'moving' (row, column) have moved """
+
+    vectors = np.zeros((ROWS, COLUMNS + 1), dtype=MOTION_DTYPE)
+    for row, column in moving:
+        vectors[row, column] = (x, y, 0)
+    return vectors
+
+
+def detector(min_blocks=3, roi=(0, 0, 1, 1)):
+    # a vector of (40, 30) is 50 long
+    return motion.MotionDetector(None, threshold=45, min_blocks=min_blocks, roi=roi)
+
+
+def test_enough_moving_blocks_are_motion():
+    motion_detector = detector()
+    start = time.monotonic()
+
+    motion_detector.analyse(motion_vectors([(0, 0), (1, 1), (2, 2)]))
+
+    assert motion_detector.last_motion_time >= start
+    assert motion_detector.wait_for_motion(start, 0)
+
+
+def test_too_few_or_too_short_vectors_are_not_motion():
+    motion_detector = detector()
+
+    motion_detector.analyse(motion_vectors([(0, 0), (1, 1)]))
+    # 30 long, under the threshold
+    motion_detector.analyse(motion_vectors([(0, 0), (1, 1), (2, 2)], x=18, y=24))
+
+    assert motion_detector.last_motion_time is None
+    assert not motion_detector.wait_for_motion(time.monotonic(), 0)
+
+
+def test_negative_vectors_are_motion():
+    motion_detector = detector()
+    motion_detector.analyse(motion_vectors([(0, 0), (1, 1), (2, 2)], x=-40, y=-30))
+    assert motion_detector.last_motion_time is not None
+
+
+def test_only_blocks_inside_the_region_of_interest_count():
+    # the right half of the image
+    motion_detector = detector(roi=(0.5, 0, 1, 1))
+
+    motion_detector.analyse(motion_vectors([(0, 0), (3, 4), (7, 2)]))
+    assert motion_detector.last_motion_time is None
+
+    motion_detector.analyse(motion_vectors([(0, 5), (3, 9), (7, 7)]))
+    assert motion_detector.last_motion_time is not None
+
+
+def test_extra_column_of_the_encoder_is_ignored():
+    motion_detector = detector()
+    motion_detector.analyse(motion_vectors([(row, COLUMNS) for row in range(ROWS)]))
+    assert motion_detector.last_motion_time is None
+
+
+def test_mask_covers_the_region_of_interest():
+    mask = detector(roi=(0.25, 0.5, 0.75, 1))._generate_mask((ROWS, COLUMNS + 1))
+
+    assert mask.shape == (ROWS, COLUMNS + 1)
+    rows, columns = np.nonzero(mask)
+    assert (rows.min(), rows.max()) == (4, ROWS - 1)
+    # columns 2.5 to 7.5 of the image, rounded outwards
+    assert (columns.min(), columns.max()) == (2, 7)
+    assert not mask[:, COLUMNS].any()
+
+
+def test_mask_follows_the_size_of_the_frames():
+    motion_detector = detector(roi=(0.5, 0, 1, 1))
+    motion_detector.analyse(motion_vectors())
+
+    bigger_frame = np.zeros((ROWS * 2, COLUMNS * 2 + 1), dtype=MOTION_DTYPE)
+    bigger_frame[0, 10:13] = (40, 30, 0)
+    motion_detector.analyse(bigger_frame)
+
+    assert motion_detector.last_motion_time is not None
+
+
+def test_parse_roi():
+    assert motion.parse_roi("0.25,0,1,0.8") == (0.25, 0, 1, 0.8)
+    with pytest.raises(ValueError):
+        motion.parse_roi("0.5,0,0.4,1")
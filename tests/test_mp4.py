@@ -0,0 +1,269 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import random
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import benchmark
+import constants
+import helper
+import mp4
+
+FRAMERATE = 30
+RESOLUTION = (576, 1152)
+
+# boxes which only hold other boxes
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"dinf"}
+
+
+def read_boxes(data, start=0, end=None):
+    """ Returns the boxes between 'start' and 'end' as a dict {type: (start, end)} of their
+        payloads, walking into the containers like ffprobe does. Also returns the types of
+        the top-level boxes in order """
+
+    boxes = {}
+    order = []
+    end = len(data) if end is None else end
+    position = start
+    while position < end:
+        size, box_type = struct.unpack(">I4s", data[position:position + 8])
+        assert size >= 8 and position + size <= end, f"box {box_type} overflows its parent"
+        boxes[box_type] = (position + 8, position + size)
+        order.append(box_type)
+        if box_type in CONTAINER_BOXES:
+            boxes.update(read_boxes(data, position + 8, position + size)[0])
+        position += size
+
+    assert position == end
+    return boxes, order
+
+
+def full_box_payload(data, boxes, box_type):
+    start, end = boxes[box_type]
+    # version and flags
+    return data[start + 4:end]
+
+
+def mux(h264, chunk_size=None):
+    muxer = mp4.Mp4Muxer(FRAMERATE)
+    if chunk_size is None:
+        muxer.write(h264)
+    else:
+        for offset in range(0, len(h264), chunk_size):
+            muxer.write(h264[offset:offset + chunk_size])
+    return muxer.finish().getvalue()
+
+
+@pytest.fixture(scope="module")
+def clip():
+    h264, frame_count = benchmark.generate_h264(2, FRAMERATE, RESOLUTION, 2000000)
+    return h264, frame_count, mux(h264, 64 * 1024)
+
+
+def test_moov_goes_before_mdat(clip):
+    _, _, data = clip
+    _, order = read_boxes(data)
+    assert order == [b"ftyp", b"moov", b"mdat"]
+
+
+def test_sample_table_describes_the_frames(clip):
+    h264, frame_count, data = clip
+    boxes, _ = read_boxes(data)
+
+    sample_count, = struct.unpack(">4xI", full_box_payload(data, boxes, b"stsz")[:8])
+    sample_sizes = struct.unpack(f">{sample_count}I", full_box_payload(data, boxes, b"stsz")[8:])
+    assert sample_count == frame_count
+
+    # the only chunk starts right after the mdat header and the frames fill the box
+    chunk_offset, = struct.unpack(">4xI", full_box_payload(data, boxes, b"stco"))
+    mdat_start, mdat_end = boxes[b"mdat"]
+    assert chunk_offset == mdat_start
+    assert chunk_offset + sum(sample_sizes) == mdat_end
+
+    # every frame is made of NAL units prefixed by their length
+    position = chunk_offset
+    for sample_size in sample_sizes:
+        sample_end = position + sample_size
+        while position < sample_end:
+            nal_size, = struct.unpack(">I", data[position:position + 4])
+            assert data[position + 4] & 0x1f in (mp4.NAL_SLICE, mp4.NAL_IDR_SLICE)
+            position += 4 + nal_size
+        assert position == sample_end
+
+    # a keyframe every second
+    keyframe_count, = struct.unpack(">I", full_box_payload(data, boxes, b"stss")[:4])
+    keyframes = struct.unpack(f">{keyframe_count}I", full_box_payload(data, boxes, b"stss")[4:])
+    assert keyframes == tuple(range(1, frame_count + 1, FRAMERATE))
+
+
+def test_durations_and_resolution(clip):
+    _, frame_count, data = clip
+    boxes, _ = read_boxes(data)
+
+    timescale, duration = struct.unpack(">8xII", full_box_payload(data, boxes, b"mdhd")[:16])
+    assert duration / timescale == pytest.approx(frame_count / FRAMERATE)
+    entry_count, stts_count, sample_delta = struct.unpack(">III", full_box_payload(data, boxes, b"stts"))
+    assert (entry_count, stts_count, sample_delta * FRAMERATE) == (1, frame_count, timescale)
+
+    width, height = struct.unpack(">II", full_box_payload(data, boxes, b"tkhd")[-8:])
+    assert (width >> 16, height >> 16) == RESOLUTION
+
+
+def _avcc(data):
+    position = data.index(b"avcC") - 4
+    size, = struct.unpack(">I", data[position:position + 4])
+    return data[position + 8:position + size]
+
+
+def test_avcc_of_high_profile_has_chroma_format_and_bit_depths():
+    sps = benchmark.generate_sps(*RESOLUTION, profile_idc=100)[4:]
+    pps = benchmark.PPS[4:]
+    avcc = _avcc(mux(benchmark.generate_h264(1, FRAMERATE, RESOLUTION, 1000000)[0]))
+
+    expected = (bytes([1, 100, sps[2], sps[3], 0xff, 0xe1]) + struct.pack(">H", len(sps)) + sps
+                + struct.pack(">BH", 1, len(pps)) + pps
+                # 4:2:0, 8 bits luma, 8 bits chroma and no SPS extensions
+                + bytes([0xfd, 0xf8, 0xf8, 0]))
+    assert avcc == expected
+
+
+def test_avcc_of_baseline_profile_has_no_extension():
+    sps = benchmark.generate_sps(*RESOLUTION, profile_idc=66)
+    h264 = sps + benchmark.PPS + b"\x00\x00\x00\x01\x65" + benchmark._payload(500)
+    avcc = _avcc(mux(h264))
+
+    assert avcc[1] == 66
+    assert avcc.endswith(benchmark.PPS[4:])
+
+
+def test_parse_sps_of_high_profile():
+    sps_info = mp4.parse_sps(benchmark.generate_sps(1920, 1080, profile_idc=100)[4:])
+    assert sps_info["profile_idc"] == 100
+    assert sps_info["chroma_format_idc"] == 1
+    assert (sps_info["bit_depth_luma_minus8"], sps_info["bit_depth_chroma_minus8"]) == (0, 0)
+    # the coded height is a whole number of macroblocks
+    assert (sps_info["width"], sps_info["height"]) == (1920, 1088)
+
+
+def test_output_does_not_depend_on_how_the_stream_is_split(clip):
+    h264, _, data = clip
+    chunk_sizes = random.Random(1)
+    muxer = mp4.Mp4Muxer(FRAMERATE)
+    position = 0
+    while position < len(h264):
+        size = chunk_sizes.randint(1, 5000)
+        muxer.write(h264[position:position + size])
+        position += size
+
+    assert muxer.finish().getvalue() == data
+
+
+def test_frames_before_the_first_keyframe_are_dropped():
+    h264, frame_count = benchmark.generate_h264(1, FRAMERATE, RESOLUTION, 1000000)
+    p_frame = b"\x00\x00\x00\x01\x41" + benchmark._payload(100)
+    data = mux(p_frame * 3 + h264)
+    boxes, _ = read_boxes(data)
+
+    sample_count, = struct.unpack(">4xI", full_box_payload(data, boxes, b"stsz")[:8])
+    assert sample_count == frame_count
+
+
+def test_stream_without_keyframes_is_an_error():
+    muxer = mp4.Mp4Muxer(FRAMERATE)
+    muxer.write(b"\x00\x00\x00\x01\x41" + benchmark._payload(100))
+    with pytest.raises(mp4.MuxerError):
+        muxer.finish()
+
+
+@pytest.mark.skipif(not shutil.which("ffprobe"), reason="ffprobe is not installed")
+def test_ffprobe_reads_every_frame(clip, tmp_path):
+    _, frame_count, data = clip
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(data)
+
+    probe = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets",
+                            "-show_entries", "stream=codec_name,width,height,nb_read_packets",
+                            "-of", "csv=p=0", str(path)], capture_output=True, text=True, check=True)
+    assert probe.stdout.strip() == f"h264,{RESOLUTION[0]},{RESOLUTION[1]},{frame_count}"
+
+
+class RecordingMuxer:
+    """ Stands for helper.FFmpegMuxer: keeps what is written into it """
+
+    instances = []
+
+    def __init__(self, framerate):
+        self.framerate = framerate
+        self.data = bytearray()
+        RecordingMuxer.instances.append(self)
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def finish(self):
+        return io.BytesIO(b"muxed by ffmpeg")
+
+    def abort(self):
+        pass
+
+
+@pytest.fixture
+def ffmpeg_installed(monkeypatch):
+    RecordingMuxer.instances = []
+    monkeypatch.setattr(helper, "FFmpegMuxer", RecordingMuxer)
+    monkeypatch.setattr(helper.shutil, "which", lambda command: f"/usr/bin/{command}")
+
+
+def test_builtin_muxer_is_the_default_without_ffmpeg(monkeypatch):
+    monkeypatch.setattr(helper.shutil, "which", lambda command: None)
+    assert constants.MUXER == "builtin"
+
+    muxer = helper.create_muxer(FRAMERATE)
+    assert isinstance(muxer, mp4.Mp4Muxer)
+    muxer.abort()
+
+
+def test_ffmpeg_is_used_when_it_is_configured(monkeypatch, ffmpeg_installed):
+    monkeypatch.setattr(constants, "MUXER", "ffmpeg")
+    assert isinstance(helper.create_muxer(FRAMERATE), RecordingMuxer)
+
+
+def test_ffmpeg_is_not_used_if_the_builtin_muxer_succeeds(clip, ffmpeg_installed):
+    h264, _, data = clip
+    assert helper.convert_to_mp4(io.BytesIO(h264), FRAMERATE).getvalue() == data
+    assert RecordingMuxer.instances == []
+
+
+def test_ffmpeg_muxes_what_the_builtin_muxer_cannot(ffmpeg_installed):
+    # without a keyframe, the builtin muxer fails when the video finishes
+    h264 = b"\x00\x00\x00\x01\x41" + benchmark._payload(200000)
+
+    assert helper.convert_to_mp4(io.BytesIO(h264), FRAMERATE).getvalue() == b"muxed by ffmpeg"
+    ffmpeg_muxer, = RecordingMuxer.instances
+    assert ffmpeg_muxer.data == h264
+    assert ffmpeg_muxer.framerate == FRAMERATE
+
+
+def test_builtin_muxer_errors_are_raised_without_ffmpeg(monkeypatch):
+    monkeypatch.setattr(helper.shutil, "which", lambda command: None)
+    with pytest.raises(mp4.MuxerError):
+        helper.convert_to_mp4(io.BytesIO(b"\x00\x00\x00\x01\x41" + benchmark._payload(100)), FRAMERATE)
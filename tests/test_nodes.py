@@ -0,0 +1,215 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" The hub and two nodes (see hub.py and node.py) talking through localhost. Every Pi uses
+    its own mock pins """
+
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import constants
+import hub
+import node
+import rpc
+
+SECRET = "s3cret"
+
+
+def zone_config(name, pins=None, node_name="", camera=False):
+    return {"name": name, "lamp_on_time": 1, "camera": camera, "node": node_name,
+            "pins": pins and dict(zip(("PIR_SENSOR", "RELAY_A", "RELAY_B"), pins))}
+
+
+NODE_ZONES = {
+    "n1": [zone_config("garaje", (5, 6, 13), "n1", camera=True)],
+    "n2": [zone_config("patio", (19, 26, 21), "n2")]
+}
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def hub_bro(make_bro, mock_pins, monkeypatch):
+    monkeypatch.setattr(constants, "NODE_SECRET", SECRET)
+    monkeypatch.setattr(constants, "HUB_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(constants, "HUB_PORT", 0)
+    monkeypatch.setattr(constants, "CAMERA_COLD_SETTLE", 0)
+
+    bro = make_bro([zone_config("entrada", (17, 27, 22)), zone_config("garaje", node_name="n1", camera=True),
+                    zone_config("patio", node_name="n2")])
+    bro.pir_zones = []
+    bro.add_handler_to_zones("pir_sensor", immediate=True,
+                             when_activated=lambda bro, zone: bro.pir_zones.append(zone.name))
+    bro.init_hardware()
+    return bro
+
+
+@pytest.fixture
+def start_node(hub_bro):
+    agents = []
+
+    def start(name):
+        agent = node.NodeAgent(name, f"127.0.0.1:{hub_bro.hub_server.port}", SECRET, NODE_ZONES[name])
+        thread = threading.Thread(target=agent.run, daemon=True)
+        thread.start()
+        agents.append((agent, thread))
+        return agent
+
+    yield start
+    for agent, thread in agents:
+        agent.stop()
+        thread.join(5)
+
+
+def _introduce(port, hello):
+    """ Connects to the hub like a node would and returns the connection and the challenge """
+
+    connection = rpc.Connection(socket.create_connection(("127.0.0.1", port), timeout=5))
+    challenge, _ = connection.receive()
+    assert challenge["type"] == "challenge"
+    connection.send(hello(challenge["nonce"]))
+    return connection, challenge
+
+
+def test_two_nodes_serve_their_zones(hub_bro, start_node):
+    first_node = start_node("n1")
+    second_node = start_node("n2")
+    assert _wait_until(lambda: all(link.is_connected for link in hub_bro.node_links.values()))
+
+    garaje = hub_bro.get_zone("garaje")
+    garaje.change_to_manual_mode().result()
+    assert not first_node.zones["garaje"].lamp.is_normal_mode
+    assert second_node.zones["patio"].lamp.is_normal_mode
+    garaje.change_to_normal_mode().result()
+    assert first_node.zones["garaje"].lamp.is_normal_mode
+
+    # the pir sensor of the second node reaches the handlers of the hub
+    second_node.zones["patio"].pir_sensor.pin.drive_high()
+    assert _wait_until(lambda: hub_bro.pir_zones == ["patio"])
+
+    # the camera is the one of the first node
+    with hub_bro.camera_arbiter.capture("jpeg") as photo:
+        assert photo.getvalue()
+
+    # the settings which suit the uplink reach the node and wait for its next video
+    camera = hub_bro.camera_arbiter
+    camera.arm(1000000, None)
+    camera.update_arm_settings(500000, [288, 144])
+    assert first_node.camera_arbiter._next_arm_settings == (500000, [288, 144])
+    camera.disarm()
+
+
+def test_the_secret_never_goes_through_the_network(mock_pins):
+    agent = node.NodeAgent("n2", "127.0.0.1:1", SECRET, NODE_ZONES["n2"])
+    hello = agent._hello("0123")
+    assert SECRET not in json.dumps(hello)
+    assert hello["proof"] == rpc.hello_proof(SECRET, "0123", "n2")
+    # a proof is only valid for its own nonce
+    assert hello["proof"] != agent._hello("4567")["proof"]
+
+
+def test_nodes_without_the_secret_are_rejected(hub_bro):
+    port = hub_bro.hub_server.port
+    link = hub_bro.node_links["n2"]
+
+    connection, _ = _introduce(port, lambda nonce: {"type": "hello", "node": "n2",
+                                                     "proof": rpc.hello_proof("wrong", nonce, "n2")})
+    with pytest.raises(rpc.ConnectionClosed):
+        connection.receive()
+    # sending the secret itself is not enough either
+    connection, _ = _introduce(port, lambda nonce: {"type": "hello", "node": "n2", "proof": SECRET})
+    with pytest.raises(rpc.ConnectionClosed):
+        connection.receive()
+    assert not link.is_connected
+
+    # a node with the secret gets in, but what it sent cannot be replayed
+    valid_hellos = []
+
+    def valid_hello(nonce):
+        valid_hellos.append({"type": "hello", "node": "n2", "proof": rpc.hello_proof(SECRET, nonce, "n2")})
+        return valid_hellos[-1]
+
+    accepted, _ = _introduce(port, valid_hello)
+    assert _wait_until(lambda: link.is_connected)
+    replayed, _ = _introduce(port, lambda nonce: valid_hellos[0])
+    with pytest.raises(rpc.ConnectionClosed):
+        replayed.receive()
+    accepted.close()
+
+
+def test_new_arm_settings_do_not_fail_while_the_node_is_away():
+    camera = hub.RemoteCamera(hub.NodeLink("garaje"))
+    camera._armed = True
+
+    # the link is down: the settings are kept for when the node connects again
+    camera.update_arm_settings(500000, (288, 144))
+    assert camera.arm_settings == (500000, (288, 144))
+
+
+def test_hello_cannot_carry_data(hub_bro):
+    # not even with the secret: the hub would have to buffer it before knowing who sent it
+    connection, _ = _introduce(hub_bro.hub_server.port,
+                               lambda nonce: {"type": "hello", "node": "n2", "size": 2 ** 40,
+                                              "proof": rpc.hello_proof(SECRET, nonce, "n2")})
+    with pytest.raises(rpc.ConnectionClosed):
+        connection.receive()
+    assert not hub_bro.node_links["n2"].is_connected
+
+
+def _connection_pair():
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        sender = socket.create_connection(server.getsockname(), timeout=5)
+        receiver, _ = server.accept()
+    receiver.settimeout(5)
+    return rpc.Connection(sender), rpc.Connection(receiver)
+
+
+def test_frames_with_too_much_data_are_refused():
+    sender, receiver = _connection_pair()
+    try:
+        sender.send({"type": "chunk", "id": 1, "size": rpc.MAXIMUM_DATA_SIZE + 1})
+        with pytest.raises(rpc.ConnectionClosed):
+            receiver.receive()
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_big_writes_are_split_in_several_chunks():
+    sender, receiver = _connection_pair()
+    media = bytes(range(256)) * (rpc.MAXIMUM_DATA_SIZE * 5 // 2 // 256)
+    writer = threading.Thread(target=rpc.ChunkWriter(sender, 7).write, args=(media,))
+    writer.start()
+    try:
+        chunks = [receiver.receive() for _ in range(3)]
+    finally:
+        writer.join(5)
+        sender.close()
+        receiver.close()
+
+    assert all(header == {"type": "chunk", "id": 7, "size": len(data)} for header, data in chunks)
+    assert b"".join(data for _, data in chunks) == media
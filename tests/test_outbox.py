@@ -0,0 +1,176 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from telegram.error import RetryAfter
+
+import benchmark
+import outbox
+
+
+@pytest.fixture
+def box():
+    instance = outbox.Outbox(rate=100, burst=100, workers=2)
+    yield instance
+    instance.stop()
+
+
+def test_requests_of_a_chat_are_sent_in_order_of_priority(box):
+    sent = []
+    release = threading.Event()
+    box.submit(outbox.PRIORITY_MEDIA, 1, lambda chat_id: release.wait(5))
+    futures = [box.submit(priority, 1, lambda chat_id, priority=priority: sent.append(priority))
+               for priority in (outbox.PRIORITY_MENU, outbox.PRIORITY_STATUS, outbox.PRIORITY_ALERT)]
+
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert sent == [outbox.PRIORITY_ALERT, outbox.PRIORITY_STATUS, outbox.PRIORITY_MENU]
+
+
+def test_sent_time_does_not_include_the_queue(box):
+    submitted_time = time.monotonic()
+    slow = box.submit(outbox.PRIORITY_MEDIA, 1, lambda chat_id: time.sleep(0.3))
+    queued = box.submit(outbox.PRIORITY_MEDIA, 1, lambda chat_id: "sent")
+
+    assert queued.result(5) == "sent"
+    assert slow.sent_time - submitted_time < 0.1
+    # it waited for the request before it to the same chat
+    assert queued.sent_time - submitted_time >= 0.3
+
+
+def test_uplink_is_measured_from_the_moment_the_upload_starts(make_bro, monkeypatch):
+    bro = make_bro()
+    samples = []
+    monkeypatch.setattr(bro.uplink, "observe", lambda size, seconds: samples.append((size, seconds)))
+
+    # an alert keeps the chat busy for a while
+    bro.outbox.submit(outbox.PRIORITY_ALERT, benchmark.BENCH_CHAT_ID, lambda chat_id: time.sleep(0.5))
+
+    def send_video(stream, **kwargs):
+        return bro.outbox.submit(outbox.PRIORITY_MEDIA, benchmark.BENCH_CHAT_ID,
+                                 lambda chat_id: time.sleep(0.1) or "sent")
+
+    assert bro._retry_network_error(send_video, BytesIO(b"video" * 1000)) == "sent"
+    (size, seconds), = samples
+    assert size == 5000
+    assert 0.1 <= seconds < 0.4
+
+
+class Chat:
+    """ Stands for Bot.send_message: keeps the texts it sends. The first request can be
+        held until 'release' is set, so the next ones wait in the outbox """
+
+    def __init__(self):
+        self.texts = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.release.wait(5)
+        self.texts.append(text)
+        return len(self.texts)
+
+
+def test_queued_status_texts_are_merged(box):
+    chat = Chat()
+    chat.release.clear()
+    first = box.submit_text(outbox.PRIORITY_STATUS, 1, chat.send_message, "busy")
+    assert benchmark.wait_until(first.running, 5)
+    futures = [box.submit_text(outbox.PRIORITY_STATUS, 1, chat.send_message, text) for text in "abc"]
+    # neither texts with options nor other chats are merged
+    options = box.submit_text(outbox.PRIORITY_STATUS, 1, chat.send_message, "d", parse_mode="HTML")
+    time.sleep(0.1)
+
+    chat.release.set()
+    assert first.result(5) == 1
+    assert [future.result(5) for future in futures] == [2, 2, 2]
+    options.result(5)
+    assert chat.texts == ["busy", "a\nb\nc", "d"]
+
+
+def test_merged_texts_fit_in_a_message(box):
+    chat = Chat()
+    chat.release.clear()
+    first = box.submit_text(outbox.PRIORITY_STATUS, 1, chat.send_message, "busy")
+    assert benchmark.wait_until(first.running, 5)
+    texts = ["a" * 3000, "b" * 1000, "c" * 94, "d" * 10]
+    futures = [box.submit_text(outbox.PRIORITY_STATUS, 1, chat.send_message, text) for text in texts]
+    time.sleep(0.1)
+
+    chat.release.set()
+    for future in futures:
+        future.result(5)
+    # the first three make a message of 4096 characters
+    assert chat.texts[1:] == ["\n".join(texts[:3]), texts[3]]
+    assert len(chat.texts[1]) == outbox.MAX_MESSAGE_LENGTH
+
+
+def test_token_bucket_allows_bursts_and_then_the_rate():
+    bucket = outbox.TokenBucket(rate=10, capacity=2)
+    assert bucket.time_until_available() == 0
+    bucket.consume()
+    bucket.consume()
+    assert 0.05 < bucket.time_until_available() <= 0.1
+
+
+def test_requests_of_a_chat_are_limited():
+    limited_box = outbox.Outbox(rate=10, burst=2, workers=2)
+    try:
+        start_time = time.monotonic()
+        futures = [limited_box.submit(outbox.PRIORITY_STATUS, 1, lambda chat_id: time.monotonic())
+                   for _ in range(4)]
+        # the limit of a chat does not delay the others
+        other_chat = limited_box.submit(outbox.PRIORITY_STATUS, 2, lambda chat_id: time.monotonic())
+        sent_times = [future.result(5) - start_time for future in futures]
+        assert other_chat.result(5) - start_time < 0.05
+    finally:
+        limited_box.stop()
+
+    # a burst of two and then one every 0.1s
+    assert sent_times[1] < 0.05
+    assert sent_times[2] >= 0.09 and sent_times[3] >= 0.19
+
+
+def test_flood_waits_are_retried(box):
+    attempts = []
+
+    def send(chat_id):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.2)
+        return "sent"
+
+    assert box.submit(outbox.PRIORITY_MEDIA, 1, send).result(5) == "sent"
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.2
+
+
+def test_too_many_flood_waits_fail_the_request(box, monkeypatch):
+    monkeypatch.setattr(outbox, "MAXIMUM_FLOOD_RETRIES", 2)
+    attempts = []
+
+    def send(chat_id):
+        attempts.append(chat_id)
+        raise RetryAfter(0.01)
+
+    with pytest.raises(RetryAfter):
+        box.submit(outbox.PRIORITY_MEDIA, 1, send).result(5)
+    assert len(attempts) == 3
@@ -0,0 +1,95 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import time
+
+import pytest
+
+import constants
+import polling
+
+
+class SilentBot:
+    """ A bot whose 'getUpdates' never brings anything """
+
+    def __init__(self):
+        self.timeouts = []
+        self._finished = threading.Event()
+
+    def delete_webhook(self):
+        return True
+
+    def get_updates(self, offset=None, timeout=0, read_latency=0):
+        self.timeouts.append(timeout)
+        self._finished.wait(0.01)
+        return []
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(polling, "is_quiet_time", lambda windows, now=None: False)
+    instance = polling.PollingScheduler(SilentBot(), queue.Queue(), 10, 2, active_window=60,
+                                        idle_timeout=50, idle_gap=5, quiet_hours="",
+                                        quiet_timeout=50, quiet_gap=60)
+    yield instance
+    instance.stop()
+
+
+def test_idle_polling_has_its_own_timeout_and_gap(scheduler):
+    assert scheduler.current_schedule() == (10, 0)
+
+    scheduler._last_activity_time = time.monotonic() - 61
+    assert scheduler.current_schedule() == (50, 5)
+
+    scheduler.notify_activity()
+    assert scheduler.current_schedule() == (10, 0)
+
+
+def test_quiet_hours_take_precedence_over_idle(scheduler, monkeypatch):
+    monkeypatch.setattr(polling, "is_quiet_time", lambda windows, now=None: True)
+    scheduler._last_activity_time = time.monotonic() - 61
+    assert scheduler.current_schedule() == (50, 60)
+
+
+def test_default_configuration_is_adaptive():
+    # otherwise, the scheduler would behave like a fixed long polling
+    assert constants.POLLING_IDLE_GAP > 0
+    assert constants.POLLING_IDLE_TIMEOUT > 0
+
+
+def test_quiet_windows_go_through_midnight():
+    windows = polling.parse_quiet_hours("23:00-07:00, 13:30-15:00")
+    assert windows == [(23 * 60, 7 * 60), (13 * 60 + 30, 15 * 60)]
+
+    def at(hour, minute):
+        return time.mktime((2021, 6, 1, hour, minute, 0, 0, 0, -1))
+
+    assert polling.is_quiet_time(windows, at(23, 30))
+    assert polling.is_quiet_time(windows, at(6, 59))
+    assert polling.is_quiet_time(windows, at(14, 0))
+    assert not polling.is_quiet_time(windows, at(7, 0))
+    assert not polling.is_quiet_time(windows, at(12, 0))
+
+
+def test_exit_stops_the_dispatcher(make_bro):
+    bro = make_bro()
+    bro._start_polling(timeout=1, courtesy_time=1)
+    assert bro._dispatcher_thread.is_alive()
+
+    bro._on_exit()
+    assert not bro._dispatcher_thread.is_alive()
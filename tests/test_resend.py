@@ -0,0 +1,150 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Requests which overlap get the same photo or video (helper.InFlight) and media recently
+    sent can be sent again without uploading it (/reenviar) """
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import benchmark
+import constants
+import handlers
+import helper
+
+CAMERA_ZONE = {"name": "entrada", "pins": {"PIR_SENSOR": 17, "RELAY_A": 22, "RELAY_B": 23},
+               "lamp_on_time": 1, "camera": True, "node": ""}
+
+
+@pytest.fixture
+def camera_bro(make_bro, mock_pins, monkeypatch):
+    monkeypatch.setattr(constants, "CAMERA_COLD_SETTLE", 0)
+    monkeypatch.setattr(constants, "PREVIEW_MODE", "off")
+    bro = make_bro([CAMERA_ZONE])
+    bro.init_hardware()
+    return bro
+
+
+def requests_of(bot_api, method):
+    return [request for request in bot_api.requests if request[1] == method]
+
+
+def test_overlapping_calls_share_the_result():
+    in_flight = helper.InFlight()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(True)
+        release.wait(5)
+        return "result"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(in_flight.run("key", function)))
+    first.start()
+    assert benchmark.wait_until(lambda: in_flight.is_running("key"), 5)
+    second = threading.Thread(target=lambda: results.append(in_flight.run("key", function)))
+    second.start()
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert calls == [True]
+    assert sorted(results) == [("result", False), ("result", True)]
+    assert not in_flight.is_running("key")
+
+
+def test_exception_reaches_every_waiter_and_clears_the_key():
+    in_flight = helper.InFlight()
+    release = threading.Event()
+
+    def failing_function():
+        release.wait(5)
+        raise OSError("the camera has failed")
+
+    errors = []
+
+    def run():
+        try:
+            in_flight.run("key", failing_function)
+        except OSError as exc:
+            errors.append(exc)
+
+    first = threading.Thread(target=run)
+    first.start()
+    assert benchmark.wait_until(lambda: in_flight.is_running("key"), 5)
+    second = threading.Thread(target=run)
+    second.start()
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert not in_flight.is_running("key")
+    # the next call runs the function again
+    assert in_flight.run("key", lambda: "again") == ("again", False)
+
+
+def test_overlapping_videos_are_uploaded_once(camera_bro, bot_api):
+    timings = []
+
+    def record():
+        timings.append(camera_bro.record_and_send_video(1, inform=False))
+
+    first = threading.Thread(target=record)
+    first.start()
+    assert benchmark.wait_until(lambda: camera_bro._in_flight.is_running("video"), 5)
+    second = threading.Thread(target=record)
+    second.start()
+    first.join(10)
+    second.join(10)
+
+    assert len(requests_of(bot_api, "sendVideo")) == 1
+    assert len(timings) == 2 and timings[0] is timings[1]
+
+
+def test_resend_uses_the_id_of_the_photo(camera_bro, bot_api):
+    camera_bro.take_and_send_photo()
+    media_key = camera_bro.last_media_key
+    assert benchmark.wait_until(lambda: media_key in camera_bro._file_ids, 5)
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(first_name="Ana"))
+    handlers.resend_command(camera_bro, update)
+
+    assert benchmark.wait_until(lambda: len(requests_of(bot_api, "sendPhoto")) == 2, 5)
+    upload, resend = requests_of(bot_api, "sendPhoto")
+    # only the id is sent, not the photo
+    assert resend[4] < 1000 < upload[4]
+    assert requests_of(bot_api, "sendMessage") == []
+
+
+def test_media_evicted_from_the_cache_cannot_be_resent(make_bro, mock_pins, bot_api, monkeypatch):
+    monkeypatch.setattr(constants, "CAMERA_COLD_SETTLE", 0)
+    monkeypatch.setattr(constants, "FILE_ID_CACHE_SIZE", 1)
+    bro = make_bro([CAMERA_ZONE])
+    bro.init_hardware()
+
+    bro.take_and_send_photo()
+    first_key = bro.last_media_key
+    assert benchmark.wait_until(lambda: first_key in bro._file_ids, 5)
+    bro.take_and_send_photo()
+    second_key = bro.last_media_key
+    assert benchmark.wait_until(lambda: second_key in bro._file_ids, 5)
+
+    assert bro.resend_media(first_key) is None
+    assert bro.resend_media(second_key).result(5) is not None
@@ -0,0 +1,171 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+
+import pytest
+from telegram.error import NetworkError
+
+import benchmark
+import spool
+
+
+class Sender:
+    """ Sends the videos of the spool while it is online. Otherwise, they fail with NetworkError """
+
+    def __init__(self, online=True):
+        self.online = online
+        self.attempts = 0
+        self.sent = []
+        self.sent_event = threading.Event()
+
+    def send_video(self, stream, caption=None):
+        self.attempts += 1
+        future = Future()
+        if self.online:
+            self.sent.append(stream.read())
+            self.sent_event.set()
+            future.set_result(True)
+        else:
+            future.set_exception(NetworkError("the network is down"))
+        return future
+
+
+@pytest.fixture
+def make_spool(tmp_path):
+    created = []
+
+    def make(sender, max_bytes=10 ** 6, max_age=3600, retry_delay=60, max_retry_delay=60):
+        upload_spool = spool.UploadSpool(sender, str(tmp_path / "spool"), max_bytes, max_age,
+                                         retry_delay, max_retry_delay)
+        created.append(upload_spool)
+        return upload_spool
+
+    yield make
+    for upload_spool in created:
+        upload_spool.stop()
+
+
+def entry_files(upload_spool):
+    return sorted(name for name in os.listdir(upload_spool.directory) if not name.startswith("README"))
+
+
+def test_entries_are_sent_oldest_first(make_spool):
+    sender = Sender(online=False)
+    upload_spool = make_spool(sender)
+    for video in (b"first", b"second", b"third"):
+        upload_spool.add("send_video", BytesIO(video))
+
+    sender.online = True
+    upload_spool.notify_online()
+
+    assert benchmark.wait_until(lambda: len(sender.sent) == 3, 5)
+    assert sender.sent == [b"first", b"second", b"third"]
+    assert benchmark.wait_until(lambda: entry_files(upload_spool) == [], 5)
+
+
+def test_network_errors_back_off(make_spool, monkeypatch):
+    delays = []
+
+    def backoff_delay(attempt, base, maximum):
+        delays.append((attempt, base, maximum))
+        if attempt == 3:
+            sender.online = True
+        return 0.01
+
+    monkeypatch.setattr(spool.helper, "backoff_delay", backoff_delay)
+    sender = Sender(online=False)
+    upload_spool = make_spool(sender, retry_delay=5, max_retry_delay=300)
+
+    upload_spool.add("send_video", BytesIO(b"video"))
+
+    assert sender.sent_event.wait(5)
+    assert sender.sent == [b"video"]
+    assert sender.attempts == 4
+    assert delays == [(1, 5, 300), (2, 5, 300), (3, 5, 300)]
+
+
+def test_oldest_entries_are_evicted_when_the_spool_is_full(make_spool):
+    upload_spool = make_spool(Sender(online=False), max_bytes=250)
+    for video in (b"a" * 100, b"b" * 100, b"c" * 100):
+        upload_spool.add("send_video", BytesIO(video))
+
+    entries = upload_spool._entries()
+    assert len(entries) == 2
+    with open(f"{entries[0][1]}.data", "rb") as data_file:
+        assert data_file.read() == b"b" * 100
+
+
+def test_old_entries_are_evicted(make_spool):
+    upload_spool = make_spool(Sender(online=False), max_age=0.2)
+    upload_spool.add("send_video", BytesIO(b"old"))
+    time.sleep(0.3)
+    upload_spool.add("send_video", BytesIO(b"new"))
+
+    entries = upload_spool._entries()
+    assert len(entries) == 1
+    with open(f"{entries[0][1]}.data", "rb") as data_file:
+        assert data_file.read() == b"new"
+
+
+def test_files_which_are_not_entries_are_left_alone(make_spool, tmp_path):
+    os.makedirs(tmp_path / "spool")
+    (tmp_path / "spool" / "README.json").write_text("{}")
+    sender = Sender()
+    upload_spool = make_spool(sender)
+
+    upload_spool.add("send_video", BytesIO(b"video"))
+
+    assert sender.sent_event.wait(5)
+    assert benchmark.wait_until(lambda: entry_files(upload_spool) == [], 5)
+    assert (tmp_path / "spool" / "README.json").exists()
+
+
+def test_entry_which_cannot_be_stored_is_dropped(make_spool, monkeypatch):
+    upload_spool = make_spool(Sender(online=False))
+
+    def copyfileobj(source, destination, length=0):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(spool.shutil, "copyfileobj", copyfileobj)
+    upload_spool.add("send_video", BytesIO(b"video"))
+
+    assert entry_files(upload_spool) == []
+
+
+def test_spool_keeps_flushing_after_an_error(make_spool, monkeypatch):
+    sender = Sender(online=False)
+    upload_spool = make_spool(sender, retry_delay=0.02, max_retry_delay=0.05)
+    entries = upload_spool._entries
+    failures = []
+
+    def failing_entries():
+        # the thread of the spool fails once
+        if not failures and threading.current_thread() is upload_spool:
+            failures.append(True)
+            raise OSError(5, "Input/output error")
+        return entries()
+
+    monkeypatch.setattr(upload_spool, "_entries", failing_entries)
+    sender.online = True
+    upload_spool.add("send_video", BytesIO(b"video"))
+
+    assert sender.sent_event.wait(5)
+    assert failures == [True]
@@ -0,0 +1,92 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Commands which arrive while the hardware is being set up (see FourthBrother.init_hardware) """
+
+import os
+import threading
+import time
+
+import pytest
+
+import benchmark
+import constants
+import handlers
+
+
+def _wait_for_message(bot_api, text, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if any(request[1] == "sendMessage" and text in (request[3] or "") for request in bot_api.requests):
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def create_bot(make_bro, monkeypatch):
+    """ The bot of bro.create_bot, without its hardware set up """
+
+    import bro as bro_module
+
+    monkeypatch.setattr(constants, "TOKEN", benchmark.BENCH_TOKEN)
+    monkeypatch.setattr(constants, "AUTHORIZED_CHATS", str(benchmark.BENCH_CHAT_ID))
+    for device, pin in benchmark.PINS.items():
+        monkeypatch.setenv(f"{device}_PIN", str(pin))
+    created = []
+
+    def create():
+        created.append(bro_module.create_bot())
+        return created[-1]
+
+    yield create
+    for bro in created:
+        bro._on_exit()
+
+
+@pytest.mark.parametrize("command, verb", [(handlers.REBOOT, "reiniciar"), (handlers.SHUTDOWN, "apagar")])
+def test_exiting_commands_do_not_wait_for_the_hardware(create_bot, bot_api, monkeypatch, command, verb):
+    # without permissions, the command only answers
+    monkeypatch.setattr(os, "getuid", lambda: 1000)
+    bro = create_bot()
+    bro._start_polling(timeout=1, courtesy_time=1)
+
+    bot_api.push_command(f"/{command}", "tester")
+
+    assert _wait_for_message(bot_api, f"ha intentado {verb} el bot")
+    assert not bro.hardware_ready.is_set()
+
+
+def test_exit_does_not_wait_forever_for_the_hardware(make_bro, bot_api, monkeypatch):
+    monkeypatch.setattr(constants, "HARDWARE_EXIT_TIMEOUT", 0.2)
+    bro = make_bro()
+    calls = []
+    bro.add_command("photo", lambda bro, update: calls.append(update), end_menu=False)
+    bro._start_polling(timeout=1, courtesy_time=1)
+
+    # the camera does not open
+    camera_opened = threading.Event()
+    bro._hardware_thread = threading.Thread(target=camera_opened.wait, args=(10,), daemon=True)
+    bro._hardware_thread.start()
+    # a command is waiting for it
+    bot_api.push_command("/photo", "tester")
+    assert _wait_for_message(bot_api, "El bot se está iniciando")
+
+    start_time = time.monotonic()
+    bro._on_exit()
+    assert time.monotonic() - start_time < 3
+    assert calls == []
+    camera_opened.set()
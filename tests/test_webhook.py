@@ -0,0 +1,136 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+import urllib.request
+
+import pytest
+
+import constants
+
+
+@pytest.fixture
+def webhook_config(monkeypatch):
+    monkeypatch.setattr(constants, "WEBHOOK_URL", "https://bro.example.com/")
+    monkeypatch.setattr(constants, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(constants, "WEBHOOK_PORT", 0)
+    monkeypatch.setattr(constants, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(constants, "WEBHOOK_CERT", "")
+    monkeypatch.setattr(constants, "WEBHOOK_KEY", "")
+    monkeypatch.setattr(constants, "WEBHOOK_SELF_SIGNED", False)
+
+
+def test_updates_arrive_through_the_webhook(make_bro, bot_api, webhook_config):
+    bro = make_bro()
+    received = threading.Event()
+    bro.add_command("ping", lambda bro, update: received.set(), end_menu=False, needs_hardware=False)
+
+    assert bro._start_webhook()
+
+    # registered once, without uploading any certificate
+    assert len(bot_api.webhooks) == 1
+    assert bot_api.webhooks[0]["url"] == "https://bro.example.com/s3cret"
+    assert "certificate" not in bot_api.webhooks[0]
+
+    request = urllib.request.Request(f"http://127.0.0.1:{bro.webhook_server.port}/s3cret",
+                                     data=json.dumps(bot_api.command_update("/ping", "test")).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        assert response.status == 200
+    assert received.wait(5)
+
+
+def test_invalid_certificate_falls_back_to_polling(make_bro, bot_api, webhook_config, monkeypatch, tmp_path):
+    cert = tmp_path / "cert.pem"
+    key = tmp_path / "key.pem"
+    cert.write_text("not a certificate")
+    key.write_text("not a key")
+    monkeypatch.setattr(constants, "WEBHOOK_CERT", str(cert))
+    monkeypatch.setattr(constants, "WEBHOOK_KEY", str(key))
+    bro = make_bro()
+
+    assert not bro._start_webhook()
+    assert bro.webhook_server is None
+    assert bot_api.webhooks == []
+
+
+def test_port_in_use_falls_back_to_polling(make_bro, bot_api, webhook_config, monkeypatch):
+    with socket.socket() as busy_socket:
+        busy_socket.bind(("127.0.0.1", 0))
+        busy_socket.listen()
+        monkeypatch.setattr(constants, "WEBHOOK_PORT", busy_socket.getsockname()[1])
+        bro = make_bro()
+
+        assert not bro._start_webhook()
+        assert bot_api.webhooks == []
+
+
+def test_self_signed_certificate_is_uploaded(make_bro, bot_api, webhook_config, monkeypatch, tmp_path):
+    # behind a proxy there is no private key, so the server does not need to load the certificate
+    cert = tmp_path / "cert.pem"
+    cert.write_text("certificate")
+    monkeypatch.setattr(constants, "WEBHOOK_CERT", str(cert))
+    monkeypatch.setattr(constants, "WEBHOOK_SELF_SIGNED", True)
+    bro = make_bro()
+
+    assert bro._start_webhook()
+    assert len(bot_api.webhooks) == 1
+    assert bot_api.webhooks[0]["certificate"] == "<file>"
+
+
+def _self_signed_certificate(directory, name):
+    cert, key = directory / f"{name}.pem", directory / f"{name}.key"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-keyout", str(key), "-out", str(cert)],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="openssl is not installed")
+def test_key_of_another_certificate_falls_back_to_polling(make_bro, bot_api, webhook_config, monkeypatch,
+                                                           tmp_path):
+    cert, _ = _self_signed_certificate(tmp_path, "first")
+    _, other_key = _self_signed_certificate(tmp_path, "second")
+    monkeypatch.setattr(constants, "WEBHOOK_CERT", str(cert))
+    monkeypatch.setattr(constants, "WEBHOOK_KEY", str(other_key))
+    bro = make_bro()
+
+    assert not bro._start_webhook()
+    assert bot_api.webhooks == []
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="openssl is not installed")
+def test_https_server_with_its_own_certificate(make_bro, bot_api, webhook_config, monkeypatch, tmp_path):
+    cert, key = _self_signed_certificate(tmp_path, "bro")
+    monkeypatch.setattr(constants, "WEBHOOK_CERT", str(cert))
+    monkeypatch.setattr(constants, "WEBHOOK_KEY", str(key))
+    bro = make_bro()
+
+    assert bro._start_webhook()
+    # the certificate is not uploaded unless it is self-signed (WEBHOOK_SELF_SIGNED)
+    assert len(bot_api.webhooks) == 1
+    assert "certificate" not in bot_api.webhooks[0]
+
+    context = ssl.create_default_context(cafile=str(cert))
+    context.check_hostname = False
+    with socket.create_connection(("127.0.0.1", bro.webhook_server.port), timeout=5) as sock:
+        with context.wrap_socket(sock) as tls_socket:
+            assert tls_socket.version() is not None
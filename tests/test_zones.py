@@ -0,0 +1,125 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import time
+
+import pytest
+from gpiozero.pins.mock import MockPin
+
+import zones
+
+NORMAL_PIN = 22
+MANUAL_PIN = 23
+DELAY = 0.05
+
+
+class RecordingPin(MockPin):
+    """ Mock pin which logs every change of state as (time, pin, state) """
+
+    def __init__(self, factory, number, log):
+        self.log = log
+        super().__init__(factory, number)
+
+    def _change_state(self, value):
+        changed = super()._change_state(value)
+        if changed:
+            self.log.append((time.monotonic(), self.number, value))
+        return changed
+
+
+@pytest.fixture
+def relay_log(mock_pins):
+    log = []
+    for pin in (NORMAL_PIN, MANUAL_PIN):
+        mock_pins.pin(pin, pin_class=RecordingPin, log=log)
+    return log
+
+
+def check_relays(log):
+    """ Replays the changes of the pins: the relay of manual mode must never be on while
+        the one of normal mode is off, and the relays must never switch closer than 'DELAY'
+        seconds. NOTE: the relays have negative logic, they are on while the pin is low """
+
+    relay_on = {NORMAL_PIN: False, MANUAL_PIN: False}
+    previous_time = None
+    for change_time, pin, state in log:
+        relay_on[pin] = not state
+        assert not relay_on[MANUAL_PIN] or relay_on[NORMAL_PIN], "manual relay on without the normal one"
+        if previous_time is not None:
+            assert change_time - previous_time >= DELAY * 0.99, "relays switched too close"
+        previous_time = change_time
+
+
+def test_back_to_back_switches(relay_log):
+    lamp = zones.LampRelays(NORMAL_PIN, MANUAL_PIN, delay=DELAY)
+    # both relays are switched off when they are created
+    del relay_log[:]
+
+    futures = [lamp.switch(True), lamp.switch(False), lamp.switch(True), lamp.switch(False)]
+    assert [future.result(5) for future in futures] == [False, False, False, False]
+    assert lamp.is_normal_mode
+    check_relays(relay_log)
+
+    assert lamp.switch(True).result(5)
+    assert not lamp.is_normal_mode
+    assert not lamp.switch(True).result(5)
+    assert lamp.switch(False).result(5)
+    assert lamp.is_normal_mode
+    check_relays(relay_log)
+
+
+def test_random_switches_keep_the_interlock(relay_log):
+    lamp = zones.LampRelays(NORMAL_PIN, MANUAL_PIN, delay=DELAY)
+    # both relays are switched off when they are created
+    del relay_log[:]
+    choices = random.Random(21)
+
+    futures = []
+    for _ in range(60):
+        futures.append(lamp.switch(choices.random() < 0.5))
+        time.sleep(choices.uniform(0, DELAY * 1.5))
+    for future in futures:
+        future.result(5)
+
+    check_relays(relay_log)
+    # the last request is the one which counts
+    manual = lamp._target_manual
+    assert lamp.is_normal_mode != manual
+    assert lamp.relay_normal.value == manual and lamp.relay_manual.value == manual
+
+
+def test_zones_config(monkeypatch):
+    monkeypatch.setenv("GARAJE_LAMP_ON_TIME", "30")
+    monkeypatch.setenv("PATIO_NODE", "n1")
+    for zone, first_pin in (("ENTRADA", 17), ("GARAJE", 5), ("PATIO", 19)):
+        for offset, device in enumerate(zones.DEVICES_NAMES):
+            monkeypatch.setenv(f"{zone}_{device}_PIN", str(first_pin + offset))
+
+    entrada, garaje, patio = zones.read_zones_config("entrada, garaje,patio")
+
+    assert entrada["name"] == "entrada" and entrada["camera"] and not entrada["node"]
+    assert entrada["pins"] == {device: 17 + offset for offset, device in enumerate(zones.DEVICES_NAMES)}
+    # only the first zone has the camera unless told otherwise
+    assert not garaje["camera"] and garaje["lamp_on_time"] == 30
+    # the pins of the zones of a node are only read by that node
+    assert patio["node"] == "n1" and patio["pins"] is None
+    assert zones.read_zones_config("patio", local_node="n1")[0]["pins"] is not None
+
+
+def test_repeated_zones_are_an_error():
+    with pytest.raises(ValueError):
+        zones.read_zones_config("garaje,garaje")
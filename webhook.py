@@ -0,0 +1,79 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import ssl
+import threading
+
+from telegram.ext.utils.webhookhandler import WebhookAppClass
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer(threading.Thread):
+    """ Local server (tornado) Telegram sends the updates to. They are put in 'update_queue'.
+
+        Unlike Updater.start_webhook, whatever can fail (the certificate, the private key,
+        the port) fails in the constructor, with an OSError, so the caller can use polling
+        instead. It does not register the webhook either: that is left to the caller, so it
+        is done only once """
+
+    def __init__(self, bot, update_queue, listen, port, url_path, cert=None, key=None, *args, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+
+        # if the server is behind a proxy which already serves https, there is no certificate
+        self._ssl_ctx = None
+        if cert and key:
+            # NOTE: ssl.SSLError (a key which does not match the certificate) is an OSError
+            self._ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self._ssl_ctx.load_cert_chain(cert, key)
+
+        # the port is taken right now, so a port in use is not discovered later
+        self._sockets = bind_sockets(port, address=listen)
+        self._app = WebhookAppClass(f"/{url_path.lstrip('/')}", bot, update_queue)
+        self._server = None
+        self._loop = IOLoop(make_current=False)
+        self._listening = threading.Event()
+        self.start()
+        self._listening.wait()
+
+    @property
+    def port(self):
+        """ The port the server listens to (useful if it was 0) """
+
+        return self._sockets[0].getsockname()[1]
+
+    def run(self):
+        self._loop.add_callback(self._listen)
+        self._loop.start()
+        self._loop.close(all_fds=True)
+        logger.debug("Webhook server stopped")
+
+    def _listen(self):
+        self._server = HTTPServer(self._app, ssl_options=self._ssl_ctx)
+        self._server.add_sockets(self._sockets)
+        self._listening.set()
+
+    def _shutdown(self):
+        self._server.stop()
+        self._loop.stop()
+
+    def stop(self):
+        self._loop.add_callback(self._shutdown)
+        self.join()
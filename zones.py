@@ -0,0 +1,335 @@
+# FourthBrother allows to use Telegram Bot API to control your Raspberry Pi
+# Copyright (C) 2021 Pablo del Hoyo Abad <pablodelhoyo1314@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from concurrent.futures import Future
+
+from decouple import config
+
+import constants
+import history
+from metrics import REGISTRY
+
+# It is important that in the .env file, in order to specify
+# the pin associated to each device calling the env variable
+# following the format: '{ZONE}_{DEVICE_NAME}_PIN' (or '{DEVICE_NAME}_PIN' if there
+# is only one zone and ZONES is empty)
+DEVICES_NAMES = ["PIR_SENSOR", "RELAY_A", "RELAY_B"]
+# name of the zone when ZONES is empty
+DEFAULT_ZONE = "principal"
+
+
+def read_zones_config(zone_names=constants.ZONES, local_node=""):
+    """ Returns a list with the configuration of each zone declared in 'zone_names' (names
+        separated by commas). 'local_node' is the name of the node reading it, if any.
+        For each zone, the .env file has:
+
+        - '{ZONE}_PIR_SENSOR_PIN', '{ZONE}_RELAY_A_PIN' and '{ZONE}_RELAY_B_PIN'.
+        - '{ZONE}_LAMP_ON_TIME' (optional): seconds the lamp is on after movement.
+        - '{ZONE}_CAMERA' (optional): whether the camera points at the zone. By default,
+          only the first zone has it.
+        - '{ZONE}_NODE' (optional): name of the node (see node.py) the devices of the zone
+          are connected to. The pins are only read by the node """
+
+    names = [name.strip() for name in zone_names.split(",") if name.strip()]
+    if not names:
+        # just one zone whose pins are '{DEVICE_NAME}_PIN'
+        return [{
+            "name": DEFAULT_ZONE,
+            "pins": {device_name: config(f"{device_name}_PIN", cast=int) for device_name in DEVICES_NAMES},
+            "lamp_on_time": constants.LAMP_ON_TIME,
+            "camera": True,
+            "node": ""
+        }]
+
+    if len(set(names)) != len(names):
+        raise ValueError(f"Repeated zones in '{zone_names}'")
+
+    zones = []
+    for i, name in enumerate(names):
+        prefix = name.upper()
+        node = config(f"{prefix}_NODE", default="")
+        pins = None
+        if not node or node == local_node:
+            pins = {device_name: config(f"{prefix}_{device_name}_PIN", cast=int)
+                    for device_name in DEVICES_NAMES}
+        zones.append({
+            "name": name,
+            "pins": pins,
+            "lamp_on_time": config(f"{prefix}_LAMP_ON_TIME", default=constants.LAMP_ON_TIME, cast=int),
+            "camera": config(f"{prefix}_CAMERA", default=i == 0, cast=bool),
+            "node": node
+        })
+
+    return zones
+
+
+class MovementThread(threading.Thread):
+    """ This thread is in charge of switching on or off the lamp of a zone
+        depending on the state of several flags """
+
+    def __init__(self, bro, zone, lamp_on_time, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.bro = bro
+        self.zone = zone
+        self.movement_event = zone.movement_event
+        # minimum time the lamp will be on
+        self.lamp_on_time = lamp_on_time
+
+        # ensure atomicity (https://stackoverflow.com/questions/43879149/stop-a-thread-flag-vs-event)
+        self._finished = threading.Event()
+        self.start()
+
+
+    def run(self):
+        while True:
+            # blocks until the internal flag of the event is set when movement
+            # is detected
+            self.movement_event.wait()
+            if self._finished.is_set():
+                break
+            # since the state of the lamp changes, the menu also does is
+            self.zone.change_to_manual_mode().add_done_callback(lambda future: self.bro.send_menu())
+            self.movement_event.clear()
+
+            # if we detect movement but the lamp is still on, wait another 'on_time' seconds
+            # before switching it off, but only if we are not exiting
+            while self.movement_event.wait(self.lamp_on_time):
+                if not self._finished.is_set():
+                    self.movement_event.clear()
+                else:
+                    break
+
+            switched = self.zone.change_to_normal_mode()
+            # again, update the menu but if it is appropiate
+            if not self.bro.is_executing_callback.is_set() and not self._finished.is_set():
+                switched.add_done_callback(lambda future: self.bro.send_menu())
+
+    def stop(self):
+        self._finished.set()
+        self.movement_event.set()
+        self.join()
+
+
+class LampRelays:
+    """ The pair of relays of a lamp. To avoid possible shortcircuits, the relay of manual mode
+        is only on while the relay of normal mode is on, and there are always 'delay' seconds
+        (the time a relay needs to switch state) between two operations on the relays.
+
+        Nobody waits for those seconds: 'switch' schedules the operations on a timer and
+        returns a Future. A request which arrives while the relays are still switching changes
+        where they are going, so they are never switched back and forth for nothing """
+
+    def __init__(self, relay_normal_pin, relay_manual_pin, name="", delay=constants.DELAY_RELAYS):
+        # gpiozero takes a while to import, so it is not imported until the devices are
+        # created (once the bot is already answering, see FourthBrother.init_hardware)
+        from negative_logic_relay import NegativeLogicRelay
+
+        self.name = name
+        # when this relay is on, the lamp acts as if there were no pir sensor
+        self.relay_normal = NegativeLogicRelay(relay_normal_pin)
+        self.relay_manual = NegativeLogicRelay(relay_manual_pin)
+        self.delay = delay
+
+        self._lock = threading.Lock()
+        # whether the relays are going to manual mode and the Futures of the requests which
+        # wait for it (along with the mode there was when they were made)
+        self._target_manual = False
+        self._waiting = []
+        self._timer = None
+        self._last_operation_time = None
+
+        # it only changes once both relays have switched
+        self.is_normal_mode = True
+
+    def switch(self, manual):
+        """ Changes to manual mode (the lamp activate when the relay is on) or to normal mode
+            (the lamp acts as if there were no pir sensor). Returns a Future whose result is
+            True if the mode has changed (False if it already was in that mode or another
+            request has changed it back before the relays had switched) """
+
+        future = Future()
+        superseded = []
+        with self._lock:
+            if manual != self._target_manual:
+                superseded, self._waiting = self._waiting, []
+                self._target_manual = manual
+            self._waiting.append((future, self.is_normal_mode))
+
+            if self._timer is None:
+                fulfilled = self._step()
+            elif self._next_operation() is None:
+                # the relays have not moved yet, so the timer is not needed anymore
+                self._timer.cancel()
+                fulfilled = self._step()
+            else:
+                # the timer will do the next operation towards the new target
+                fulfilled = []
+
+        if superseded:
+            REGISTRY.counter("relay_requests_superseded_total", "Requests of a mode changed before completing",
+                             zone=self.name).inc(len(superseded))
+        for waiting_future, _ in superseded:
+            waiting_future.set_result(False)
+        for waiting_future, changed in fulfilled:
+            waiting_future.set_result(changed)
+        return future
+
+    def _next_operation(self):
+        """ Returns the next operation towards the target mode (None if it has been reached).
+            The relay of normal mode is switched first when going to manual mode and last
+            when going to normal mode """
+
+        if self._target_manual:
+            if not self.relay_normal.value:
+                return self.relay_normal.on
+            if not self.relay_manual.value:
+                return self.relay_manual.on
+        else:
+            if self.relay_manual.value:
+                return self.relay_manual.off
+            if self.relay_normal.value:
+                return self.relay_normal.off
+        return None
+
+    def _step(self):
+        """ Does the next operation if it can be done now or schedules it. Must be called
+            with the lock held. Returns the requests fulfilled as (future, changed) """
+
+        self._timer = None
+        operation = self._next_operation()
+        if operation is not None:
+            now = time.monotonic()
+            wait = 0
+            if self._last_operation_time is not None:
+                wait = self._last_operation_time + self.delay - now
+
+            if wait <= 0:
+                operation()
+                REGISTRY.counter("relay_operations_total", "Operations on the relays", zone=self.name).inc()
+                self._last_operation_time = now
+                operation = self._next_operation()
+                # leave enough time for the relay to switch state. We don't want a shortcircuit
+                wait = self.delay
+
+            if operation is not None:
+                self._timer = threading.Timer(wait, lambda: self._on_timer(timer))
+                timer = self._timer
+                timer.daemon = True
+                timer.start()
+                return []
+
+        self.is_normal_mode = not self._target_manual
+        fulfilled = [(future, is_normal_mode != self.is_normal_mode) for future, is_normal_mode in self._waiting]
+        self._waiting = []
+        return fulfilled
+
+    def _on_timer(self, timer):
+        with self._lock:
+            # a cancelled timer could have fired anyway
+            if self._timer is not timer:
+                return
+            fulfilled = self._step()
+
+        for future, changed in fulfilled:
+            future.set_result(changed)
+
+
+class BaseZone:
+    """ State of a zone and the thread which switches its lamp when there is movement.
+        Subclasses decide where the devices are (see Zone and hub.RemoteZone) """
+
+    def __init__(self, bro, name, lamp_on_time, camera=False):
+        self.bro = bro
+        self.name = name
+        # whether the camera points at this zone (its alerts come with a video)
+        self.has_camera = camera
+
+        self.pir_activated = False
+        self.last_time_pir = 0
+
+        # If this is true, then the lamp will be on for an specified amount of time when the pir sensor
+        # detects movement
+        self.movement_activated = False
+        self.movement_event = threading.Event()
+        self.switch_on_from_button = threading.Event()
+
+        self.movement_thread = MovementThread(bro, self, lamp_on_time, name=f"movement-{name}")
+
+    @property
+    def is_normal_mode(self):
+        raise NotImplementedError
+
+    def _switch(self, manual):
+        """ Returns a Future whose result is True if the mode has changed """
+
+        raise NotImplementedError
+
+    def _change_mode(self, manual):
+        mode = "manual" if manual else "normal"
+        start_time = time.monotonic()
+
+        def on_switched(future):
+            REGISTRY.histogram("relay_switch_seconds", "Time spent switching the relays",
+                               mode=mode, zone=self.name).observe(time.monotonic() - start_time)
+            if future.result():
+                self.bro.history.record(history.EVENT_MODE, f"{mode} ({self.name})")
+
+        future = self._switch(manual)
+        future.add_done_callback(on_switched)
+        return future
+
+    def change_to_normal_mode(self):
+        """ Switches the relays in such a way that the lamps acts as if there were no pir sensor.
+            It does not wait for the relays: the Future returned is done once they have switched """
+
+        return self._change_mode(False)
+
+    # TODO: make sure to gracefully change to manual mode when exiting in case
+    # it is not in that mode
+    def change_to_manual_mode(self):
+        """ Switches the relays in such a way that the lamp activate when the relay is on.
+            It does not wait for the relays: the Future returned is done once they have switched """
+
+        return self._change_mode(True)
+
+    def stop(self):
+        # NOTE: stop() calls join()
+        self.movement_thread.stop()
+
+
+class Zone(BaseZone):
+    """ A pir sensor and the pair of relays of its lamp connected to this Pi. Every zone has
+        its own state and its own lock, so switching the lamp of a zone never waits for
+        another zone """
+
+    def __init__(self, bro, name, pins, lamp_on_time, camera=False):
+        # see LampRelays.__init__
+        from gpiozero import MotionSensor
+
+        self.pir_sensor = MotionSensor(pins["PIR_SENSOR"])
+        self.lamp = LampRelays(pins["RELAY_A"], pins["RELAY_B"], name)
+
+        super().__init__(bro, name, lamp_on_time, camera)
+
+    @property
+    def is_normal_mode(self):
+        return self.lamp.is_normal_mode
+
+    def _switch(self, manual):
+        return self.lamp.switch(manual)